@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""基于 asyncio 的代理检测.
+
+NOTE:
+  + 需要 python3.5 以上 (async/await)
+  + 没有依赖第三方的 http library，直接通过 asyncio 的 stream 向代理发送 HTTP/1.1 请求
+  + 总并发数由 CONCURRENT.ASYNC_TOTAL 限制，对同一个代理 (ip:port) 的并发数由
+    CONCURRENT.ASYNC_PER_HOST 限制; 开启 ADAPTIVE 时，在此之下再由 AIMD 按错误率和耗时
+    调整各阶段和各 target 的并发数，对各 target 的请求速率由令牌桶限制，见 limiter.py
+  + 检测结果通过回调交给调用者处理 (例如写入 redis)，回调在事件循环中执行，不应阻塞太久
+  + 与代理的连接保持 keep-alive，在同一个事件循环中复用，每个代理最多保持 ASYNC_PER_HOST
+    个空闲连接; 复用的连接失败时用新连接重试一次
+  + 可用性检测边读边查找 VALIDATE 标记，提前结束的连接不再复用，见 probe.py
+"""
+
+import time
+import asyncio
+import logging
+import collections
+from urllib.parse import urlsplit
+
+from probe import Scanner, Timing
+
+
+# 响应 body 的最大长度，超过的部分不再读取
+MAX_BODY = 1024 * 1024
+
+
+class HTTPError(Exception):
+    """代理返回了无法解析的响应"""
+
+
+class AsyncLimiter(object):
+    """asyncio 下的 limiter.Limiter，按 AIMD 的并发数限制同时进行的检测，需要在事件循环中创建.
+    """
+    def __init__(self, policy):
+        self.policy    = policy
+        self.condition = asyncio.Condition()
+        self.inflight  = 0
+
+    async def acquire(self):
+        async with self.condition:
+            while self.inflight >= int(self.policy.limit):
+                await self.condition.wait()
+            self.inflight += 1
+        return time.time()
+
+    async def release(self, ok, time_start):
+        self.policy.record(ok, time.time() - time_start)
+        async with self.condition:
+            self.inflight -= 1
+            self.condition.notify(max(1, int(self.policy.limit) - self.inflight))
+
+
+async def wait_rate(rate):
+    # 等待 limiter.RateLimiter 允许发送下一个请求，不阻塞事件循环
+    delay = rate.reserve()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def _split_proxy(proxy):
+    # 'http://ip:port' -> ('ip', port)
+    parts = urlsplit(proxy)
+    return parts.hostname, parts.port or 80
+
+
+class AsyncValidator(object):
+    """用 asyncio 并发地通过代理访问指定站点.
+    """
+    def __init__(self, headers=None, timeout=10, total=1000, per_host=10,
+                 stage_policies=None, target_policies=None, target_rates=None):
+        self.headers  = dict(headers or {})
+        self.timeout  = timeout
+        self.total    = total
+        self.per_host = per_host
+
+        # 各阶段和各 target 的 limiter.AIMD，以及各 target 的 limiter.RateLimiter
+        self.stage_policies  = stage_policies or {}
+        self.target_policies = target_policies or {}
+        self.target_rates    = target_rates or {}
+        self.target_limiters = {}    # 在事件循环中创建的 AsyncLimiter
+
+        # 响应需要在本地检查内容，不接受压缩的 body
+        self.headers['Accept-Encoding']  = 'identity'
+        self.headers['Connection']       = 'keep-alive'
+        self.headers['Proxy-Connection'] = 'keep-alive'
+
+        self.idle       = collections.defaultdict(list)    # 每个代理的空闲连接
+        self.num_new    = 0
+        self.num_reused = 0
+
+    def _build_request(self, url):
+        parts = urlsplit(url)
+        lines = ['GET %s HTTP/1.1' % (url,), 'Host: %s' % (parts.netloc,)]
+        for key, val in self.headers.items():
+            if key.lower() != 'host':
+                lines.append('%s: %s' % (key, val))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def fetch(self, proxy, url):
+        """
+        GET 'url' through 'proxy' ('http://ip:port'), return (status, body).
+        Raise an exception on network errors or timeout.
+        """
+        reader, writer, reused = await self._connect(proxy)
+        try:
+            writer.write(self._build_request(url))
+            status, body, keep = await asyncio.wait_for(self._read_response(reader),
+                                                        self.timeout)
+        except Exception:
+            writer.close()
+            if not reused:
+                raise
+            # 空闲的连接可能已被代理关闭，用新连接重试一次
+            self.idle.pop(proxy, None)
+            return await self.fetch(proxy, url)
+
+        idle = self.idle[proxy]
+        if keep and len(idle) < self.per_host:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+        return status, body
+
+    async def _connect(self, proxy):
+        # 返回 (reader, writer, 是否是复用的连接)
+        idle = self.idle.get(proxy)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                self.num_reused += 1
+                return reader, writer, True
+            writer.close()
+
+        host, port = _split_proxy(proxy)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), self.timeout)
+        self.num_new += 1
+
+        return reader, writer, False
+
+    async def probe(self, proxy, url, val):
+        """
+        GET 'url' through 'proxy' and read the body only until 'val' or
+        </title> appears, return a Timing.
+        Raise an exception on network errors or timeout.
+        """
+        time_start = time.time()
+        reader, writer, reused = await self._connect(proxy)
+        connect = time.time() - time_start
+        try:
+            writer.write(self._build_request(url))
+            status, found, ttfb, keep = await asyncio.wait_for(
+                self._scan_response(reader, Scanner(val), time_start), self.timeout)
+        except Exception:
+            writer.close()
+            if not reused:
+                raise
+            self.idle.pop(proxy, None)
+            return await self.probe(proxy, url, val)
+
+        idle = self.idle[proxy]
+        if keep and len(idle) < self.per_host:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+        return Timing(status == 200 and bool(found), connect, ttfb, time.time() - time_start)
+
+    async def _scan_response(self, reader, scanner, time_start):
+        # 返回 (status, 是否找到标记, TTFB, 连接是否可以复用)
+        status, headers, keep = await self._read_head(reader)
+        ttfb = time.time() - time_start
+        if status != 200:
+            # 非 200 的响应不检查内容，连接也不再复用
+            return status, False, ttfb, False
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                line   = await reader.readline()
+                length = int(line.split(b';')[0].strip() or b'0', 16)
+                if length == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunk = await reader.readexactly(length)
+                await reader.readline()
+                if scanner.feed(chunk):
+                    keep = False
+                    break
+        elif 'content-length' in headers:
+            left = int(headers['content-length'])
+            while left > 0:
+                chunk = await reader.read(min(left, 8192))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', left)
+                left -= len(chunk)
+                if scanner.feed(chunk) and left > 0:
+                    keep = False
+                    break
+        else:
+            keep = False
+            while True:
+                chunk = await reader.read(8192)
+                if not chunk or scanner.feed(chunk):
+                    break
+
+        return status, scanner.found, ttfb, keep
+
+    async def _read_head(self, reader):
+        # 返回 (status, headers, 连接是否可以复用)
+        status_line = await reader.readline()
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise HTTPError('Bad status line %r' % (status_line[:100],))
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, val = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = val.strip()
+
+        keep = (status_line.startswith(b'HTTP/1.1')
+                and headers.get('connection', '').lower() != 'close'
+                and headers.get('proxy-connection', '').lower() != 'close')
+
+        return status, headers, keep
+
+    async def _read_response(self, reader):
+        # 返回 (status, body, 连接是否可以复用)
+        status, headers, keep = await self._read_head(reader)
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body, complete = await self._read_chunked(reader)
+            keep = keep and complete
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            body   = await reader.readexactly(min(length, MAX_BODY))
+            keep   = keep and length <= MAX_BODY
+        else:
+            body = await reader.read(MAX_BODY)
+            keep = False
+
+        return status, body, keep
+
+    async def _read_chunked(self, reader):
+        # 返回 (body, 是否读完了整个 body)
+        chunks = []
+        size   = 0
+        while size < MAX_BODY:
+            line = await reader.readline()
+            length = int(line.split(b';')[0].strip() or b'0', 16)
+            if length == 0:
+                # 跳过 trailer
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks), True
+            chunks.append(await reader.readexactly(length))
+            await reader.readline()
+            size += length
+
+        return b''.join(chunks), False
+
+    def _run(self, coros, stage):
+        # 在新的事件循环中运行所有任务，限制总并发数和对同一个代理的并发数;
+        # 每个任务返回检测是否成功，反馈给 stage 的 AIMD
+        async def run_all():
+            total    = asyncio.Semaphore(self.total)
+            per_host = collections.defaultdict(lambda: asyncio.Semaphore(self.per_host))
+            policy   = self.stage_policies.get(stage)
+            adaptive = AsyncLimiter(policy) if policy is not None else None
+            self.target_limiters = dict((target, AsyncLimiter(policy))
+                                        for target, policy in self.target_policies.items())
+
+            async def limited(proxy, coro):
+                if adaptive is None:
+                    async with total:
+                        async with per_host[proxy]:
+                            return await coro
+
+                time_start = await adaptive.acquire()
+                ok         = False
+                try:
+                    async with total:
+                        async with per_host[proxy]:
+                            ok = await coro
+                            return ok
+                finally:
+                    await adaptive.release(ok, time_start)
+
+            await asyncio.gather(*[limited(proxy, coro) for proxy, coro in coros])
+
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(run_all())
+        finally:
+            # 连接属于这个事件循环，不能在之后的事件循环中复用
+            for idle in self.idle.values():
+                for reader, writer in idle:
+                    writer.close()
+            self.idle.clear()
+            self.target_limiters = {}
+            asyncio.set_event_loop(None)
+            loop.close()
+
+        logging.info('Connections of asyncio: %d new, %d reused'
+                     % (self.num_new, self.num_reused))
+
+    async def _check_anony(self, proxy, url_reflect, judge, callback):
+        try:
+            status, body = await self.fetch(proxy.decode('utf-8'), url_reflect)
+        except Exception as e:
+            logging.debug('Error when validating anonymous: %r' % (e,))
+            callback(proxy, None)
+            return False
+        if status != 200:
+            # 代理返回的错误页面不是 reflect 的响应，与连接失败一样处理
+            logging.debug('Status %d when validating anonymous' % (status,))
+            callback(proxy, None)
+            return False
+
+        callback(proxy, judge(body))
+        return True
+
+    def filter_anony(self, proxies, url_reflect, judge, callback):
+        """
+        Check whether each proxy in 'proxies' (b'http://ip:port') is anonymous
+        by visiting 'url_reflect' and passing the response body to
+        judge(body), call callback(proxy, is_anonymous) for each proxy,
+        'is_anonymous' is None if the proxy didn't respond.
+        """
+        self._run([(proxy, self._check_anony(proxy, url_reflect, judge, callback))
+                   for proxy in proxies], 'filter')
+
+    async def _timing(self, target, proxy, url, val):
+        adaptive = self.target_limiters.get(target)
+        rate     = self.target_rates.get(target)
+        timing   = Timing(False, None, None, None)
+
+        # 反馈给 AIMD 的耗时从限速的等待结束后算起，见 ProxyPool._limited
+        time_start = await adaptive.acquire() if adaptive is not None else None
+        try:
+            if rate is not None:
+                await wait_rate(rate)
+                time_start = time.time()
+            timing = await self.probe(proxy, url, val)
+        except Exception as e:
+            logging.debug('Error when validating %s: %r' % (proxy, e))
+        finally:
+            if adaptive is not None:
+                await adaptive.release(timing.ok, time_start)
+
+        return timing
+
+    async def _timing_all(self, proxy, sites, callback):
+        # 并发访问所有站点，每个站点一个连接，全部完成后一次性交给回调
+        targets = [site[0] for site in sites]
+        timings = await asyncio.gather(*[self._timing(target, proxy, url, val)
+                                         for target, url, val in sites])
+        callback(proxy, dict(zip(targets, timings)))
+
+        return any(timing.ok for timing in timings)
+
+    def valid_active(self, proxies, sites, callback):
+        """
+        Visit all sites in 'sites' ([(target, url, VALIDATE), ...])
+        concurrently through each proxy in 'proxies' ('http://ip:port'),
+        call callback(proxy, {target: Timing, ...}) once per proxy.
+        """
+        self._run([(proxy, self._timing_all(proxy, sites, callback))
+                   for proxy in proxies], 'valid')
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""批量写 redis.
+
+NOTE:
+  + 写操作先放入缓冲区，缓冲区满 (STORE.BATCH_SIZE) 或距离上次写入超过
+    STORE.BATCH_DELAY 秒时，由后台线程通过一个 pipeline 写入 redis
+  + 连接失败或超时时按指数退避重试，最多 STORE.TRY 次，每次等待不超过 STORE.TIME_WAIT 秒;
+    重试时使用同一个 StrictRedis，由共享的连接池重新建立连接，不再新建 StrictRedis
+  + 命令本身出错 (例如 WRONGTYPE) 时不重试: EXEC 中出错的命令不会回滚其他命令，重试会把
+    其他命令 (例如 incr) 再执行一次; 只记录并丢弃出错的命令，其他命令照常计入已写入
+  + add() 不会阻塞在 redis 的网络操作上，可以在 asyncio 的回调中调用
+  + 每次写入是一个 MULTI/EXEC 事务，add_many() 加入的一组命令不会被拆到两次写入中，
+    因此这组命令是原子执行的
+  + 每次写入成功后以写入的命令调用 on_write，ProxyPool 由此发布 mtime 的变化
+  + 后台线程在第一次 add() 时启动，close() 时停止; 各阶段的线程共用一个 writer，close()
+    的同时另一个线程可能在 add()，所以线程的启动和停止都在锁中进行，每个线程有自己的
+    代数 (generation) 和 Event，close() 只停止当时的线程，之后 add() 启动新的线程
+"""
+
+import time
+import random
+import logging
+import threading
+
+import redis
+
+import metrics
+
+
+WRITER_BUFFER   = metrics.REGISTRY.gauge(
+    'proxypool_writer_buffer', 'Commands buffered in BatchWriter')
+WRITER_COMMANDS = metrics.REGISTRY.counter(
+    'proxypool_writer_commands_total', 'Commands written by BatchWriter by result')
+
+
+class BatchWriter(object):
+    """缓冲写操作，批量通过 pipeline 写入 redis.
+    """
+    def __init__(self, rdb, size=500, delay=1, try_times=3, time_wait=5, on_write=None):
+        self.rdb       = rdb
+        self.size      = size
+        self.delay     = delay
+        self.try_times = try_times
+        self.time_wait = time_wait
+        self.on_write  = on_write
+
+        self.buffer     = []
+        self.lock       = threading.Lock()
+        self.lock_flush = threading.Lock()
+        self.wakeup     = threading.Event()
+        self.thread     = None
+        self.generation = 0    # 后台线程的代数，close() 时加一，旧的线程随后退出
+
+        # 统计已写入的命令数和 pipeline 数
+        self.num_commands  = 0
+        self.num_pipelines = 0
+
+    def add(self, command, *args):
+        """Buffer a redis command, e.g. add('sadd', 'sproxy_all', proxy)"""
+        self.add_many([(command, args)])
+
+    def add_many(self, commands):
+        """Buffer a group of commands [(command, args), ...] which are written atomically"""
+        with self.lock:
+            self.buffer.extend(commands)
+            num = len(self.buffer)
+            WRITER_BUFFER.set(num)
+            if self.thread is None:
+                self._start()
+            wakeup = self.wakeup
+
+        if num >= self.size:
+            wakeup.set()
+
+    def _start(self):
+        # 在 self.lock 中调用
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(self.generation, self.wakeup))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, generation, wakeup):
+        while True:
+            wakeup.wait(self.delay)
+            wakeup.clear()
+            with self.lock:
+                if generation != self.generation:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Write all buffered commands into redis, return the number written"""
+        with self.lock_flush:
+            with self.lock:
+                commands, self.buffer = self.buffer, []
+                WRITER_BUFFER.set(0)
+
+            if not commands:
+                return 0
+
+            for try_times in range(1, self.try_times + 1):
+                try:
+                    pipe = self.rdb.pipeline(transaction=True)
+                    for command, args in commands:
+                        getattr(pipe, command)(*args)
+                    with metrics.REDIS_SECONDS.time(op='pipeline'):
+                        results = pipe.execute(raise_on_error=False)
+                except (redis.ConnectionError, redis.TimeoutError) as e:
+                    logging.info('Tried %d' % (try_times,))
+                    if try_times >= self.try_times:
+                        logging.error('Dropped %d commands: %r' % (len(commands), e))
+                        WRITER_COMMANDS.inc(len(commands), result='dropped')
+                        return 0
+                    wait = min(self.time_wait, 0.1 * 2 ** try_times)
+                    time.sleep(random.uniform(0, wait))
+                    continue
+                except Exception as e:
+                    # 整个事务没有执行 (EXECABORT，或 SQLite 回滚)，重试也是同样的结果
+                    logging.error('Dropped %d commands: %r' % (len(commands), e))
+                    WRITER_COMMANDS.inc(len(commands), result='dropped')
+                    return 0
+
+                return self._written(commands, results)
+
+    def _written(self, commands, results):
+        # 记录执行出错的命令，以写入成功的命令调用 on_write，返回写入成功的命令数;
+        # on_write 出错不影响已经写入的命令，也不重试
+        errors  = [(command, result) for command, result in zip(commands, results)
+                   if isinstance(result, Exception)]
+        written = [command for command, result in zip(commands, results)
+                   if not isinstance(result, Exception)]
+        if errors:
+            logging.error('Dropped %d of %d commands, first error in %s: %r'
+                          % (len(errors), len(commands), errors[0][0][0], errors[0][1]))
+            WRITER_COMMANDS.inc(len(errors), result='error')
+
+        self.num_commands  += len(written)
+        self.num_pipelines += 1
+        WRITER_COMMANDS.inc(len(written), result='ok')
+
+        if self.on_write is not None and written:
+            try:
+                self.on_write(written)
+            except Exception as e:
+                logging.error('Error after writing %d commands: %r' % (len(written), e))
+
+        return len(written)
+
+    def close(self):
+        """Stop the background thread and flush the remaining commands"""
+        with self.lock:
+            thread, wakeup  = self.thread, self.wakeup
+            self.thread     = None
+            self.generation += 1
+        wakeup.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较分别请求各 target 的 /proxylist 和一次请求 /proxylist/batch 的耗时，以及大的 num 下
+json 和 NDJSON 流式返回的首字节时间.
+
+CACHE.CHECK_INTERVAL 设为 0，每个请求都要读 mtime，对应缓存刚过期时的情况; 每一项的
+redis_commands 是每个请求平均执行的 redis 命令数 (一个 MULTI/EXEC 算作一个).
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_batch
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import http.client
+
+from proxypool import ProxyPool
+from listcache import ProxyListCache
+from benchmarks.common import make_configfile, serve_in_thread, Timer
+from benchmarks.stubredis import StubRedis
+from benchmarks.bench_handler import seed
+
+
+HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def make_app(configfile):
+    import tornado.web
+    from handlers.handler_template import ProxyListHandler, BatchProxyListHandler
+
+    proxypool = ProxyPool(configfile)
+    listcache = ProxyListCache(proxypool, check_interval=0)
+    handler_args = dict(proxypool=proxypool, listcache=listcache)
+    return tornado.web.Application([
+        (r'/proxylist', ProxyListHandler, handler_args),
+        (r'/proxylist/batch', BatchProxyListHandler, handler_args),
+    ])
+
+
+def _post(conn, path, body):
+    # 返回 (首字节的时间, 结束的时间)
+    time_start = time.time()
+    conn.request('POST', path, body, HEADERS)
+    res = conn.getresponse()
+    res.read(1)
+    time_first = time.time()
+    res.read()
+    return time_first - time_start, time.time() - time_start
+
+
+def run_targets(port, stub, targets, num_requests, num):
+    """Return the reports of separate requests and one batch request for 'targets'"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    results = []
+    try:
+        for mode in ('separate', 'batch'):
+            timer    = Timer()
+            commands = stub.num_commands
+            for _ in range(num_requests):
+                with timer:
+                    if mode == 'batch':
+                        specs = ','.join('%s:%d:10' % (target, num) for target in targets)
+                        _post(conn, '/proxylist/batch', 'spec=%s' % (specs,))
+                    else:
+                        for target in targets:
+                            _post(conn, '/proxylist', 'target=%s&num=%d' % (target, num))
+            report = timer.report(mode)
+            report['redis_commands'] = (stub.num_commands - commands) / float(num_requests)
+            results.append(report)
+    finally:
+        conn.close()
+
+    return results
+
+
+def run_stream(port, num_requests, num):
+    """Return the reports of a large 'num' in json and NDJSON"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    results = []
+    try:
+        for mode in ('json', 'stream'):
+            body = 'spec=all:%d:30' % (num,)
+            if mode == 'stream':
+                body += '&stream=1'
+            timer = Timer()
+            firsts = []
+            for _ in range(num_requests):
+                with timer:
+                    time_first, _ = _post(conn, '/proxylist/batch', body)
+                firsts.append(time_first)
+            report = timer.report('%s-%d' % (mode, num))
+            report['ttfb_ms'] = sorted(firsts)[len(firsts) // 2] * 1000
+            results.append(report)
+    finally:
+        conn.close()
+
+    return results
+
+
+def bench(num_requests=500, num=10, num_proxies=1000, large=100000):
+    """Return the reports of separate vs batch requests and json vs NDJSON"""
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    stub       = StubRedis().start()
+    configfile = make_configfile(stub.port)
+    try:
+        proxypool = ProxyPool(configfile)
+        seed(proxypool.rdb, proxypool.configs, max(num_proxies, large))
+        targets   = [target.lower() for target in proxypool.targets]
+
+        port, stop = serve_in_thread(make_app(configfile))
+        try:
+            results  = run_targets(port, stub, targets, num_requests, num)
+            results += run_stream(port, max(5, num_requests // 100), large)
+        finally:
+            stop()
+    finally:
+        os.remove(configfile)
+        stub.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=500)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--large', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(json.dumps(bench(args.requests, args.num, large=args.large), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""测量抓取阶段 (抓取页面 + 进程池解析 + 写入 redis) 每秒处理的页面数.
+
+页面由本地的假站点提供，结构与 settings.yaml 中 PROXY_SITES 各站点相同; 每个站点复制的
+几份页面中的代理相同，同时报告去重后的代理数、去掉的重复数 (即节省的写入和检测次数)，
+以及去重索引 (proxyaddr.ProxyIndex) 与保存 bytes 的 set 每个代理占用的内存.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_crawl
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import tracemalloc
+
+import yaml
+
+import proxyaddr
+from proxypool import ProxyPool
+from benchmarks.common import ROOT, make_configfile, serve_in_thread
+from benchmarks.fakenet import make_site_app, site_path
+from benchmarks.stubredis import StubRedis
+from benchmarks.bench_parse import make_page
+
+
+def make_sites(port, copies, rows):
+    # 每个 PROXY_SITES 站点复制 copies 份，返回 (PROXY_SITES 配置, {url: 页面})
+    with open(os.path.join(ROOT, 'settings.yaml'), 'rb') as fp:
+        origin = yaml.safe_load(fp)['PROXY_SITES']
+
+    sites = {}
+    pages = {}
+    for url, val in origin.items():
+        page = make_page(url, rows)
+        for copy in range(copies):
+            key = '%s#%d' % (url, copy)
+            local_url = 'http://127.0.0.1:%d%s' % (port, site_path(key))
+            sites[local_url] = {'rules': val['rules'], 'proxies': {'http': '', 'https': ''}}
+            pages[key] = page
+
+    return sites, pages
+
+
+def measure_memory(proxies):
+    """
+    Return the bytes per proxy of a set of b'http://ip:port' and of a
+    ProxyIndex holding the same 'proxies'.
+    """
+    proxies = [proxyaddr.normalize(proxy) for proxy in proxies]
+    results = {}
+    for name in ('set', 'index'):
+        tracemalloc.start()
+        if name == 'set':
+            holder = set(proxy.encode('utf-8') for proxy in proxies)
+        else:
+            holder = proxyaddr.ProxyIndex()
+            holder.add_many(proxies)
+        results[name] = tracemalloc.get_traced_memory()[0] / max(1, len(proxies))
+        tracemalloc.stop()
+        del holder
+
+    return results
+
+
+def bench(copies=20, rows=200):
+    """Return the crawling speed of 'copies' copies of each site with 'rows' proxies"""
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    pages = {}
+    port, stop = serve_in_thread(make_site_app(pages))
+    stub       = StubRedis().start()
+    configfile = make_configfile(stub.port)
+    try:
+        sites, site_pages = make_sites(port, copies, rows)
+        pages.update(site_pages)
+
+        proxypool = ProxyPool(configfile)
+        proxypool.configs['PROXY_SITES'] = sites
+
+        dedup = {}
+        report_dedup = proxypool._report_dedup
+        proxypool._report_dedup = lambda index: dedup.update(report_dedup(index))
+
+        time_start = time.time()
+        proxypool.fetch_proxies()
+        elapsed = time.time() - time_start
+
+        num_proxies = proxypool.rdb.scard(proxypool.sproxy_all)
+        memory      = measure_memory(['http://10.%d.%d.%d:%d' % (i >> 16 & 255, i >> 8 & 255,
+                                                              i & 255, 8000 + i % 1000)
+                                      for i in range(100000)])
+    finally:
+        os.remove(configfile)
+        stub.stop()
+        stop()
+
+    return [{
+        'name': 'crawl',
+        'pages': len(sites),
+        'proxies': num_proxies,
+        'duplicates': dedup.get('duplicates'),
+        'pages_per_sec': len(sites) / elapsed,
+        'set_bytes_per_proxy': memory['set'],
+        'index_bytes_per_proxy': memory['index'],
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--copies', type=int, default=20, help='每个站点复制的份数')
+    parser.add_argument('-r', '--rows', type=int, default=200, help='每个页面的代理数')
+    args = parser.parse_args()
+
+    print(json.dumps(bench(args.copies, args.rows), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较 get_many 取出整个分数区间再 shuffle、按排名随机抽样和按分数加权抽样的耗时.
+
+加权抽样 (weighted) 的 alias 表在 mtime 不变时只建立一次，建表的耗时单独记录为 build_ms.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_get_many
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import argparse
+
+from proxypool import ProxyPool
+from benchmarks.common import make_configfile, Timer
+from benchmarks.stubredis import StubRedis, ZSet
+
+
+def legacy_get_many(proxypool, db, num, minscore, maxscore):
+    # 之前的实现: 取出分数区间内的所有代理，shuffle 后切片
+    res = proxypool.rdb.zrangebyscore(db, minscore, maxscore)
+    random.shuffle(res)
+    return res[:num]
+
+
+def make_zset(size):
+    zset = ZSet()
+    for i in range(size):
+        proxy = ('http://10.%d.%d.%d:%d' % (i >> 16 & 255, i >> 8 & 255, i & 255,
+                                            8000 + (i >> 24))).encode('utf-8')
+        zset.add(proxy, random.uniform(0, 30))
+    zset.sorted()
+    return zset
+
+
+def bench(num_requests=200, num=10, sizes=(1000, 100000, 1000000)):
+    """Return the reports of both implementations on sorted sets of 'sizes'"""
+    logging.getLogger().setLevel(logging.ERROR)
+
+    stub       = StubRedis().start()
+    configfile = make_configfile(stub.port)
+    try:
+        proxypool = ProxyPool(configfile)
+        db        = proxypool.configs['TARGET']['ALL']['DB_PROXY']
+        db_mtime  = proxypool.configs['TARGET']['ALL']['DB_MTIME']
+        maxscore  = proxypool.init_value
+
+        results = []
+        for size in sizes:
+            stub.store.data[db.encode('utf-8')] = make_zset(size)
+            proxypool.rdb.set(db_mtime, size)
+
+            for name, get_many in (('zrangebyscore+shuffle', legacy_get_many),
+                                   ('rank-sample', None),
+                                   ('weighted', None)):
+                timer = Timer()
+                # 大的 sorted set 上旧实现非常慢，只减少它的请求次数; 每种大小分别计算
+                times = num_requests
+                if get_many is legacy_get_many:
+                    times = max(5, min(num_requests, num_requests * 1000 // size))
+                if name == 'weighted':
+                    # 第一次请求建立 alias 表
+                    time_start = time.time()
+                    proxypool.get_many(num=num, maxscore=maxscore, select='weighted')
+                    time_build = time.time() - time_start
+                for _ in range(times):
+                    with timer:
+                        if name == 'weighted':
+                            proxypool.get_many(num=num, maxscore=maxscore, select='weighted')
+                        elif get_many is None:
+                            proxypool.get_many(num=num, maxscore=maxscore)
+                        else:
+                            get_many(proxypool, db, num, 0, maxscore)
+                report = timer.report(name)
+                report['size'] = size
+                if name == 'weighted':
+                    report['build_ms'] = time_build * 1000
+                results.append(report)
+    finally:
+        os.remove(configfile)
+        stub.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=200)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--sizes', default='1000,100000,1000000')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print(json.dumps(bench(args.requests, args.num, sizes), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较 /proxylist 在每个请求新建 ProxyPool、共享 ProxyPool 和使用响应缓存时的吞吐.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_handler
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import http.client
+
+import redis
+
+import tornado.web
+
+from proxypool import ProxyPool
+from listcache import ProxyListCache
+from benchmarks.common import make_configfile, serve_in_thread, Timer
+from benchmarks.stubredis import StubRedis
+
+
+def seed(rdb, configs, num_proxies):
+    for target, val in configs['TARGET'].items():
+        for i in range(num_proxies):
+            proxy = 'http://10.%d.%d.%d:8080' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+            rdb.execute_command('ZADD', val['DB_PROXY'], (i % 200) / 10.0, proxy)
+        rdb.set(val['DB_MTIME'], int(time.time()))
+
+
+class RedisProxyListHandler(tornado.web.RequestHandler):
+    # 还原不使用缓存时的行为: 每个请求都访问 redis 并调用 json.dumps
+    def initialize(self, proxypool):
+        self.proxypool = proxypool
+
+    def post(self):
+        target = self.get_argument('target', default='') or 'all'
+        num    = int(self.get_argument('num', default='') or 5)
+        delay  = int(self.get_argument('delay', default='') or 10)
+
+        proxypool = self.proxypool
+        proxypool.refresh()
+        proxies = proxypool.get_many(target=target, num=num, maxscore=delay)
+        ret = {
+            'status': 'success',
+            'proxylist': {
+                'num': len(proxies),
+                'mtime': proxypool.get_mtime(target=target),
+                'target': target,
+                'proxies': [proxy.decode('utf-8') for proxy in proxies],
+            },
+        }
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(ret))
+
+
+def make_app(configfile, mode):
+    from handlers.handler_template import ProxyListHandler
+
+    if mode == 'cached':
+        proxypool = ProxyPool(configfile)
+        listcache = ProxyListCache(proxypool)
+        return tornado.web.Application([
+            (r'/proxylist', ProxyListHandler, dict(proxypool=proxypool, listcache=listcache)),
+        ])
+
+    if mode == 'shared':
+        return tornado.web.Application([
+            (r'/proxylist', RedisProxyListHandler, dict(proxypool=ProxyPool(configfile))),
+        ])
+
+    class UncachedProxyListHandler(RedisProxyListHandler):
+        # 还原最初的行为: 每个请求都解析配置文件、新建 redis 连接池
+        def initialize(self):
+            proxypool     = ProxyPool(configfile)
+            store         = proxypool.configs['STORE']
+            proxypool.rdb = redis.StrictRedis(host=store['HOST'], port=store['PORT'],
+                                              db=store['RDB'])
+            self.proxypool = proxypool
+
+    return tornado.web.Application([
+        (r'/proxylist', UncachedProxyListHandler),
+    ])
+
+
+def run(app, num_requests):
+    port, stop = serve_in_thread(app)
+    conn  = http.client.HTTPConnection('127.0.0.1', port)
+    timer = Timer()
+    body  = 'target=58&num=10&delay=10'
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    time_start = time.time()
+    try:
+        for _ in range(num_requests):
+            with timer:
+                conn.request('POST', '/proxylist', body, headers)
+                res = conn.getresponse()
+                res.read()
+    finally:
+        elapsed = time.time() - time_start
+        conn.close()
+        stop()
+
+    return timer, elapsed
+
+
+def bench(num_requests=2000, num_proxies=1000,
+          modes=('per-request', 'shared', 'cached')):
+    """Return the reports of /proxylist in each mode of 'modes'"""
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    stub       = StubRedis().start()
+    configfile = make_configfile(stub.port)
+    try:
+        proxypool = ProxyPool(configfile)
+        seed(proxypool.rdb, proxypool.configs, num_proxies)
+
+        results = []
+        for mode in modes:
+            timer, elapsed = run(make_app(configfile, mode), num_requests)
+            results.append(timer.report(mode, elapsed))
+    finally:
+        os.remove(configfile)
+        stub.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-p', '--proxies', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(json.dumps(bench(args.requests, args.proxies), indent=2))
+
+
+if __name__ == '__main__':
+    main()
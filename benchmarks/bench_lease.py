@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""测量借出 (checkout) 和归还 (release) 代理的耗时，包括 Lua 脚本的执行和一次 redis 往返.
+
+stubredis 不支持 Lua 脚本，这个 benchmark 使用真实的 redis-server ($REDIS_SERVER 或 PATH 中的
+redis-server)，没有时返回空的结果. 每个 LEASE.SCAN 分别测:
+
+  + idle: 没有被借出的代理，借出 --num 个后立即归还
+  + leased: 分数最低的 SCAN 个代理都已被其他客户端借出 (最坏情况)，每次借出都要检查完 SCAN 个
+    候选后返回空列表; 脚本执行期间 redis 不处理其他客户端的命令
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_lease
+"""
+
+import os
+import json
+import logging
+import argparse
+
+from proxypool import ProxyPool
+from benchmarks.common import make_configfile, RedisServer, Timer
+
+
+def _seed(proxypool, db, num_proxies):
+    pipe = proxypool.rdb.pipeline(transaction=False)
+    pipe.delete(db, '%s:%s' % (db, proxypool.leases.suffix),
+                '%s:%s:owner' % (db, proxypool.leases.suffix))
+    for i in range(num_proxies):
+        pipe.zadd(db, 1 + i * 0.001, 'http://10.%d.%d.%d:80' % (i >> 16 & 255, i >> 8 & 255,
+                                                               i & 255))
+    pipe.execute()
+
+
+def run(proxypool, num_requests, num, scan):
+    """Return the reports of idle and worst case checkouts with LEASE.SCAN 'scan'"""
+    maxscore = proxypool.init_value
+    results  = []
+
+    checkout, release = Timer(), Timer()
+    for _ in range(num_requests):
+        with checkout:
+            token, expires, proxies = proxypool.leases.checkout('ALL', num, 0, maxscore)
+        with release:
+            proxypool.leases.release('ALL', token, proxies)
+    for name, timer in (('idle-checkout', checkout), ('idle-release', release)):
+        report = timer.report(name)
+        report['scan'] = scan
+        results.append(report)
+
+    # 其他客户端借出分数最低的 scan 个代理，之后的借出都检查完 scan 个候选
+    proxypool.leases.checkout('ALL', scan, 0, maxscore, ttl=proxypool.leases.max_ttl)
+    timer = Timer()
+    for _ in range(num_requests):
+        with timer:
+            proxypool.leases.checkout('ALL', num, 0, maxscore)
+    report = timer.report('leased-checkout')
+    report['scan'] = scan
+    results.append(report)
+
+    return results
+
+
+def bench(num_requests=500, num=10, num_proxies=10000, scans=(100, 200, 1000)):
+    """Return the reports of checkout and release for each LEASE.SCAN in 'scans'"""
+    logging.getLogger().setLevel(logging.ERROR)
+
+    server = RedisServer().start()
+    if server is None:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.warning('No redis-server found, set REDIS_SERVER to run bench_lease')
+        return []
+
+    results = []
+    try:
+        for scan in scans:
+            configfile = make_configfile(server.port, LEASE={'SCAN': scan})
+            try:
+                proxypool = ProxyPool(configfile)
+                _seed(proxypool, proxypool.configs['TARGET']['ALL']['DB_PROXY'], num_proxies)
+                results.extend(run(proxypool, num_requests, num, proxypool.leases.scan))
+            finally:
+                os.remove(configfile)
+    finally:
+        server.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=500)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--scans', default='100,200,1000')
+    args = parser.parse_args()
+
+    scans = [int(scan) for scan in args.scans.split(',')]
+    print(json.dumps(bench(args.requests, args.num, scans=scans), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较每次解释 rules 解析页面与使用编译后的 XPath 解析页面的速度.
+
+页面默认按 settings.yaml 中 PROXY_SITES 各站点的结构生成，也可以通过 --fixtures
+指定保存的页面所在目录，文件名是 urllib.parse.quote(url, safe='') + '.html'.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_parse
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+from urllib.parse import quote
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+from lxml import etree
+
+import siteparser
+from benchmarks.common import ROOT
+
+
+def _ip(i):
+    return '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+
+
+def make_page(url, rows):
+    # 按各站点的结构生成页面
+    if 'site-digger' in url:
+        trs = ''.join('<tr><td>%s:8080</td><td>CN</td></tr>' % (_ip(i),) for i in range(rows))
+        body = "<table id='proxies_table'><tbody>%s</tbody></table>" % (trs,)
+    elif 'pachong' in url:
+        trs = ''.join("<tr data-type='%s'><td>%d</td><td>%s</td><td>80</td></tr>"
+                      % (('anonymous', 'high', 'transparent')[i % 3], i, _ip(i))
+                      for i in range(rows))
+        body = '<table>%s</table>' % (trs,)
+    elif 'proxy.com.ru' in url:
+        trs = ''.join('<tr><td>%d</td><td>%s</td><td>3128</td></tr>' % (i, _ip(i))
+                      for i in range(rows))
+        body = ("<table bordercolor='#CCCCCC'><tr><th>no</th></tr>%s</table>"
+                "<table bordercolor='#CCCCCC'><tr><td>footer</td></tr></table>" % (trs,))
+    elif 'proxy360' in url:
+        body = ''.join("<div name='list_proxy_ip'><div><span>%s</span><span>80</span>"
+                       "<span>%s</span></div></div>" % (_ip(i), ('高匿', '透明')[i % 2])
+                       for i in range(rows))
+    elif 'cn-proxy' in url:
+        trs = ''.join('<tr><td>%s</td><td>8080</td><td>%s</td></tr>'
+                      % (_ip(i), ('高度匿名', '透明')[i % 2]) for i in range(rows))
+        body = '<table><tbody>%s</tbody></table>' % (trs,)
+    else:
+        body = ''
+
+    return ('<html><head><title>%s</title></head><body>%s</body></html>'
+            % (url, body))
+
+
+def legacy_parse(rules, text):
+    # 之前的实现: 每次解析都重新解释 rules
+    html      = etree.HTML(text)
+    proxies   = []
+    len_rules = len(rules)
+
+    nodes = html.xpath(rules[0])
+    if nodes:
+        if len_rules == 1:
+            for node in nodes:
+                text = node.text.strip()
+                if text:
+                    proxies.append('http://%s' % (text,))
+        elif len_rules == 2:
+            rule_1     = rules[1].split(',')
+            rule_1_len = len(rule_1)
+
+            if rule_1_len == 3:
+                for node in nodes:
+                    node = node.xpath(rule_1[0])
+                    ip   = node[1].text.strip()
+                    port = node[2].text.strip() or '80'
+                    if ip:
+                        proxies.append('http://%s:%s' % (ip, port))
+            elif rule_1_len == 4:
+                for node in nodes:
+                    ip     = node.xpath(rule_1[0])[0].text.strip()
+                    port   = node.xpath(rule_1[1])[0].text.strip()
+                    niming = node.xpath(rule_1[2])[0].text.strip()
+                    if ip and niming == siteparser.ANONYMOUS_TEXT.get(rule_1[-1]):
+                        proxies.append('http://%s:%s' % (ip, port))
+
+    return proxies
+
+
+def load_pages(sites, fixtures, rows):
+    pages = {}
+    for url in sites:
+        path = os.path.join(fixtures or '', quote(url, safe='') + '.html')
+        if fixtures and os.path.exists(path):
+            with open(path, encoding='utf-8') as fp:
+                pages[url] = fp.read()
+        else:
+            pages[url] = make_page(url, rows)
+    return pages
+
+
+def bench(rounds=50, rows=200, workers=2, fixtures=None):
+    """Return the parsing speed of each implementation"""
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    with open(os.path.join(ROOT, 'settings.yaml'), 'rb') as fp:
+        sites = yaml.safe_load(fp)['PROXY_SITES']
+    pages = load_pages(sites, fixtures, rows)
+    jobs  = [(url, sites[url]['rules'], pages[url]) for url in sites] * rounds
+
+    results = []
+
+    time_start = time.time()
+    num = sum(len(legacy_parse(rules, text)) for url, rules, text in jobs)
+    elapsed = time.time() - time_start
+    results.append({'name': 'legacy', 'pages_per_sec': len(jobs) / elapsed, 'proxies': num})
+
+    time_start = time.time()
+    num = sum(len(siteparser.parse_page(*job)[1]) for job in jobs)
+    elapsed = time.time() - time_start
+    results.append({'name': 'compiled', 'pages_per_sec': len(jobs) / elapsed, 'proxies': num})
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        time_start = time.time()
+        futures = [executor.submit(siteparser.parse_page, *job) for job in jobs]
+        num = sum(len(future.result()[1]) for future in futures)
+        elapsed = time.time() - time_start
+    results.append({'name': 'compiled-process-pool-%d' % (workers,),
+                    'pages_per_sec': len(jobs) / elapsed, 'proxies': num})
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--rounds', type=int, default=50)
+    parser.add_argument('-r', '--rows', type=int, default=200)
+    parser.add_argument('-w', '--workers', type=int, default=2)
+    parser.add_argument('--fixtures', default=None)
+    args = parser.parse_args()
+
+    results = bench(args.rounds, args.rows, args.workers, args.fixtures)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
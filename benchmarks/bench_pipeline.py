@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较依次运行三个阶段 (batch) 与流水线 (pipeline) 得到第一个可用代理的耗时.
+
+代理列表站点由本地的假站点提供，其中一个站点每次请求都要等待 slow 秒; 页面中的代理是
+fakenet 中的假代理，它们同时扮演 reflect 站点和目标站点.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_pipeline
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+
+from proxypool import ProxyPool
+from pipeline import Pipeline
+from benchmarks.common import make_configfile, serve_in_thread
+from benchmarks.fakenet import FakeProxyFarm, make_site_app, site_path
+from benchmarks.stubredis import StubRedis
+
+
+# 与 settings.yaml 中 site-digger 的结构相同
+RULES = ["//table[@id='proxies_table']/tbody/tr/td[1]"]
+
+
+def make_page(proxies):
+    trs = ''.join('<tr><td>127.0.0.1:%d</td><td>CN</td></tr>' % (proxy.port,)
+                  for proxy in proxies)
+    return ("<html><head><title>proxies</title></head><body><table id='proxies_table'>"
+            "<tbody>%s</tbody></table></body></html>" % (trs,))
+
+
+def make_sites(farm, num_sites, fast_port, slow_port):
+    # 假代理平均分到 num_sites 个站点，最后一个站点由慢的 server 提供
+    # 返回 (PROXY_SITES 配置, 快站点的页面, 慢站点的页面)
+    sites, fast, slow = {}, {}, {}
+    for i in range(num_sites):
+        key   = 'site-%d' % (i,)
+        port  = slow_port if i == num_sites - 1 else fast_port
+        pages = slow if i == num_sites - 1 else fast
+        url   = 'http://127.0.0.1:%d%s' % (port, site_path(key))
+        pages[key] = make_page(farm.proxies[i::num_sites])
+        sites[url] = {'rules': RULES, 'proxies': {'http': '', 'https': ''}}
+
+    return sites, fast, slow
+
+
+def run(configfile, sites, mode):
+    proxypool = ProxyPool(configfile)
+    proxypool.configs['PROXY_SITES'] = sites
+    for key in (proxypool.sproxy_all, proxypool.sproxy_anon, proxypool.hproxy_anony):
+        proxypool.rdb.delete(key)
+
+    # 记录第一个可用代理交给 writer 的时间
+    first      = []
+    time_start = time.time()
+    save       = proxypool._save_timings
+
+    def save_timings(proxy, timings):
+        if not first and any(timing.ok for timing in timings.values()):
+            first.append(time.time() - time_start)
+        save(proxy, timings)
+    proxypool._save_timings = save_timings
+
+    if mode == 'pipeline':
+        Pipeline(proxypool).run()
+    else:
+        proxypool.fetch_proxies()
+        proxypool.filter_anony()
+        proxypool.valid_active()
+    elapsed = time.time() - time_start
+
+    return {
+        'mode': mode,
+        'proxies': proxypool.rdb.scard(proxypool.sproxy_all),
+        'anonymous': proxypool.rdb.scard(proxypool.sproxy_anon),
+        'first_usable_ms': first[0] * 1000 if first else None,
+        'round_ms': elapsed * 1000,
+    }
+
+
+def bench(num_proxies=300, num_sites=5, slow=3, modes=('batch', 'pipeline')):
+    """Return the time to the first usable proxy and of the whole round in each mode"""
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    farm = FakeProxyFarm(num=num_proxies).start()
+    stub = StubRedis().start()
+    fast_pages, slow_pages = {}, {}
+    fast_port, stop_fast = serve_in_thread(make_site_app(fast_pages))
+    slow_port, stop_slow = serve_in_thread(make_site_app(slow_pages, delay=slow))
+    sites, fast, slow = make_sites(farm, num_sites, fast_port, slow_port)
+    fast_pages.update(fast)
+    slow_pages.update(slow)
+
+    # 假代理直接扮演目标站点和 reflect 站点，本机 ip 直接向一个假代理请求 /ip 得到
+    targets = {}
+    for i, target in enumerate(('ALL', '58', 'GANJI')):
+        targets[target] = {'URL': 'http://target-%d.test/' % (i,), 'VALIDATE': 'fake',
+                           'RATE': 0}
+    configfile = make_configfile(stub.port, TARGET=targets,
+                                 URL={'REFLECT': 'http://reflect.test/ip',
+                                      'LOCAL_IP': farm.proxies[0].url + '/ip'},
+                                 LOCAL_IP={'TRY': 10},
+                                 CONCURRENT={'MODE': 'thread'},
+                                 ADAPTIVE={'TARGET_RATE': 0})
+    try:
+        results = [run(configfile, sites, mode) for mode in modes]
+    finally:
+        os.remove(configfile)
+        stop_fast()
+        stop_slow()
+        stub.stop()
+        farm.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-p', '--proxies', type=int, default=300)
+    parser.add_argument('-s', '--sites', type=int, default=5)
+    parser.add_argument('--slow', type=float, default=3, help='慢站点每次请求等待的秒数')
+    args = parser.parse_args()
+
+    print(json.dumps(bench(args.proxies, args.sites, args.slow), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较 server.py 在不同 worker 数下 /proxylist 的总吞吐.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_server -w 1 4
+
+客户端是多个进程，每个进程一个 keep-alive 连接; 在多核的机器上运行才能看出差别.
+"""
+
+import os
+import json
+import time
+import signal
+import socket
+import logging
+import argparse
+import http.client
+import multiprocessing
+
+from proxypool import ProxyPool
+from benchmarks.common import make_configfile, Timer
+from benchmarks.stubredis import StubRedis
+from benchmarks.bench_handler import seed
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_ready(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('Server on port %d is not ready' % (port,))
+
+
+def _client(args):
+    port, num_requests = args
+    conn    = http.client.HTTPConnection('127.0.0.1', port)
+    timer   = Timer()
+    body    = 'target=58&num=10&delay=10'
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    for _ in range(num_requests):
+        with timer:
+            conn.request('POST', '/proxylist', body, headers)
+            conn.getresponse().read()
+    conn.close()
+    return timer.samples
+
+
+def run(configfile, port, num_workers, num_clients, num_requests):
+    pid = os.fork()
+    if pid == 0:
+        from server import Master
+        logging.getLogger().setLevel(logging.WARNING)
+        try:
+            Master(configfile).run()
+        finally:
+            os._exit(0)
+
+    try:
+        _wait_ready(port)
+        pool = multiprocessing.Pool(num_clients)
+        time_start = time.time()
+        results = pool.map(_client, [(port, num_requests)] * num_clients)
+        elapsed = time.time() - time_start
+        pool.close()
+        pool.join()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    timer = Timer()
+    for samples in results:
+        timer.samples.extend(samples)
+    return timer.report('workers=%d' % (num_workers,), elapsed)
+
+
+def bench(workers=(1, 2), num_clients=8, num_requests=500, num_proxies=1000):
+    """Return the reports of /proxylist served by server.py with each worker count"""
+    stub    = StubRedis().start()
+    results = []
+    try:
+        for num_workers in workers:
+            port       = _free_port()
+            configfile = make_configfile(stub.port, SERVER={'PORT': port, 'ADDRESS': '127.0.0.1',
+                                                            'WORKERS': num_workers, 'GRACE': 0},
+                                         CACHE={'CHANNEL': ''})
+            try:
+                proxypool = ProxyPool(configfile)
+                seed(proxypool.rdb, proxypool.configs, num_proxies)
+                results.append(run(configfile, port, num_workers, num_clients, num_requests))
+            finally:
+                os.remove(configfile)
+    finally:
+        stub.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        default=[1, multiprocessing.cpu_count()])
+    parser.add_argument('-c', '--clients', type=int, default=8)
+    parser.add_argument('-n', '--requests', type=int, default=500,
+                        help='每个客户端的请求数')
+    parser.add_argument('-p', '--proxies', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = bench(args.workers, args.clients, args.requests, args.proxies)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较 redis 后端和嵌入式 SQLite 后端上 get_many 的耗时.
+
+redis 后端连接 stubredis (本机 TCP)，SQLite 后端使用临时文件; 每种后端分别测随机抽样
+(random) 和加权抽样 (weighted)，SQLite 后端另外测按排名抽样 (rank-sample，redis 后端上
+random 的实现)，说明 SQLite 上为什么改为缓存候选代理.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_storage
+"""
+
+import os
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+
+from proxypool import ProxyPool
+from benchmarks.common import make_configfile, Timer
+from benchmarks.stubredis import StubRedis
+from benchmarks.bench_get_many import make_zset
+
+
+def _fill(proxypool, backend, stub, db, zset):
+    # redis 后端直接替换 stubredis 中的 sorted set，SQLite 后端在一个事务中写入
+    if backend == 'redis':
+        stub.store.data[db.encode('utf-8')] = zset
+        return
+    proxypool.rdb.delete(db)
+    args = []
+    for score, member in zset.sorted():
+        args.extend((score, member))
+    proxypool.rdb.zadd(db, *args)
+
+
+def bench(num_requests=200, num=10, sizes=(1000, 100000)):
+    """Return the reports of get_many on both backends with sorted sets of 'sizes'"""
+    logging.getLogger().setLevel(logging.ERROR)
+
+    stub    = StubRedis().start()
+    tempdir = tempfile.mkdtemp()
+    configfiles = {
+        'redis': make_configfile(stub.port),
+        'sqlite': make_configfile(stub.port, STORE={
+            'BACKEND': 'sqlite', 'PATH': os.path.join(tempdir, 'proxypool.db')}),
+    }
+    try:
+        results = []
+        for size in sizes:
+            zset = make_zset(size)
+            for backend in ('redis', 'sqlite'):
+                proxypool = ProxyPool(configfiles[backend])
+                db        = proxypool.configs['TARGET']['ALL']['DB_PROXY']
+                db_mtime  = proxypool.configs['TARGET']['ALL']['DB_MTIME']
+                maxscore  = proxypool.init_value
+                _fill(proxypool, backend, stub, db, zset)
+                proxypool.rdb.set(db_mtime, size)
+
+                selects = ['random', 'weighted']
+                if backend == 'sqlite':
+                    selects.append('rank-sample')
+                for select in selects:
+                    timer = Timer()
+                    # 第一次请求建立缓存，不计入
+                    if select != 'rank-sample':
+                        proxypool.get_many(num=num, maxscore=maxscore, select=select)
+                    # 按排名抽样在大的 SQLite 表上很慢，减少请求次数
+                    times = num_requests
+                    if select == 'rank-sample':
+                        times = max(5, min(num_requests, num_requests * 1000 // size))
+                    for _ in range(times):
+                        with timer:
+                            if select == 'rank-sample':
+                                proxypool._sample(db, num, 0, maxscore)
+                            else:
+                                proxypool.get_many(num=num, maxscore=maxscore, select=select)
+                    report = timer.report('%s-%s' % (backend, select))
+                    report['size'] = size
+                    results.append(report)
+    finally:
+        for configfile in configfiles.values():
+            os.remove(configfile)
+        shutil.rmtree(tempdir)
+        stub.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=200)
+    parser.add_argument('--num', type=int, default=10)
+    parser.add_argument('--sizes', default='1000,100000')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print(json.dumps(bench(args.requests, args.num, sizes), indent=2))
+
+
+if __name__ == '__main__':
+    main()
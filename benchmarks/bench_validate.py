@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较 thread 与 asyncio 两种方式下匿名检测和可用性检测的吞吐.
+
+每种方式分别在固定并发数和开启 ADAPTIVE (见 limiter.py) 时各运行一次，开启时 mode 带有
+'+adaptive' 后缀，并记录各阶段和各 target 最终的并发数; 对每个 target 的请求速率由 --rate
+限制，默认不限制.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_validate
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+
+from proxypool import ProxyPool
+from benchmarks.common import make_configfile
+from benchmarks.fakenet import FakeProxyFarm
+from benchmarks.stubredis import StubRedis
+
+
+def run(configfile, mode, farm):
+    proxypool = ProxyPool(configfile)
+    proxypool.ip_local = '127.0.0.1'
+    proxypool.rdb.delete(proxypool.sproxy_anon)
+    proxies = [proxy.url.encode('utf-8') for proxy in farm.proxies]
+
+    time_start = time.time()
+    proxypool._filter_anony(proxies)
+    time_filter = time.time() - time_start
+
+    num_anon = len(proxypool.rdb.smembers(proxypool.sproxy_anon))
+
+    time_start = time.time()
+    proxypool.valid_active()
+    time_valid = time.time() - time_start
+
+    result = {
+        'mode': mode,
+        'proxies': len(proxies),
+        'anonymous': num_anon,
+        'filter_per_sec': len(proxies) / time_filter,
+        'valid_per_sec': num_anon * len(proxypool.targets) / time_valid,
+    }
+    for stage, lim in proxypool.stage_limiters.items():
+        result['limit_%s' % (stage,)] = int(lim.policy.limit)
+    for target, lim in proxypool.target_limiters.items():
+        result['limit_%s' % (target,)] = int(lim.policy.limit)
+
+    return result
+
+
+def bench(num_proxies=300, modes=('thread', 'asyncio'), latency=(0.01, 0.2), failure=0.1,
+          rate=0):
+    """
+    Return the throughput of filter_anony and valid_active in each mode of
+    'modes', requests to each target are limited to 'rate' per second.
+    """
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    farm  = FakeProxyFarm(num=num_proxies, latency=latency, failure=failure).start()
+    stub  = StubRedis().start()
+    # 假代理直接扮演目标站点，url 不需要能解析
+    targets = {}
+    for i, target in enumerate(('ALL', '58', 'GANJI')):
+        targets[target] = {'URL': 'http://target-%d.test/' % (i,), 'VALIDATE': 'fake',
+                           'RATE': rate}
+    try:
+        results = []
+        for mode in modes:
+            for adaptive in (False, True):
+                configfile = make_configfile(stub.port, TARGET=targets,
+                                             URL={'REFLECT': 'http://reflect.test/ip'},
+                                             CONCURRENT={'MODE': mode},
+                                             ADAPTIVE={'ENABLED': adaptive, 'TARGET_RATE': rate})
+                try:
+                    results.append(run(configfile, mode + ('+adaptive' if adaptive else ''),
+                                       farm))
+                finally:
+                    os.remove(configfile)
+    finally:
+        stub.stop()
+        farm.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-p', '--proxies', type=int, default=300)
+    parser.add_argument('--modes', default='thread,asyncio')
+    parser.add_argument('--failure', type=float, default=0.1, help='假代理的失败率')
+    parser.add_argument('--rate', type=float, default=0, help='对每个 target 每秒最多的请求数')
+    args = parser.parse_args()
+
+    results = bench(args.proxies, args.modes.split(','), failure=args.failure, rate=args.rate)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""比较客户端轮询 /proxylist 和长轮询 /proxylist/watch 时的 handler 请求数、redis 命令数，
+以及 mtime 变化后客户端得知的延迟.
+
+另一个 ProxyPool 每隔 --update 秒通过 BatchWriter 写入新的 mtime，与检测时一样在
+CACHE.CHANNEL 上发布; 每个客户端一个线程:
+
+  + poll: 每隔 --interval 秒请求一次 /proxylist，比较其中的 mtime
+  + watch: 请求 /proxylist/watch，返回后立即带上新的 mtime 再次请求
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.bench_watch
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import http.client
+
+from proxypool import ProxyPool
+from benchmarks.common import make_configfile, serve_in_thread, percentile
+from benchmarks.stubredis import StubRedis
+from benchmarks.bench_handler import seed
+
+
+HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def _client(port, mode, interval, timeout, deadline, published, seen):
+    # 记录每次得知新 mtime 的延迟，返回请求数
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    last = 0
+    num  = 0
+    try:
+        while time.time() < deadline:
+            if mode == 'watch':
+                conn.request('GET', '/proxylist/watch?target=58&timeout=%s&mtime=%d'
+                             % (timeout, last))
+                mtime = json.loads(conn.getresponse().read().decode('utf-8'))['mtime']
+            else:
+                conn.request('POST', '/proxylist', 'target=58&num=5', HEADERS)
+                body  = json.loads(conn.getresponse().read().decode('utf-8'))
+                mtime = body['proxylist']['mtime']
+            num += 1
+            now  = time.time()
+            if last and mtime > last and mtime in published:
+                seen.append(now - published[mtime])
+            last = mtime
+            if mode == 'poll':
+                time.sleep(max(0, interval - (time.time() - now)))
+    finally:
+        conn.close()
+    return num
+
+
+def run(port, stub, updater, mode, num_clients, duration, interval, update):
+    db_mtime  = updater.configs['TARGET']['58']['DB_MTIME']
+    published = {}
+    seen      = []
+    counts    = []
+    deadline  = time.time() + duration
+
+    def client():
+        # 长轮询最多等待两次更新的间隔，结束时客户端不会等待太久
+        counts.append(_client(port, mode, interval, update * 2, deadline, published, seen))
+
+    threads = [threading.Thread(target=client) for _ in range(num_clients)]
+    for thread in threads:
+        thread.start()
+
+    commands   = stub.store.num_commands
+    time_start = time.time()
+    mtime      = int(updater.rdb.get(db_mtime))
+    while time.time() < deadline - update * 2:
+        time.sleep(update)
+        mtime += 1
+        published[mtime] = time.time()
+        updater.writer.add('set', db_mtime, mtime)
+        updater.writer.flush()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - time_start
+
+    return {
+        'mode': mode,
+        'clients': num_clients,
+        'requests_per_sec': sum(counts) / elapsed,
+        'redis_per_sec': (stub.store.num_commands - commands) / elapsed,
+        # 客户端得知的 mtime 变化占全部变化的比例，poll 时两次请求之间的变化只能得知最后一个，
+        # 缓存每隔 CACHE.CHECK_INTERVAL 秒才检查 mtime
+        'notified': len(seen) / float(max(1, len(published) * num_clients)),
+        'notify_p50_ms': percentile(seen, 50) * 1000,
+        'notify_p99_ms': percentile(seen, 99) * 1000,
+    }
+
+
+def bench(num_clients=20, duration=10, interval=1, update=2, modes=('poll', 'watch')):
+    """Return the reports of polling and long-polling clients"""
+    from handlers.handler_template import make_app
+
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    stub       = StubRedis().start()
+    configfile = make_configfile(stub.port)
+    try:
+        updater = ProxyPool(configfile)
+        seed(updater.rdb, updater.configs, 1000)
+
+        port, stop = serve_in_thread(make_app(ProxyPool(configfile)))
+        try:
+            # 等待 handler 订阅频道
+            time.sleep(0.5)
+            results = [run(port, stub, updater, mode, num_clients, duration, interval, update)
+                       for mode in modes]
+        finally:
+            stop()
+    finally:
+        os.remove(configfile)
+        stub.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--clients', type=int, default=20)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=1, help='poll 的请求间隔秒数')
+    parser.add_argument('--update', type=float, default=2, help='写入新 mtime 的间隔秒数')
+    args = parser.parse_args()
+
+    print(json.dumps(bench(args.clients, args.duration, args.interval, args.update), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""benchmark 共用的工具函数."""
+
+import os
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import yaml
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_configfile(port, **overrides):
+    """
+    Write a copy of settings.yaml whose redis points to the stub redis
+    listening on 'port', return the path of the new file.
+    'overrides' are merged recursively into the top-level sections.
+    """
+    with open(os.path.join(ROOT, 'settings.yaml'), 'rb') as fp:
+        configs = yaml.safe_load(fp)
+
+    configs['STORE']['HOST'] = '127.0.0.1'
+    configs['STORE']['PORT'] = port
+    _merge(configs, overrides)
+
+    fd, path = tempfile.mkstemp(suffix='.yaml')
+    with os.fdopen(fd, 'w') as fp:
+        yaml.dump(configs, fp, allow_unicode=True)
+
+    return path
+
+
+def _merge(configs, overrides):
+    for key, val in overrides.items():
+        if isinstance(val, dict) and isinstance(configs.get(key), dict):
+            _merge(configs[key], val)
+        else:
+            configs[key] = val
+
+
+class RedisServer(object):
+    """
+    A throwaway redis-server on a random local port, for what stubredis
+    can't do (Lua scripts). The binary is $REDIS_SERVER or redis-server
+    on PATH; start() returns None if neither exists.
+    """
+    def __init__(self, binary=None):
+        self.binary  = binary or os.environ.get('REDIS_SERVER') or shutil.which('redis-server')
+        self.port    = None
+        self.process = None
+
+    def start(self, timeout=5):
+        if not self.binary:
+            return None
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            [self.binary, '--port', str(self.port), '--bind', '127.0.0.1', '--save', '',
+             '--appendonly', 'no'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError('redis-server did not start on port %d' % (self.port,))
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+
+def percentile(samples, pct):
+    """Return the 'pct' percentile of 'samples'"""
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    index   = min(len(samples) - 1, int(len(samples) * pct / 100.0))
+    return samples[index]
+
+
+def serve_in_thread(app):
+    """
+    Start a tornado HTTP server for 'app' on a random local port in a
+    background thread, return (port, stop).
+    """
+    import tornado.httpserver
+    import tornado.ioloop
+    import tornado.netutil
+
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    port    = sockets[0].getsockname()[1]
+    started = threading.Event()
+    holder  = {}
+
+    def run():
+        try:
+            import asyncio
+            asyncio.set_event_loop(asyncio.new_event_loop())
+        except ImportError:
+            pass
+        io_loop = tornado.ioloop.IOLoop.current()
+        server  = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
+        holder['io_loop'] = io_loop
+        holder['server']  = server
+        io_loop.add_callback(started.set)
+        io_loop.start()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    started.wait()
+
+    def stop():
+        io_loop = holder['io_loop']
+        io_loop.add_callback(holder['server'].stop)
+        io_loop.add_callback(io_loop.stop)
+        thread.join()
+
+    return port, stop
+
+
+class Timer(object):
+    """记录一组操作的耗时"""
+    def __init__(self):
+        self.samples = []
+
+    def __enter__(self):
+        self.time_start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.samples.append(time.time() - self.time_start)
+
+    def report(self, name, elapsed=None):
+        elapsed = elapsed or sum(self.samples)
+        num     = len(self.samples)
+        return {
+            'name': name,
+            'num': num,
+            'per_sec': num / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(self.samples, 50) * 1000,
+            'p99_ms': percentile(self.samples, 99) * 1000,
+        }
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""本地的假代理，只用于 benchmark.
+
+NOTE:
+  + 每个假代理监听 127.0.0.1 上的一个端口，收到请求后不再转发，直接扮演目标站点返回响应
+  + 请求路径以 /ip 或 /reflect 结尾时扮演 reflect 站点，返回 {"origin": "...", "headers": {...}}
+  + 每个代理有各自的延迟、失败率和是否匿名，由 random.Random(seed) 生成，可重复
+  + make_site_app() 返回扮演代理列表站点的 tornado application，路径是 quote(原 url)
+"""
+
+import json
+import random
+import asyncio
+import threading
+from urllib.parse import quote, unquote
+
+
+class FakeProxy(object):
+    """一个假代理的行为"""
+    def __init__(self, port, latency, failure, anonymous):
+        self.port      = port
+        self.latency   = latency
+        self.failure   = failure
+        self.anonymous = anonymous
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % (self.port,)
+
+
+class FakeProxyFarm(object):
+    """在后台线程的事件循环中运行的一组假代理"""
+    def __init__(self, num=100, latency=(0.01, 0.2), failure=0.1, anonymous=0.8,
+                 page=b'<html><head><title>fake</title></head><body></body></html>',
+                 seed=0):
+        self.num       = num
+        self.latency   = latency
+        self.failure   = failure
+        self.anonymous = anonymous
+        self.page      = page
+        self.random    = random.Random(seed)
+        self.proxies   = []
+        self.requests  = 0
+        self.servers   = []
+        self.writers   = set()
+
+    def _make_handler(self, proxy):
+        async def handle(reader, writer):
+            self.writers.add(writer)
+            try:
+                while True:
+                    request_line = await reader.readline()
+                    if not request_line:
+                        break
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self.requests += 1
+                    await asyncio.sleep(proxy.latency)
+                    if self.random.random() < proxy.failure:
+                        break
+
+                    path = request_line.split()[1]
+                    if path.endswith((b'/ip', b'/reflect')):
+                        origin  = '10.0.%d.%d' % (proxy.port >> 8 & 255, proxy.port & 255)
+                        headers = {'Via': '1.1 fake'}
+                        if not proxy.anonymous:
+                            origin = '127.0.0.1, ' + origin
+                            headers['X-Forwarded-For'] = '127.0.0.1'
+                        body = json.dumps({'origin': origin, 'headers': headers}).encode('utf-8')
+                    else:
+                        body = self.page
+
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+                                 b'Content-Length: ' + str(len(body)).encode('utf-8')
+                                 + b'\r\n\r\n' + body)
+                    await writer.drain()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                self.writers.discard(writer)
+                try:
+                    writer.close()
+                except RuntimeError:
+                    # 事件循环已停止
+                    pass
+
+        return handle
+
+    def start(self):
+        started = threading.Event()
+
+        async def listen():
+            for _ in range(self.num):
+                proxy  = FakeProxy(0, self.random.uniform(*self.latency), self.failure,
+                                   self.random.random() < self.anonymous)
+                server = await asyncio.start_server(self._make_handler(proxy),
+                                                    '127.0.0.1', 0, backlog=1024)
+                proxy.port = server.sockets[0].getsockname()[1]
+                self.servers.append(server)
+                self.proxies.append(proxy)
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(listen())
+            self.loop.call_soon(started.set)
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+
+        return self
+
+    def stop(self):
+        async def close():
+            # 关闭所有连接并等待处理连接的 task 结束，避免事件循环停止后留下未完成的 task
+            for server in self.servers:
+                server.close()
+            for writer in list(self.writers):
+                writer.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            if tasks:
+                await asyncio.wait(tasks, timeout=self.latency[1] + 1)
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def site_path(url):
+    """Return the path of 'url' served by make_site_app()"""
+    return '/' + quote(url, safe='')
+
+
+def make_site_app(pages, delay=0):
+    """
+    Return a tornado application serving 'pages' ({url: html}), the page
+    of url is at site_path(url). Each request sleeps 'delay' seconds
+    first, which blocks the whole server, so serve slow sites separately.
+    """
+    import time
+    import tornado.web
+
+    class SiteHandler(tornado.web.RequestHandler):
+        def get(self, path):
+            if delay:
+                time.sleep(delay)
+            page = pages.get(unquote(path))
+            if page is None:
+                raise tornado.web.HTTPError(404)
+            self.set_header('Content-Type', 'text/html; charset=utf-8')
+            self.write(page)
+
+    return tornado.web.Application([(r'/(.*)', SiteHandler)])
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""本地的 redis 替身，只用于 benchmark.
+
+NOTE:
+  + 通过 RESP 协议与 redis-py 通信，只实现了代理池用到的命令
+  + 所有 db 共享同一份数据，SELECT 直接返回 OK
+  + sorted set 用 dict 加惰性排序的列表实现，写入后第一次读取时重新排序
+"""
+
+import bisect
+import threading
+import socketserver
+
+
+class ZSet(object):
+    """简单的 sorted set"""
+    def __init__(self):
+        self.scores = {}
+        self.items  = []
+        self.keys   = []
+        self.dirty  = False
+
+    def add(self, member, score):
+        new = member not in self.scores
+        self.scores[member] = score
+        self.dirty = True
+        return int(new)
+
+    def remove(self, member):
+        if member in self.scores:
+            del self.scores[member]
+            self.dirty = True
+            return 1
+        return 0
+
+    def sorted(self):
+        if self.dirty:
+            self.items = sorted((score, member) for member, score in self.scores.items())
+            self.keys  = [score for score, member in self.items]
+            self.dirty = False
+        return self.items
+
+    def range_by_score(self, minscore, maxscore):
+        # minscore, maxscore 是 (score, 是否开区间)
+        self.sorted()
+        if minscore[1]:
+            lo = bisect.bisect_right(self.keys, minscore[0])
+        else:
+            lo = bisect.bisect_left(self.keys, minscore[0])
+        if maxscore[1]:
+            hi = bisect.bisect_left(self.keys, maxscore[0])
+        else:
+            hi = bisect.bisect_right(self.keys, maxscore[0])
+        return lo, max(lo, hi)
+
+
+def _parse_score(value):
+    # 与 redis 相同: '(' 开头是开区间，'-inf'、'+inf' 是无穷，其他不是浮点数的值是错误
+    value = value.decode('utf-8')
+    exclusive = value.startswith('(')
+    if exclusive:
+        value = value[1:]
+    if value != value.strip() or value.lower() == 'nan':
+        raise ValueError('min or max is not a float')
+    try:
+        return float(value), exclusive
+    except ValueError:
+        raise ValueError('min or max is not a float')
+
+
+def _format_score(score):
+    return repr(float(score)).encode('utf-8')
+
+
+class Store(object):
+    """命令的实现"""
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+        self.num_commands = 0
+        self.subscribers  = {}    # channel -> [RESPHandler, ...]
+
+    def execute(self, args):
+        name = args[0].decode('utf-8').upper()
+        method = getattr(self, 'cmd_' + name.lower(), None)
+        if method is None:
+            return Error('ERR unknown command %r' % (name,))
+        with self.lock:
+            self.num_commands += 1
+            try:
+                return method(*args[1:])
+            except ValueError as e:
+                return Error('ERR %s' % (e,))
+
+    def _get(self, key, factory):
+        value = self.data.get(key)
+        if value is None:
+            value = factory()
+            self.data[key] = value
+        return value
+
+    def cmd_ping(self, *args):
+        return Status('PONG')
+
+    def cmd_select(self, db):
+        return Status('OK')
+
+    def cmd_client(self, *args):
+        return Status('OK')
+
+    def cmd_flushdb(self, *args):
+        self.data.clear()
+        return Status('OK')
+
+    def cmd_get(self, key):
+        value = self.data.get(key)
+        return value if isinstance(value, bytes) else None
+
+    def cmd_set(self, key, value, *args):
+        self.data[key] = value
+        return Status('OK')
+
+    def cmd_mget(self, *keys):
+        return [self.cmd_get(key) for key in keys]
+
+    def cmd_incrby(self, key, amount):
+        value = int(self.cmd_get(key) or b'0') + int(amount)
+        self.data[key] = str(value).encode('utf-8')
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, b'1')
+
+    def cmd_del(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def cmd_publish(self, channel, message):
+        handlers = self.subscribers.get(channel, [])
+        for handler in handlers:
+            handler.send([b'message', channel, message])
+        return len(handlers)
+
+    def cmd_sadd(self, key, *members):
+        members_set = self._get(key, set)
+        num = len(members_set)
+        members_set.update(members)
+        return len(members_set) - num
+
+    def cmd_srem(self, key, *members):
+        members_set = self._get(key, set)
+        num = len(members_set)
+        members_set.difference_update(members)
+        return num - len(members_set)
+
+    def cmd_smembers(self, key):
+        return list(self._get(key, set))
+
+    def cmd_sismember(self, key, member):
+        return int(member in self._get(key, set))
+
+    def cmd_scard(self, key):
+        return len(self._get(key, set))
+
+    def cmd_hset(self, key, field, value):
+        fields = self._get(key, dict)
+        new = field not in fields
+        fields[field] = value
+        return int(new)
+
+    def cmd_hget(self, key, field):
+        return self._get(key, dict).get(field)
+
+    def cmd_hmget(self, key, *fields):
+        values = self._get(key, dict)
+        return [values.get(field) for field in fields]
+
+    def cmd_hincrby(self, key, field, amount):
+        values = self._get(key, dict)
+        value  = int(values.get(field, b'0')) + int(amount)
+        values[field] = str(value).encode('utf-8')
+        return value
+
+    def cmd_hdel(self, key, *fields):
+        values = self._get(key, dict)
+        return sum(1 for field in fields if values.pop(field, None) is not None)
+
+    def cmd_hgetall(self, key):
+        ret = []
+        for field, value in self._get(key, dict).items():
+            ret.extend((field, value))
+        return ret
+
+    def cmd_hlen(self, key):
+        return len(self._get(key, dict))
+
+    def cmd_zadd(self, key, *args):
+        zset = self._get(key, ZSet)
+        added = 0
+        for i in range(0, len(args), 2):
+            added += zset.add(args[i + 1], float(args[i]))
+        return added
+
+    def cmd_zrem(self, key, *members):
+        zset = self._get(key, ZSet)
+        return sum(zset.remove(member) for member in members)
+
+    def cmd_zcard(self, key):
+        return len(self._get(key, ZSet).scores)
+
+    def cmd_zscore(self, key, member):
+        score = self._get(key, ZSet).scores.get(member)
+        return None if score is None else _format_score(score)
+
+    def cmd_zcount(self, key, minscore, maxscore):
+        lo, hi = self._get(key, ZSet).range_by_score(_parse_score(minscore),
+                                                    _parse_score(maxscore))
+        return hi - lo
+
+    def cmd_zrange(self, key, start, stop, *args):
+        items = self._get(key, ZSet).sorted()
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(0, len(items) + start)
+        if stop < 0:
+            stop = len(items) + stop
+        items = items[start:stop + 1]
+        if args and args[0].upper() == b'WITHSCORES':
+            ret = []
+            for score, member in items:
+                ret.extend((member, _format_score(score)))
+            return ret
+        return [member for score, member in items]
+
+    def cmd_zrangebyscore(self, key, minscore, maxscore, *args):
+        zset = self._get(key, ZSet)
+        lo, hi = zset.range_by_score(_parse_score(minscore), _parse_score(maxscore))
+        options = [arg.decode('utf-8').upper() for arg in args]
+        if 'LIMIT' in options:
+            i = options.index('LIMIT')
+            offset, count = int(args[i + 1]), int(args[i + 2])
+            lo = min(hi, lo + offset)
+            hi = hi if count < 0 else min(hi, lo + count)
+        items = zset.sorted()[lo:hi]
+        if 'WITHSCORES' in options:
+            ret = []
+            for score, member in items:
+                ret.extend((member, _format_score(score)))
+            return ret
+        return [member for score, member in items]
+
+
+class Status(str):
+    pass
+
+
+class Error(str):
+    pass
+
+
+def _encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, Error):
+        return ('-%s\r\n' % (value,)).encode('utf-8')
+    if isinstance(value, Status):
+        return ('+%s\r\n' % (value,)).encode('utf-8')
+    if isinstance(value, int):
+        return (':%d\r\n' % (value,)).encode('utf-8')
+    if isinstance(value, bytes):
+        return b'$' + str(len(value)).encode('utf-8') + b'\r\n' + value + b'\r\n'
+    if isinstance(value, list):
+        return (b'*' + str(len(value)).encode('utf-8') + b'\r\n'
+                + b''.join(_encode(item) for item in value))
+    raise TypeError(value)
+
+
+class RESPHandler(socketserver.StreamRequestHandler):
+    """处理一个客户端连接，支持 MULTI/EXEC 和 SUBSCRIBE"""
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        store  = self.server.store
+        queued = None
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            name = args[0].upper()
+            if name == b'SUBSCRIBE':
+                self._subscribe(store, args[1:])
+                return
+            if name == b'MULTI':
+                queued = []
+                reply = Status('OK')
+            elif name == b'EXEC':
+                reply  = [store.execute(item) for item in (queued or [])]
+                queued = None
+                self.server.num_commands += 1
+            elif queued is not None:
+                queued.append(args)
+                reply = Status('QUEUED')
+            else:
+                reply = store.execute(args)
+                self.server.num_commands += 1
+            self.wfile.write(_encode(reply))
+
+    def _subscribe(self, store, channels):
+        # 订阅后连接只用于接收消息，其他命令忽略，连接关闭时退订
+        self.lock_send = threading.Lock()
+        with store.lock:
+            for i, channel in enumerate(channels, 1):
+                store.subscribers.setdefault(channel, []).append(self)
+                self.send([b'subscribe', channel, i])
+        try:
+            while self._read_command() is not None:
+                pass
+        finally:
+            with store.lock:
+                for channel in channels:
+                    store.subscribers[channel].remove(self)
+
+    def send(self, value):
+        with self.lock_send:
+            try:
+                self.wfile.write(_encode(value))
+            except OSError:
+                pass
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        num = int(line[1:])
+        args = []
+        for _ in range(num):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+
+class StubRedis(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """在后台线程中运行的 redis 替身"""
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.TCPServer.__init__(self, (host, port), RESPHandler)
+        self.store = Store()
+        # 执行的命令数，MULTI/EXEC 中的命令合计为一个
+        self.num_commands = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""运行全部 benchmark，把结果写成 json 文件，并可与之前的结果比较.
+
+所有 benchmark 都在本机离线运行: redis 由 stubredis 代替，代理、目标站点和 reflect
+站点由 fakenet 中的假代理扮演，代理列表站点由 fakenet 中的假站点提供. lease 需要真实的
+redis-server (见 bench_lease.py)，没有时结果为空.
+
+在项目根目录下运行:
+
+    $ python3 -m benchmarks.suite -o before.json
+    $ python3 -m benchmarks.suite -o after.json --compare before.json
+
+结果文件的格式:
+
+    {
+      "meta": {"time": ..., "commit": ..., "python": ..., "quick": ...},
+      "results": {"crawl": [{...}, ...], "validate": [...], ...}
+    }
+
+比较时按 (benchmark, name/mode/size) 对应每一项，列出 *per_sec 和 *_ms 指标的变化.
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+from benchmarks import (bench_crawl, bench_parse, bench_validate, bench_pipeline,
+                        bench_get_many, bench_storage, bench_handler, bench_batch,
+                        bench_watch, bench_server, bench_lease)
+from benchmarks.common import ROOT
+
+
+def _benches(quick):
+    # (名字, 函数, 参数)，quick 时减小规模
+    if quick:
+        return [
+            ('crawl', bench_crawl.bench, dict(copies=5, rows=100)),
+            ('parse', bench_parse.bench, dict(rounds=10, rows=100)),
+            ('validate', bench_validate.bench, dict(num_proxies=100)),
+            ('pipeline', bench_pipeline.bench, dict(num_proxies=100, slow=1)),
+            ('get_many', bench_get_many.bench, dict(num_requests=100, sizes=(1000, 100000))),
+            ('storage', bench_storage.bench, dict(num_requests=100, sizes=(1000,))),
+            ('handler', bench_handler.bench, dict(num_requests=500, num_proxies=1000)),
+            ('batch', bench_batch.bench, dict(num_requests=200, large=10000)),
+            ('watch', bench_watch.bench, dict(num_clients=10, duration=5, update=1)),
+            ('server', bench_server.bench, dict(workers=(1, 2), num_clients=4, num_requests=200)),
+            ('lease', bench_lease.bench, dict(num_requests=100, scans=(200,))),
+        ]
+    return [
+        ('crawl', bench_crawl.bench, {}),
+        ('parse', bench_parse.bench, {}),
+        ('validate', bench_validate.bench, {}),
+        ('pipeline', bench_pipeline.bench, {}),
+        ('get_many', bench_get_many.bench, {}),
+        ('storage', bench_storage.bench, {}),
+        ('handler', bench_handler.bench, {}),
+        ('batch', bench_batch.bench, {}),
+        ('watch', bench_watch.bench, {}),
+        ('server', bench_server.bench, {}),
+        ('lease', bench_lease.bench, {}),
+    ]
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(only=None, quick=False):
+    """Run the benchmarks named in 'only' (all if None), return the results document"""
+    results = {}
+    for name, bench, params in _benches(quick):
+        if only and name not in only:
+            continue
+        sys.stderr.write('Running %s ...\n' % (name,))
+        time_start    = time.time()
+        results[name] = bench(**params)
+        sys.stderr.write('Finished %s in %.1fs\n' % (name, time.time() - time_start))
+
+    return {
+        'meta': {
+            'time': int(time.time()),
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick,
+        },
+        'results': results,
+    }
+
+
+def _key(item):
+    # 同一个 benchmark 中区分各项的键
+    return tuple((field, item[field]) for field in ('name', 'mode', 'size', 'scan')
+                 if field in item)
+
+
+def compare(old, new):
+    """Return the lines comparing the metrics of 'new' with 'old'"""
+    lines = []
+    for bench, items in sorted(new['results'].items()):
+        old_items = dict((_key(item), item) for item in old['results'].get(bench, []))
+        for item in items:
+            old_item = old_items.get(_key(item))
+            if old_item is None:
+                continue
+            for metric, value in sorted(item.items()):
+                if not (metric.endswith('per_sec') or metric.endswith('_ms')):
+                    continue
+                old_value = old_item.get(metric)
+                if not old_value:
+                    continue
+                label = ' '.join('%s=%s' % pair for pair in _key(item))
+                lines.append('%-10s %-40s %-16s %12.2f -> %12.2f (%+.1f%%)'
+                             % (bench, label, metric, old_value, value,
+                                (value / old_value - 1) * 100))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', default=None, help='结果文件，默认输出到标准输出')
+    parser.add_argument('--only', nargs='+', default=None,
+                        help='只运行指定的 benchmark: '
+                             'crawl parse validate pipeline get_many storage handler batch watch '
+                             'server lease')
+    parser.add_argument('--quick', action='store_true', help='减小规模，快速运行')
+    parser.add_argument('--compare', default=None, help='与之前的结果文件比较')
+    args = parser.parse_args()
+
+    doc  = run(args.only, args.quick)
+    text = json.dumps(doc, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            old = json.load(fp)
+        for line in compare(old, doc):
+            sys.stderr.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
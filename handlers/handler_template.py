@@ -6,15 +6,72 @@
 # Date: 2014-03-04 21:18:55
 # -----------------------------------------
 
-"""处理 nginx 传来的请求，返回相应的 proxy list.
+"""处理 /proxylist 等请求，返回相应的 proxy list.
+
+由 server.py 在多个 worker 进程中运行，也可以单独运行在 8000 端口上调试.
 """
 
+import os
 import json
+import time
+import logging
 
+import tornado
+import tornado.gen
 import tornado.ioloop
+import tornado.iostream
+import tornado.concurrent
 import tornado.web
+from tornado.log import access_log
 
+import metrics
 from proxypool import ProxyPool
+from listcache import ProxyListCache
+from watch import MtimeWatcher
+from reflector import reflect
+
+
+HTTP_REQUESTS = metrics.REGISTRY.counter(
+    'proxypool_http_requests_total', 'HTTP requests by handler and status code')
+HTTP_SECONDS  = metrics.REGISTRY.histogram(
+    'proxypool_http_request_seconds', 'HTTP request latency by handler')
+
+# /proxylist/batch 流式返回时每写入多少行 flush 一次
+STREAM_LINES = 1000
+
+
+def flushed(handler):
+    """
+    Flush the output of 'handler', return a Future resolved once it has
+    been written to the socket. flush() returns a Future since tornado 4.0,
+    tornado 3.2 (requirements.txt) takes a callback instead, and never
+    calls it once the connection is closed.
+    """
+    if tornado.version_info >= (4, 0):
+        return handler.flush()
+    future = tornado.concurrent.Future()
+    if handler.request.connection.stream.closed():
+        future.set_exception(tornado.iostream.StreamClosedError())
+    else:
+        handler.flush(callback=lambda: future.set_result(None))
+    return future
+
+
+def log_request(handler):
+    """记录请求的指标; 成功的请求只在 DEBUG 级别记录日志，避免每个请求都写日志"""
+    status  = handler.get_status()
+    elapsed = handler.request.request_time()
+    name    = type(handler).__name__
+    HTTP_REQUESTS.inc(handler=name, code=status)
+    HTTP_SECONDS.observe(elapsed, handler=name)
+
+    if status < 400:
+        log_method = access_log.debug
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method('%d %s %.2fms' % (status, handler._request_summary(), elapsed * 1000))
 
 
 class ProxyListHandler(tornado.web.RequestHandler):
@@ -42,6 +99,11 @@ class ProxyListHandler(tornado.web.RequestHandler):
       'err': '失败原因',
     }
     """
+    def initialize(self, proxypool, listcache):
+        # proxypool 和 listcache 由 application 共享，不在每个请求中重新创建
+        self.proxypool = proxypool
+        self.listcache = listcache
+
     def get(self):
         self.write('Please refer to the API doc.')
     
@@ -49,44 +111,367 @@ class ProxyListHandler(tornado.web.RequestHandler):
         target = self.get_argument('target', default='') or 'all'
         num    = int(self.get_argument('num', default='') or 5)
         delay  = int(self.get_argument('delay', default='') or 10)
+        select = self.get_argument('select', default='') or 'random'
 
-        proxypool = ProxyPool()
-        
+        self.proxypool.refresh()
+
+        self.set_header('Content-Type', 'application/json')
+
+        # 正常情况下由缓存直接生成响应，见 listcache.py
+        try:
+            self.write(self.listcache.render(target, num, delay, select=select))
+        except Exception as e:
+            ret = {
+                'status': 'failure',
+                'target': target,
+                'err': str(e),
+            }
+            self.write(json.dumps(ret))
+
+
+class BatchProxyListHandler(tornado.web.RequestHandler):
+    """一次返回多个 target 的代理列表，spec 的格式是 target:num:delay (num、delay 可省略)，
+    可以重复或用逗号分隔; 所有 spec 只读一次 redis (或缓存)，见 listcache.py
+    示例:
+    + 成功，results 中每一项与 /proxylist 的响应相同
+    {
+      'status': 'success',
+      'results': [
+        {'status': 'success', 'proxylist': {'num': 5, 'mtime': 1394069326, ...}},
+        {'status': 'success', 'proxylist': {'num': 10, 'mtime': 1394069326, ...}},
+      ],
+    }
+    + stream=1 时以 NDJSON 格式逐行返回，适合很大的 num: 每个 spec 先是一行
+      {"status": "success", "target": "58", "mtime": 1394069326, "num": 2}，
+      之后每个代理一行 {"target": "58", "proxy": "http://220.248.180.149:3128"}
+    + 失败
+    {
+      'status': 'failure',
+      'err': '失败原因',
+    }
+    """
+    def initialize(self, proxypool, listcache):
+        self.proxypool = proxypool
+        self.listcache = listcache
+
+    def _specs(self):
+        specs = []
+        for value in self.get_arguments('spec'):
+            for spec in value.split(','):
+                if not spec:
+                    continue
+                target, num, delay = (spec.split(':') + ['', ''])[:3]
+                specs.append((target or 'all', int(num or 5), int(delay or 10)))
+        if not specs:
+            raise ValueError('At least one spec is required')
+        return specs
+
+    @tornado.gen.coroutine
+    def post(self):
+        select = self.get_argument('select', default='') or 'random'
+        stream = self.get_argument('stream', default='') in ('1', 'true')
+
+        self.proxypool.refresh()
+
+        try:
+            specs = self._specs()
+            if stream:
+                lines = self.listcache.stream_many(specs, select=select)
+            else:
+                body  = self.listcache.render_many(specs, select=select)
+        except Exception as e:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({'status': 'failure', 'err': str(e)}))
+            return
+
+        if not stream:
+            self.set_header('Content-Type', 'application/json')
+            self.write(body)
+            return
+
+        # 代理已经抽取好，分块写出，每块 flush 后等待发送完再写下一块，输出缓冲区不随 num 增大
+        self.set_header('Content-Type', 'application/x-ndjson')
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= STREAM_LINES:
+                self.write(''.join(chunk))
+                chunk = []
+                yield flushed(self)
+        if chunk:
+            self.write(''.join(chunk))
+
+
+class WatchHandler(tornado.web.RequestHandler):
+    """长轮询: 等到 target 的 mtime 大于客户端上次看到的 mtime 后返回，最多等待 timeout 秒
+    (不超过 WATCH.TIMEOUT)，超时时 changed 是 false，见 watch.py
+    示例:
+    {
+      'status': 'success',
+      'target': '58',
+      'mtime': 1394069400,
+      'changed': true,
+    }
+    """
+    def initialize(self, watcher, timeout):
+        self.watcher = watcher
+        self.timeout = timeout
+        self.target  = None
+        self.future  = None
+        self.closed  = False
+
+    @tornado.gen.coroutine
+    def get(self):
+        name    = self.get_argument('target', default='') or 'all'
+        since   = self.get_argument('mtime', default='')
+        timeout = self.get_argument('timeout', default='')
+
+        self.set_header('Content-Type', 'application/json')
         try:
-            proxies = proxypool.get_many(target=target, num=num, maxscore=delay)
-            num_ret = len(proxies)
-            mtime   = proxypool.get_mtime(target=target)
+            since       = int(since or 0)
+            timeout     = min(float(timeout or self.timeout), self.timeout)
+            self.target = self.watcher.normalize(name)
+            self.future = self.watcher.wait(self.target, since, timeout)
+        except Exception as e:
+            self.write(json.dumps({'status': 'failure', 'target': name, 'err': str(e)}))
+            return
+
+        mtime = yield self.future
+        if self.closed:
+            return
+        ret = {
+            'status': 'success',
+            'target': name,
+            'mtime': mtime or self.watcher.current(self.target),
+            'changed': mtime is not None,
+        }
+        self.write(json.dumps(ret))
+
+    post = get
+
+    def on_connection_close(self):
+        self.closed = True
+        if self.future is not None:
+            self.watcher.cancel(self.target, self.future)
+
+
+class EventsHandler(tornado.web.RequestHandler):
+    """Server-Sent Events: target 的 mtime 每次变化时推送一个事件，事件的 id 是 mtime，
+    断开重连时浏览器带上的 Last-Event-ID 之后的变化会立即推送; 没有事件时每 WATCH.HEARTBEAT
+    秒发送一个注释行，见 watch.py
+    示例:
+    id: 1394069400
+    event: mtime
+    data: {"target": "58", "mtime": 1394069400}
+    """
+    def initialize(self, watcher, heartbeat):
+        self.watcher   = watcher
+        self.heartbeat = heartbeat
+        self.target    = None
+        self.future    = None
+        self.closed    = False
 
-            proxylist = []
-            for proxy in proxies:
-                proxylist.append(proxy.decode('utf-8'))
+    @tornado.gen.coroutine
+    def get(self):
+        name = self.get_argument('target', default='') or 'all'
+        last = self.request.headers.get('Last-Event-ID') or self.get_argument('mtime', default='')
+        try:
+            last        = int(last or 0)
+            self.target = self.watcher.normalize(name)
+            # 没有检测过的 target 没有 mtime，在发送 event-stream 的响应头之前报错
+            self.watcher.current(self.target)
+        except Exception as e:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({'status': 'failure', 'target': name, 'err': str(e)}))
+            return
 
-            if str(target).upper() in proxypool.targets:
-                status = 'success'
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        while not self.closed:
+            self.future = self.watcher.wait(self.target, last, self.heartbeat)
+            mtime = yield self.future
+            if self.closed:
+                break
+            if mtime is None:
+                self.write(': heartbeat\n\n')
             else:
-                status = 'success-partial'
+                last = mtime
+                self.write('id: %d\nevent: mtime\ndata: %s\n\n'
+                           % (mtime, json.dumps({'target': name, 'mtime': mtime})))
+            try:
+                yield flushed(self)
+            except tornado.iostream.StreamClosedError:
+                break
 
+    def on_connection_close(self):
+        self.closed = True
+        if self.future is not None:
+            self.watcher.cancel(self.target, self.future)
+
+
+class LeaseHandler(tornado.web.RequestHandler):
+    """借出代理，租期内不会再借给其他客户端，见 lease.py
+    示例:
+    {
+      'status': 'success',
+      'lease': {
+        'token': '9f0c...',
+        'expires': 1394069386.25,
+        'target': '58',
+        'num': 2,
+        'proxies': [
+          'http://220.248.180.149:3128',
+          'http://61.55.141.11:81',
+        ],
+      },
+    }
+    """
+    def initialize(self, proxypool):
+        self.proxypool = proxypool
+
+    def post(self):
+        target = self.get_argument('target', default='') or 'all'
+        num    = int(self.get_argument('num', default='') or 5)
+        delay  = int(self.get_argument('delay', default='') or 10)
+        ttl    = self.get_argument('ttl', default='')
+
+        self.proxypool.refresh()
+
+        self.set_header('Content-Type', 'application/json')
+        try:
+            target, token, expires, proxies = self.proxypool.checkout(
+                target=target, num=num, maxscore=delay, ttl=int(ttl) if ttl else None)
             ret = {
-                'status': status,
-                'proxylist': {
-                    'num': num_ret,
-                    'mtime': mtime,
+                'status': 'success',
+                'lease': {
+                    'token': token,
+                    'expires': round(expires, 3),
                     'target': target,
-                    'proxies': proxylist,
+                    'num': len(proxies),
+                    'proxies': [proxy.decode('utf-8') for proxy in proxies],
                 },
             }
         except Exception as e:
+            ret = {'status': 'failure', 'err': str(e)}
+        self.write(json.dumps(ret))
+
+
+class ReleaseHandler(tornado.web.RequestHandler):
+    """归还借出的代理，可以同时报告使用结果 outcome (ok/failed) 和耗时 latency
+    示例:
+    {
+      'status': 'success',
+      'released': ['http://220.248.180.149:3128'],
+    }
+    """
+    def initialize(self, proxypool):
+        self.proxypool = proxypool
+
+    def post(self):
+        target  = self.get_argument('target', default='') or 'all'
+        token   = self.get_argument('token')
+        proxies = [proxy for value in self.get_arguments('proxy')
+                   for proxy in value.split(',') if proxy]
+        outcome = self.get_argument('outcome', default='') or None
+        latency = self.get_argument('latency', default='')
+
+        self.set_header('Content-Type', 'application/json')
+        try:
+            released = self.proxypool.release(token, proxies, target=target, outcome=outcome,
+                                              latency=float(latency) if latency else None)
             ret = {
-                'status': 'failure',
-                'target': target,
-                'err': str(e),
+                'status': 'success',
+                'released': [proxy.decode('utf-8') for proxy in released],
             }
+        except Exception as e:
+            ret = {'status': 'failure', 'err': str(e)}
+        self.write(json.dumps(ret))
+
 
+class ReflectHandler(tornado.web.RequestHandler):
+    """返回请求者的 ip 和转发相关的请求头，用于检测代理是否匿名
+    示例:
+    {
+      'origin': '220.248.180.149',
+      'headers': {
+        'Via': '1.1 proxy',
+        'X-Forwarded-For': '61.55.141.11',
+      },
+    }
+    """
+    def get(self):
         self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(reflect(self.request.remote_ip, self.request.headers)))
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """返回处理该请求的 worker 进程的状态，redis 不可用时状态码是 503
+    示例:
+    {
+      'status': 'ok',
+      'worker': 2,
+      'pid': 12345,
+      'uptime': 3600,
+      'cache': {'hits': 10000, 'misses': 12},
+    }
+    """
+    def initialize(self, proxypool, listcache, worker):
+        self.proxypool = proxypool
+        self.listcache = listcache
+        self.worker    = worker
 
+    def get(self):
+        try:
+            self.proxypool.rdb.ping()
+            status = 'ok'
+        except Exception as e:
+            status = 'redis unavailable: %r' % (e,)
+            self.set_status(503)
+
+        ret = {
+            'status': status,
+            'worker': self.worker['id'],
+            'pid': os.getpid(),
+            'uptime': int(time.time() - self.worker['started']),
+            'cache': {
+                'hits': self.listcache.num_hits,
+                'misses': self.listcache.num_misses,
+            },
+        }
+        self.set_header('Content-Type', 'application/json')
         self.write(json.dumps(ret))
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """以 Prometheus 的文本格式返回各阶段和各 worker 的指标，见 metrics.py"""
+    def initialize(self, proxypool, worker):
+        self.proxypool = proxypool
+        self.worker    = worker
+
+    def get(self):
+        configs = self.proxypool.configs['METRICS']
+        source  = 'worker:%d' % (self.worker['id'],)
+
+        # 本 worker 的指标直接读取，其他进程的指标读取它们写入 redis 的快照
+        snapshots = [metrics.REGISTRY.snapshot(worker=self.worker['id'])]
+        try:
+            with metrics.REDIS_SECONDS.time(op='hgetall'):
+                values = self.proxypool.rdb.hgetall(configs['HASH'])
+        except Exception as e:
+            logging.error('Error when reading metrics: %r' % (e,))
+            values = {}
+        for field, value in values.items():
+            field = field.decode('utf-8')
+            if field == source:
+                continue
+            # 已经退出的 worker 不再更新快照
+            max_age = configs['INTERVAL'] * 3 if field.startswith('worker:') else None
+            snapshots.extend(metrics.load_snapshots([value], max_age=max_age))
+
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.render(snapshots))
+
+
 class MainHandler(tornado.web.RequestHandler):
     """处理未匹配到的请求"""
     def get(self):
@@ -96,12 +481,63 @@ class MainHandler(tornado.web.RequestHandler):
         self.write('Please refer to the API doc.')
         
 
-app = tornado.web.Application([
-    (r'/proxylist', ProxyListHandler),
-    (r'.*', MainHandler),
-])
+def make_app(proxypool=None, worker=None):
+    """
+    Return the application, 'worker' is the state of the worker process
+    reported by /health, see server.py.
+    """
+    proxypool = proxypool or ProxyPool()
+    listcache = ProxyListCache(proxypool,
+                               check_interval=proxypool.configs['CACHE']['CHECK_INTERVAL'],
+                               max_entries=proxypool.configs['CACHE']['MAX_ENTRIES'],
+                               weight=proxypool.select_weight,
+                               temperature=proxypool.select_temperature)
+    listcache.listen(proxypool.configs['CACHE']['CHANNEL'])
+    watch   = proxypool.configs.get('WATCH') or {}
+    watcher = MtimeWatcher(proxypool, subscribed=listcache.listening,
+                           poll_interval=proxypool.configs['CACHE']['CHECK_INTERVAL'])
+    listcache.add_listener(watcher.update)
+    worker = worker or {'id': 0, 'started': time.time()}
+
+    return tornado.web.Application([
+        (r'/proxylist', ProxyListHandler, dict(proxypool=proxypool, listcache=listcache)),
+        (r'/proxylist/batch', BatchProxyListHandler,
+         dict(proxypool=proxypool, listcache=listcache)),
+        (r'/proxylist/watch', WatchHandler,
+         dict(watcher=watcher, timeout=watch.get('TIMEOUT', 30))),
+        (r'/proxylist/events', EventsHandler,
+         dict(watcher=watcher, heartbeat=watch.get('HEARTBEAT', 15))),
+        (r'/lease', LeaseHandler, dict(proxypool=proxypool)),
+        (r'/lease/release', ReleaseHandler, dict(proxypool=proxypool)),
+        (r'/reflect', ReflectHandler),
+        (r'/health', HealthHandler, dict(proxypool=proxypool, listcache=listcache,
+                                         worker=worker)),
+        (r'/metrics', MetricsHandler, dict(proxypool=proxypool, worker=worker)),
+        (r'.*', MainHandler),
+    ], log_function=log_request)
+
+
+def publish_metrics(proxypool, worker):
+    """Write the metrics of this worker into redis every METRICS.INTERVAL seconds"""
+    configs = proxypool.configs['METRICS']
+
+    def publish():
+        try:
+            metrics.REGISTRY.publish(proxypool.rdb, configs['HASH'],
+                                     'worker:%d' % (worker['id'],), worker=worker['id'])
+        except Exception as e:
+            logging.error('Error when publishing metrics: %r' % (e,))
+
+    callback = tornado.ioloop.PeriodicCallback(publish, configs['INTERVAL'] * 1000)
+    callback.start()
+
+    return callback
 
 
 if __name__ == '__main__':
+    worker    = {'id': 0, 'started': time.time()}
+    proxypool = ProxyPool()
+    app       = make_app(proxypool, worker=worker)
     app.listen(8000)
+    publish_metrics(proxypool, worker)
     tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""复用连接的 HTTP session.
+
+NOTE:
+  + requests.get() 每次都新建 session 和连接，CRAWL.HEADERS 中的 Connection: keep-alive
+    不起作用; 这里每个线程使用一个 session，连接在同一个线程的请求之间复用
+  + 每个 session 的连接池大小由 HTTP 中对应阶段的配置限制
+  + 通过 urllib3 连接池的 num_connections/num_requests 统计新建和复用的连接数，
+    被连接池淘汰的 host 的计数会丢失，所以统计是近似值
+"""
+
+import logging
+import threading
+
+import requests
+
+
+def _pool_counts(session):
+    # 返回 session 中所有连接池的 (新建连接数, 请求数)
+    num_connections = num_requests = 0
+    # 同一个 adapter 挂载在 http:// 和 https:// 上，只统计一次
+    adapters = dict((id(adapter), adapter) for adapter in session.adapters.values())
+    for adapter in adapters.values():
+        managers = [adapter.poolmanager] + list(getattr(adapter, 'proxy_manager', {}).values())
+        for manager in managers:
+            pools = manager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                num_connections += getattr(pool, 'num_connections', 0)
+                num_requests    += getattr(pool, 'num_requests', 0)
+
+    return num_connections, num_requests
+
+
+class SessionPool(object):
+    """一个阶段 (抓取、匿名检测) 使用的 session.
+    """
+    def __init__(self, name, headers=None, pool_connections=10, pool_maxsize=10):
+        self.name             = name
+        self.headers          = headers or {}
+        self.pool_connections = pool_connections
+        self.pool_maxsize     = pool_maxsize
+
+        self.local    = threading.local()
+        self.lock     = threading.Lock()
+        self.sessions = []
+        self.closed   = [0, 0]    # 已关闭的 session 的 (新建连接数, 请求数)
+        self.last     = (0, 0)    # 上次 round_stats() 时的计数
+
+    def new_session(self, pool_connections=None, pool_maxsize=None):
+        """Return a new tracked session, close it with close_session()"""
+        session = requests.Session()
+        session.headers.update(self.headers)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections or self.pool_connections,
+            pool_maxsize=pool_maxsize or self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        with self.lock:
+            self.sessions.append(session)
+
+        return session
+
+    def get(self):
+        """Return the session of the current thread"""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.new_session()
+            self.local.session = session
+
+        return session
+
+    def close_session(self, session):
+        num_connections, num_requests = _pool_counts(session)
+        with self.lock:
+            self.sessions.remove(session)
+            self.closed[0] += num_connections
+            self.closed[1] += num_requests
+        session.close()
+
+    def close_all(self):
+        """Close all sessions, threads get new sessions on the next get()"""
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            self.close_session(session)
+        self.local = threading.local()
+
+    def round_stats(self):
+        """
+        Return {'new': n, 'reused': m}, the connections created and reused
+        since the last call, and log them.
+        """
+        with self.lock:
+            num_connections, num_requests = self.closed
+            for session in self.sessions:
+                counts = _pool_counts(session)
+                num_connections += counts[0]
+                num_requests    += counts[1]
+            last, self.last = self.last, (num_connections, num_requests)
+
+        new    = num_connections - last[0]
+        reused = max(0, (num_requests - last[1]) - new)
+        logging.info('Connections of %s: %d new, %d reused' % (self.name, new, reused))
+
+        return {'new': new, 'reused': reused}
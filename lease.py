@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""代理的租约: 借出的代理在租期内不会再借给其他客户端.
+
+NOTE:
+  + 每个 target 的租约存储在两个 key 中:
+    - '<DB_PROXY>:<LEASE.SUFFIX>': sorted set，member 是代理，score 是租约的到期时间
+    - '<DB_PROXY>:<LEASE.SUFFIX>:owner': hash，key 是代理，value 是借出时的 token
+  + 借出和归还都由一个 Lua 脚本原子执行，多个 handler 进程之间不需要加锁，
+    每次是一次 redis 往返 (EVALSHA)
+  + 借出时按分数从低到高 (延迟从小到大) 选出没有被借出的代理，最多检查 LEASE.SCAN 个候选;
+    顺带清理已经到期的租约，到期而没有归还的代理可以再次借出
+  + 脚本执行期间 redis 不处理其他客户端的命令，每个候选是一次 ZSCORE: 分数最低的候选都已被借出
+    时，SCAN 是 200 的借出耗时约 0.5ms，1000 约 2ms (benchmarks/bench_lease.py)，
+    LEASE.SCAN 不能超过 MAX_SCAN
+  + 归还时 token 必须与借出时的一致，租约到期后被其他客户端借走的代理不能再由原客户端归还;
+    客户端报告的结果 (ok/failed 和耗时) 与检测结果一样更新代理的历史记录和分数，见 scoring.py;
+    同一时间只有租约的持有者会报告一个代理的结果，读-改-写不会与其他客户端冲突
+  + 需要 redis 2.6 以上 (Lua 脚本)，SQLite 后端 (sqlitestore.py) 上不能借出代理
+"""
+
+import time
+import uuid
+import logging
+
+import scoring
+import metrics
+
+
+LEASES = metrics.REGISTRY.counter(
+    'proxypool_leases_total', 'Proxies checked out and released by outcome')
+
+# KEYS: 代理的 sorted set, 租约的 sorted set, 租约的 hash
+# ARGV: now, 到期时间, num, minscore, maxscore, token, 最多检查的候选数
+CHECKOUT = """
+local now, expires, num, scan = tonumber(ARGV[1]), ARGV[2], tonumber(ARGV[3]), tonumber(ARGV[7])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 100)
+if #expired > 0 then
+  redis.call('ZREM', KEYS[2], unpack(expired))
+  redis.call('HDEL', KEYS[3], unpack(expired))
+end
+
+local chosen = {}
+local offset = 0
+while #chosen < num and offset < scan do
+  local batch = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[4], ARGV[5], 'LIMIT', offset,
+                          math.min(100, scan - offset))
+  if #batch == 0 then
+    break
+  end
+  for _, proxy in ipairs(batch) do
+    local leased = redis.call('ZSCORE', KEYS[2], proxy)
+    if not leased or tonumber(leased) <= now then
+      redis.call('ZADD', KEYS[2], expires, proxy)
+      redis.call('HSET', KEYS[3], proxy, ARGV[6])
+      chosen[#chosen + 1] = proxy
+      if #chosen >= num then
+        break
+      end
+    end
+  end
+  offset = offset + 100
+end
+return chosen
+"""
+
+# KEYS: 租约的 sorted set, 租约的 hash
+# ARGV: token, proxy, proxy, ...
+RELEASE = """
+local released = {}
+for i = 2, #ARGV do
+  if redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[1] then
+    redis.call('ZREM', KEYS[1], ARGV[i])
+    redis.call('HDEL', KEYS[2], ARGV[i])
+    released[#released + 1] = ARGV[i]
+  end
+end
+return released
+"""
+
+# 代理仍在 sorted set 中时才更新分数和历史记录，不会重新加入已删除的代理;
+# 更新后增加 sorted set 的版本号，get_many 缓存的抽样表由此失效，见 ProxyPool._sample_version
+# KEYS: 代理的 sorted set, 历史记录的 hash, 版本号
+# ARGV: proxy, 分数, 历史记录
+SET_SCORE = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+  redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+  redis.call('INCR', KEYS[3])
+  return 1
+end
+return 0
+"""
+
+
+class LeaseError(Exception):
+    """租约的参数错误"""
+
+
+class LeaseManager(object):
+    """借出、归还代理.
+    """
+    OUTCOMES = ('ok', 'failed')
+    MAX_SCAN = 1000
+
+    def __init__(self, proxypool, ttl=60, max_ttl=600, scan=200, suffix='leases'):
+        self.proxypool = proxypool
+        self.ttl       = ttl
+        self.max_ttl   = max_ttl
+        self.scan      = max(1, min(scan, self.MAX_SCAN))
+        self.suffix    = suffix
+
+        rdb = proxypool.rdb
+        if hasattr(rdb, 'register_script'):
+            self.script_checkout  = rdb.register_script(CHECKOUT)
+            self.script_release   = rdb.register_script(RELEASE)
+            self.script_set_score = rdb.register_script(SET_SCORE)
+        else:
+            self.script_checkout = self.script_release = self.script_set_score = None
+
+    def _check_backend(self):
+        if self.script_checkout is None:
+            raise LeaseError('Leases need the redis backend (STORE.BACKEND: redis)')
+
+    def _keys(self, target):
+        db    = self.proxypool.configs['TARGET'][target]['DB_PROXY']
+        lease = '%s:%s' % (db, self.suffix)
+        return db, lease, lease + ':owner'
+
+    def checkout(self, target, num, minscore, maxscore, ttl=None):
+        """
+        Lease at most 'num' proxies of 'target' which scores are between
+        'minscore' and 'maxscore' for 'ttl' seconds, the fastest first.
+        Return (token, expires, [proxy, ...]).
+        """
+        self._check_backend()
+        ttl = self.ttl if ttl is None else ttl
+        if not 0 < ttl <= self.max_ttl:
+            raise LeaseError('ttl must be in (0, %d]' % (self.max_ttl,))
+
+        now     = time.time()
+        expires = now + ttl
+        token   = uuid.uuid4().hex
+        with metrics.REDIS_SECONDS.time(op='lease_checkout'):
+            proxies = self.script_checkout(keys=self._keys(target),
+                                           args=['%.3f' % (now,), '%.3f' % (expires,), num,
+                                                 minscore, maxscore, token, self.scan])
+        LEASES.inc(len(proxies), action='checkout')
+
+        return token, expires, proxies
+
+    def release(self, target, token, proxies, outcome=None, latency=None):
+        """
+        Release 'proxies' leased with 'token', return the released ones.
+        'outcome' ('ok' or 'failed') and 'latency' reported by the client
+        update the score of the released proxies.
+        """
+        self._check_backend()
+        if outcome is not None and outcome not in self.OUTCOMES:
+            raise LeaseError('outcome must be one of %s' % (', '.join(self.OUTCOMES),))
+        if not proxies:
+            return []
+
+        db, lease, owner = self._keys(target)
+        with metrics.REDIS_SECONDS.time(op='lease_release'):
+            released = self.script_release(keys=[lease, owner], args=[token] + list(proxies))
+        LEASES.inc(len(released), action='release', outcome=outcome or 'none')
+
+        if outcome is not None and released:
+            # 租约已经归还，更新分数失败时只记录日志
+            try:
+                self._report(target, db, released, outcome, latency)
+            except Exception as e:
+                logging.error('Error when reporting the outcome of %s: %r' % (released, e))
+
+        return released
+
+    def _report(self, target, db, proxies, outcome, latency):
+        # 按客户端报告的结果更新历史记录和分数; 成功但没有报告耗时的，按原来的平均延迟计算
+        proxypool = self.proxypool
+        model     = proxypool.score_model
+        score_db  = proxypool._score_hash(target)
+        records   = proxypool.rdb.hmget(score_db, proxies)
+
+        pipe = proxypool.rdb.pipeline(transaction=False)
+        for proxy, value in zip(proxies, records):
+            record = scoring.loads(value)
+            if outcome != 'ok':
+                time_delay = proxypool.time_exception
+            elif latency is not None:
+                time_delay = latency
+            elif record is not None and record[0] is not None:
+                time_delay = record[0]
+            else:
+                continue
+            record = model.update(record, time_delay)
+            self.script_set_score(keys=[db, score_db, proxypool._version_key(target)],
+                                  args=[proxy, model.score(record), scoring.dumps(record)],
+                                  client=pipe)
+        pipe.execute()
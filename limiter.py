@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""根据检测的错误率和耗时自适应调整并发数，以及每个 target 站点的请求速率上限.
+
+NOTE:
+  + 大部分抓取到的代理本来就是不可用的，单个检测失败不能说明并发过高; AIMD 按窗口调整:
+    每完成 ADAPTIVE.WINDOW 个检测，比较这个窗口的错误率和平均耗时与基线 (历史窗口的 EWMA)，
+    - 错误率超过基线 ADAPTIVE.TOLERANCE，或平均耗时超过基线的 ADAPTIVE.LATENCY 倍:
+      并发数乘以 ADAPTIVE.DECREASE (multiplicative decrease)
+    - 否则并发数加 ADAPTIVE.INCREASE (additive increase); 第一次拥塞之前每个窗口翻倍
+      (slow start)，asyncio 方式下的上限很大，逐个增加太慢
+    - 并发数在 [ADAPTIVE.MIN, 上限] 之间，上限是各阶段的线程数或 ADAPTIVE.TARGET_MAX
+  + AIMD 只负责计算并发数，Limiter (线程) 和 asyncvalid.AsyncLimiter (asyncio) 按它限制
+    同时进行的检测数; AIMD 由 ProxyPool 保存，学到的并发数在各轮之间延续
+  + 这个模块总是被 proxypool.py 导入，不能使用 async/await (需要 python3.5)，
+    asyncio 方式下用到的部分在 asyncvalid.py 中
+  + RateLimiter 是令牌桶，限制对每个 target 站点每秒的请求数，避免被目标站点封禁
+"""
+
+import time
+import threading
+
+import metrics
+
+
+CONCURRENCY_LIMIT  = metrics.REGISTRY.gauge(
+    'proxypool_concurrency_limit', 'Concurrent checks allowed by stage and target')
+CONCURRENCY_ADJUST = metrics.REGISTRY.counter(
+    'proxypool_concurrency_adjust_total', 'Adjustments of the concurrency limit by direction')
+
+class AIMD(object):
+    """按窗口的加性增、乘性减.
+    """
+    def __init__(self, initial=10, minimum=1, maximum=100, window=50, tolerance=0.1,
+                 latency=2, decrease=0.5, increase=5, alpha=0.2, labels=None):
+        self.minimum   = minimum
+        self.maximum   = maximum
+        self.limit     = float(max(minimum, min(initial, maximum)))
+        self.window    = window
+        self.tolerance = tolerance
+        self.latency   = latency
+        self.decrease  = decrease
+        self.increase  = increase
+        self.alpha     = alpha
+        self.labels    = labels or {}
+
+        self.lock         = threading.Lock()
+        self.slow_start   = True
+        self.num          = 0
+        self.failures     = 0
+        self.time_total   = 0.0
+        self.base_failure = None    # 错误率的基线
+        self.base_latency = None    # 成功检测的平均耗时的基线
+
+        CONCURRENCY_LIMIT.set(int(self.limit), **self.labels)
+
+    def record(self, ok, latency):
+        """Record a finished check, return the current limit"""
+        with self.lock:
+            self.num += 1
+            if ok:
+                self.time_total += latency
+            else:
+                self.failures += 1
+            if self.num >= self.window:
+                self._adjust()
+            return int(self.limit)
+
+    def _adjust(self):
+        failure = self.failures / self.num
+        succeed = self.num - self.failures
+        latency = self.time_total / succeed if succeed else None
+        self.num = self.failures = 0
+        self.time_total = 0.0
+
+        if self.base_failure is None:
+            self.base_failure = failure
+            self.base_latency = latency
+            return
+
+        congested = failure > self.base_failure + self.tolerance
+        if latency is not None and self.base_latency is not None:
+            congested = congested or latency > self.base_latency * self.latency
+
+        if congested:
+            self.slow_start = False
+            self.limit      = max(self.minimum, self.limit * self.decrease)
+            CONCURRENCY_ADJUST.inc(direction='down', **self.labels)
+        elif self.limit < self.maximum:
+            if self.slow_start:
+                self.limit = min(self.maximum, self.limit * 2)
+            else:
+                self.limit = min(self.maximum, self.limit + self.increase)
+            CONCURRENCY_ADJUST.inc(direction='up', **self.labels)
+        CONCURRENCY_LIMIT.set(int(self.limit), **self.labels)
+
+        # 拥塞的窗口也计入基线: 只对突然的变化做出反应，持续的变化 (例如一批代理都不可用，
+        # 或目标站点整体变慢) 逐渐成为新的基线，并发数不会一直减小到最小值
+        alpha = self.alpha
+        self.base_failure = alpha * failure + (1 - alpha) * self.base_failure
+        if latency is not None:
+            if self.base_latency is None:
+                self.base_latency = latency
+            else:
+                self.base_latency = alpha * latency + (1 - alpha) * self.base_latency
+
+
+class Limiter(object):
+    """多线程下按 AIMD 的并发数限制同时进行的检测.
+    """
+    def __init__(self, policy):
+        self.policy    = policy
+        self.condition = threading.Condition()
+        self.inflight  = 0
+
+    def acquire(self):
+        """Block until a slot is available, return the time acquired"""
+        with self.condition:
+            while self.inflight >= int(self.policy.limit):
+                self.condition.wait()
+            self.inflight += 1
+        return time.time()
+
+    def release(self, ok, time_start):
+        """Release the slot acquired at 'time_start', 'ok' is the result of the check"""
+        self.policy.record(ok, time.time() - time_start)
+        with self.condition:
+            self.inflight -= 1
+            # 并发数可能刚刚增加，唤醒所有可以开始的线程
+            self.condition.notify(max(1, int(self.policy.limit) - self.inflight))
+
+
+class RateLimiter(object):
+    """令牌桶，每秒最多 rate 个请求，rate 是 0 时不限制.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate   = rate
+        self.burst  = burst or max(1, rate)
+        self.tokens = float(self.burst)
+        self.last   = time.time()
+        self.lock   = threading.Lock()
+
+    def reserve(self):
+        """Take a token, return the seconds to wait before sending the request"""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now         = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last   = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def wait(self):
+        """Block until a request can be sent"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
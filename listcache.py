@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""/proxylist 响应的进程内缓存.
+
+NOTE:
+  + 每个 (target, delay) 缓存分数不超过 delay 的全部代理，每个代理预先编码成 json 字符串，
+    请求时只需随机抽样并拼接，不访问 redis，也不调用 json.dumps
+  + 代理只在检测时更新，更新时间记录在 TARGET 的 DB_MTIME 中; 至少间隔 CACHE.CHECK_INTERVAL
+    秒才读一次 DB_MTIME，变化后丢弃该 target 的缓存
+  + CACHE.CHANNEL 不为空时，另外订阅该 redis 频道，每轮检测结束后 ProxyPool 在频道上发布
+    更新的 target，收到后立即丢弃缓存，不必等到下次检查 mtime (只有 redis 后端支持);
+    检测中每次写入新的 mtime 也在频道上发布，转发给 add_listener() 注册的回调，见 watch.py
+  + select=weighted 时按分数加权不放回抽样，每个 (target, delay) 的 alias 表在第一次
+    加权请求时建立，与候选代理一起在 mtime 变化后丢弃，见 weighted.py
+  + 需要检查的 mtime 和缓存中没有的代理在一个 pipeline (MULTI/EXEC) 中读出，一次 redis 往返;
+    /proxylist/batch 一次请求多个 (target, num, delay)，也只读一次 redis，mtime 变化时再读一次
+"""
+
+import json
+import time
+import random
+import logging
+import threading
+
+import metrics
+import weighted
+
+
+CACHE_REQUESTS = metrics.REGISTRY.counter(
+    'proxypool_cache_requests_total', 'Lookups of the /proxylist cache by result')
+
+
+class ProxyListCache(object):
+    """按 (target, delay) 缓存候选代理和预先编码的 json 片段.
+    """
+    def __init__(self, proxypool, check_interval=5, max_entries=256, weight='inverse',
+                 temperature=1.0):
+        self.proxypool      = proxypool
+        self.check_interval = check_interval
+        self.max_entries    = max_entries
+        self.weight         = weight
+        self.temperature    = temperature
+
+        self.lock      = threading.Lock()
+        self.entries   = {}    # (target, delay) -> (mtime, 预先编码的代理列表, 分数列表)
+        self.samplers  = {}    # (target, delay) -> (mtime, WeightedSampler)
+        self.mtimes    = {}    # target -> (mtime, 上次检查的时间)
+        self.thread    = None
+        self.listeners = []    # 频道上 mtime 的通知，见 add_listener
+
+        # 统计命中和重新加载的次数
+        self.num_hits   = 0
+        self.num_misses = 0
+
+    def _normalize(self, target):
+        target = str(target).upper()
+        if target not in self.proxypool.targets:
+            target = 'ALL'
+        return target
+
+    def _read(self, stale, missing, now):
+        # 在一个 pipeline 中读出 stale 中各 target 的 mtime 和 missing 中各 (target, delay)
+        # 分数在 [0, delay] 之间的全部代理，一次 redis 往返; 每个代理编码成 json 字符串.
+        # missing 中各 target 的 mtime 也在这个 pipeline 中读出，与代理是同一时刻的，
+        # 订阅线程的 invalidate() 可能随时删除 self.mtimes 中的 target，不能依赖它.
+        # 返回新读出的 {(target, delay): (mtime, 预先编码的代理列表, 分数列表)}
+        configs = self.proxypool.configs['TARGET']
+        targets = sorted(set(stale) | set(target for target, _ in missing))
+        pipe    = self.proxypool.rdb.pipeline(transaction=True)
+        for target in targets:
+            pipe.get(configs[target]['DB_MTIME'])
+        for target, delay in missing:
+            pipe.zrangebyscore(configs[target]['DB_PROXY'], 0, delay, withscores=True)
+        with metrics.REDIS_SECONDS.time(op='proxylist'):
+            values = pipe.execute()
+
+        mtimes = dict((target, int(mtime)) for target, mtime in zip(targets, values))
+        loaded = []
+        for members in values[len(targets):]:
+            loaded.append(([json.dumps(proxy.decode('utf-8')) for proxy, score in members],
+                           [score for proxy, score in members]))
+
+        entries = {}
+        with self.lock:
+            for target in stale:
+                self.mtimes[target] = (mtimes[target], now)
+            for key, (proxies, scores) in zip(missing, loaded):
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+                    self.samplers.clear()
+                entries[key] = self.entries[key] = (mtimes[key[0]], proxies, scores)
+
+        return entries
+
+    def _entries(self, keys):
+        # 返回 keys 中各 (target, delay) 的 (target, mtime, 预先编码的代理列表, 分数列表)
+        # 需要检查的 mtime (距离上次检查超过 check_interval 秒) 和缓存中没有的代理在同一个
+        # pipeline 中读出; 只有 mtime 变化了的 (target, delay) 需要第二次往返重新读取
+        keys = [(self._normalize(target), delay) for target, delay in keys]
+        now  = time.time()
+        with self.lock:
+            stale   = sorted(set(target for target, _ in keys
+                                 if now - self.mtimes.get(target, (None, 0))[1]
+                                 >= self.check_interval))
+            missing = sorted(set(key for key in keys if key not in self.entries))
+
+        loaded = self._read(stale, missing, now) if stale or missing else {}
+        with self.lock:
+            changed = sorted(set(key for key in keys if key not in loaded and
+                                 (key not in self.entries or
+                                  self.entries[key][0] != self.mtimes.get(key[0], (None,))[0])))
+        if changed:
+            loaded.update(self._read([], changed, now))
+
+        results = [None] * len(keys)
+        lost    = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                entry = loaded.get(key) or self.entries.get(key)
+                if entry is None:
+                    lost.append(i)
+                    continue
+                results[i] = (key[0],) + entry
+                self._count(key in loaded)
+        if lost:
+            # 并发的请求可能刚刚清空了缓存，重新读取
+            loaded.update(self._read([], sorted(set(keys[i] for i in lost)), now))
+            with self.lock:
+                for i in lost:
+                    results[i] = (keys[i][0],) + loaded[keys[i]]
+                    self._count(True)
+
+        return results
+
+    def _count(self, miss):
+        if miss:
+            self.num_misses += 1
+            CACHE_REQUESTS.inc(result='miss')
+        else:
+            self.num_hits += 1
+            CACHE_REQUESTS.inc(result='hit')
+
+    def _entry(self, target, delay):
+        # 返回 (target, mtime, 预先编码的代理列表, 分数列表)
+        return self._entries([(target, delay)])[0]
+
+    def _sampler(self, delay, entry):
+        target, mtime, proxies, scores = entry
+        key = (target, delay)
+        with self.lock:
+            cached = self.samplers.get(key)
+            if cached is not None and cached[0] == mtime:
+                return target, mtime, cached[1]
+
+        # 建表是 O(N)，在锁外进行; 并发的请求可能各建一次，结果相同
+        sampler = weighted.WeightedSampler(proxies, weighted.weights(
+            scores, kind=self.weight, temperature=self.temperature))
+        with self.lock:
+            self.samplers[key] = (mtime, sampler)
+
+        return target, mtime, sampler
+
+    def _sample(self, num, delay, select, entry):
+        # 从 entry 的代理中抽取至多 num 个，返回 (target, mtime, 预先编码的代理列表)
+        if select == 'weighted':
+            target, mtime, sampler = self._sampler(delay, entry)
+            return target, mtime, sampler.sample(num)
+
+        target, mtime, proxies, scores = entry
+        if len(proxies) > num:
+            proxies = random.sample(proxies, num)
+        else:
+            proxies = list(proxies)
+            random.shuffle(proxies)
+        return target, mtime, proxies
+
+    @staticmethod
+    def _status(name, target):
+        return 'success' if target == str(name).upper() else 'success-partial'
+
+    def _render(self, name, target, mtime, proxies):
+        return ('{"status": "%s", "proxylist": {"num": %d, "mtime": %d, '
+                '"target": %s, "proxies": [%s]}}'
+                % (self._status(name, target), len(proxies), mtime, json.dumps(name),
+                   ', '.join(proxies)))
+
+    def render(self, target, num, delay, select='random'):
+        """
+        Return the json response of /proxylist as a str, proxies are
+        sampled uniformly if 'select' is 'random', or weighted by their
+        scores if it's 'weighted'.
+        """
+        if select not in ('random', 'weighted'):
+            raise ValueError('Unknown select %r' % (select,))
+        return self._render(target, *self._sample(num, delay, select,
+                                                  self._entry(target, delay)))
+
+    def _sections(self, specs, select):
+        # 返回各 spec 的 (name, target, mtime, 预先编码的代理列表)，redis 只读一次
+        if select not in ('random', 'weighted'):
+            raise ValueError('Unknown select %r' % (select,))
+        entries = self._entries([(target, delay) for target, num, delay in specs])
+        return [(name,) + self._sample(num, delay, select, entry)
+                for (name, num, delay), entry in zip(specs, entries)]
+
+    def render_many(self, specs, select='random'):
+        """
+        Return the json response of /proxylist/batch as a str, 'specs'
+        is a list of (target, num, delay), all of them are read from
+        the cache or redis in one round trip.
+        """
+        return ('{"status": "success", "results": [%s]}'
+                % (', '.join(self._render(*section)
+                             for section in self._sections(specs, select)),))
+
+    def stream_many(self, specs, select='random'):
+        """
+        Return an iterator of the NDJSON lines of /proxylist/batch: a
+        header line for each spec followed by a line for each proxy.
+        The proxies are read and sampled before returning.
+        """
+        return self._lines(self._sections(specs, select))
+
+    def _lines(self, sections):
+        for name, target, mtime, proxies in sections:
+            label = json.dumps(name)
+            yield ('{"status": "%s", "target": %s, "mtime": %d, "num": %d}\n'
+                   % (self._status(name, target), label, mtime, len(proxies)))
+            for proxy in proxies:
+                yield '{"target": %s, "proxy": %s}\n' % (label, proxy)
+
+    def invalidate(self, targets=None):
+        """Drop the cache of 'targets', all targets if it's None"""
+        with self.lock:
+            for entries in (self.entries, self.samplers):
+                for key in list(entries):
+                    if targets is None or key[0] in targets:
+                        del entries[key]
+            for target in list(self.mtimes):
+                if targets is None or target in targets:
+                    del self.mtimes[target]
+
+    def add_listener(self, listener):
+        """
+        Call 'listener' with {target: mtime} on each mtime published on
+        the channel, or with None after (re)subscribing since messages
+        may have been missed. It's called in the listening thread.
+        """
+        self.listeners.append(listener)
+
+    @property
+    def listening(self):
+        return self.thread is not None
+
+    def _notify(self, mtimes):
+        for listener in self.listeners:
+            try:
+                listener(mtimes)
+            except Exception as e:
+                logging.error('Error when notifying %r: %r' % (listener, e))
+
+    def listen(self, channel):
+        """Invalidate the cache on messages of redis 'channel' in a background thread"""
+        # SQLite 后端没有 pubsub，只检查 mtime
+        if not channel or self.thread is not None or not hasattr(self.proxypool.rdb, 'pubsub'):
+            return
+
+        self.thread = threading.Thread(target=self._listen, args=(channel,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _listen(self, channel):
+        while True:
+            try:
+                pubsub = self.proxypool.rdb.pubsub()
+                pubsub.subscribe(channel)
+                # 重新订阅期间可能错过了通知
+                self.invalidate()
+                self._notify(None)
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    # 'ALL 58' 是一轮检测结束，丢弃缓存; 'ALL:1394069400' 是检测中 mtime 的变化，
+                    # 缓存仍按 check_interval 检查 mtime，只通知 listeners
+                    targets = []
+                    mtimes  = {}
+                    for item in message['data'].decode('utf-8').split():
+                        target, _, mtime = item.partition(':')
+                        if mtime:
+                            mtimes[target] = int(mtime)
+                        else:
+                            targets.append(target)
+                    if targets:
+                        self.invalidate(targets)
+                        logging.debug('Invalidated the cache of %s' % (targets,))
+                    if mtimes:
+                        self._notify(mtimes)
+            except Exception as e:
+                logging.error('Error when listening on %s: %r' % (channel, e))
+                time.sleep(self.check_interval)
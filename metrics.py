@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""进程内的计数器、gauge 和直方图，以 Prometheus 的文本格式输出.
+
+NOTE:
+  + 各模块在模块级通过 REGISTRY.counter()/gauge()/histogram() 定义指标，
+    更新时只在内存中加锁计数，不访问 redis
+  + 抓取、检测在 proxypool 进程中，/proxylist 在 server.py 的各 worker 中，它们的指标不在
+    同一个进程里; 各进程定期把 snapshot() 写入 redis 的 hash METRICS.HASH，field 是进程的名字，
+    /metrics 读出全部快照后由 render() 合并成一份输出
+  + 只输出有样本的指标，例如 worker 中不会输出从未更新过的抓取阶段的指标
+"""
+
+import json
+import time
+import threading
+import contextlib
+
+
+# 请求、redis 往返等的耗时分布，单位 s
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter(object):
+    """只增不减的计数"""
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name   = name
+        self.help   = help
+        self.lock   = threading.Lock()
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(key), value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """可增可减的当前值，例如队列长度"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_key(labels)] = value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(object):
+    """按 buckets 统计的分布"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name    = name
+        self.help    = help
+        self.buckets = tuple(buckets)
+        self.lock    = threading.Lock()
+        self.values  = {}    # labels -> [各 bucket 的计数, 总和, 总数]
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the with block"""
+        time_start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - time_start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (buckets, total, count) in self.values.items():
+                labels = dict(key)
+                for bound, num in zip(self.buckets, buckets):
+                    samples.append((self.name + '_bucket', dict(labels, le=repr(float(bound))),
+                                    num))
+                samples.append((self.name + '_bucket', dict(labels, le='+Inf'), count))
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, count))
+        return samples
+
+
+class Registry(object):
+    """进程内的所有指标.
+    """
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, help, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, *args)
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def snapshot(self, **labels):
+        """
+        Return the samples of all metrics as a json-serializable dict,
+        'labels' are added to every sample.
+        """
+        families = {}
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            samples = metric.samples()
+            if not samples:
+                continue
+            families[metric.name] = {
+                'kind': metric.kind,
+                'help': metric.help,
+                'samples': [[name, dict(sample_labels, **labels), value]
+                            for name, sample_labels, value in samples],
+            }
+
+        return {'time': time.time(), 'families': families}
+
+    def publish(self, rdb, name, source, **labels):
+        """Write snapshot(**labels) into field 'source' of redis hash 'name'"""
+        rdb.hset(name, source, json.dumps(self.snapshot(**labels)))
+
+
+def load_snapshots(values, max_age=None):
+    """
+    Parse the snapshots read from redis ('values' is a list of json strings),
+    snapshots older than 'max_age' seconds are dropped.
+    """
+    now       = time.time()
+    snapshots = []
+    for value in values:
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        snapshot = json.loads(value)
+        if max_age is not None and now - snapshot['time'] > max_age:
+            continue
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                                              .replace('"', '\\"'))
+                              for name, value in sorted(labels.items())),)
+
+
+def render(snapshots):
+    """Merge 'snapshots' and return them in the Prometheus text format"""
+    families = {}
+    for snapshot in snapshots:
+        for name, family in snapshot['families'].items():
+            merged = families.setdefault(name, {'kind': family['kind'], 'help': family['help'],
+                                                'samples': []})
+            merged['samples'].extend(family['samples'])
+
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append('# HELP %s %s' % (name, family['help']))
+        lines.append('# TYPE %s %s' % (name, family['kind']))
+        for sample_name, labels, value in family['samples']:
+            lines.append('%s%s %s' % (sample_name, _format_labels(labels), repr(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# 多个模块共用的 redis 往返耗时
+REDIS_SECONDS = REGISTRY.histogram('proxypool_redis_seconds',
+                                   'Round-trip time of redis calls by operation')
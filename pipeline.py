@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""抓取、匿名检测和可用性检测以流水线方式运行.
+
+NOTE:
+  + fetch_proxies、filter_anony、valid_active 依次运行时，每一步都要等上一步全部完成，
+    一个慢的代理网站会推迟所有代理的检测; 流水线中:
+    - 每个页面解析完后，其中需要检测匿名的代理立即进入匿名检测队列
+    - 每个代理被判断为匿名后立即进入可用性检测队列
+    - 已有的匿名代理 (sproxy_anon) 也进入可用性检测队列，每个代理在一轮中只检测一次
+  + 两个队列都有长度上限 (PIPELINE.FILTER_QUEUE、PIPELINE.VALID_QUEUE)，队列满时上游阻塞，
+    内存占用与代理数无关
+  + 匿名检测和可用性检测各有固定数目的线程 (CONCURRENT.PROXY_FILTER、PROXY_VALID)，
+    开启 ADAPTIVE 时同样由 AIMD 限制并发数; 流水线总是使用 thread 方式，不使用 CONCURRENT.MODE
+  + 检测结果由 BatchWriter 在 STORE.BATCH_DELAY 内写入，handler 在 CACHE.CHECK_INTERVAL 内
+    读到新的 mtime，新的可用代理在几秒内就能被取到，不用等到一轮结束
+"""
+
+import time
+import queue
+import logging
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import metrics
+import proxyaddr
+import siteparser
+from proxypool import STAGE_PENDING, STAGE_SECONDS
+
+
+PIPELINE_QUEUE = metrics.REGISTRY.gauge(
+    'proxypool_pipeline_queue', 'Proxies waiting in each queue of the pipeline')
+FIRST_USABLE   = metrics.REGISTRY.gauge(
+    'proxypool_pipeline_first_usable_seconds',
+    'Seconds from the start of the last pipeline round to its first usable proxy')
+
+# 通知下游线程结束
+_DONE = object()
+
+
+class Pipeline(object):
+    """一轮流水线.
+    """
+    def __init__(self, proxypool, filter_queue=1000, valid_queue=500):
+        self.proxypool    = proxypool
+        self.filter_queue = queue.Queue(maxsize=filter_queue)
+        self.valid_queue  = queue.Queue(maxsize=valid_queue)
+
+        self.lock       = threading.Lock()
+        self.crawled    = proxyaddr.ProxyIndex()    # 本轮抓取到的代理
+        self.filtering  = set()    # 本轮进入匿名检测的代理
+        self.validating = set()    # 本轮进入可用性检测的代理
+        self.time_start = None
+        self.first_ok   = None    # 本轮第一个可用代理的耗时
+
+        # 统计各阶段处理的代理数
+        self.num_crawled   = 0
+        self.num_filtered  = 0
+        self.num_validated = 0
+
+    def run(self):
+        """Run one round, return the stats of the round"""
+        proxypool       = self.proxypool
+        self.time_start = time.time()
+        proxypool.ip_local      = proxypool.get_ip_local()
+        proxypool.health        = {}
+        proxypool.score_records = {}
+
+        # 可用性检测的线程共用一个访问各 target 的线程池，见 ProxyPool._probe_round
+        with proxypool._probe_round():
+            filters = [self._start(self._filter_worker)
+                       for _ in range(proxypool.tnum_proxy_filter)]
+            valids  = [self._start(self._valid_worker)
+                       for _ in range(proxypool.tnum_proxy_valid)]
+
+            # 已有的匿名代理与新抓取的代理同时检测可用性
+            anonymous = self._start(self._feed_anonymous)
+
+            try:
+                self._crawl()
+            finally:
+                # 抓取出错时也要让下游线程结束
+                for _ in filters:
+                    self.filter_queue.put(_DONE)
+                for thread in filters + [anonymous]:
+                    thread.join()
+
+                for _ in valids:
+                    self.valid_queue.put(_DONE)
+                for thread in valids:
+                    thread.join()
+
+        proxypool.writer.close()
+        proxypool._close_sessions('crawl')
+        proxypool._close_sessions('filter')
+        proxypool._report_dedup(self.crawled)
+        proxypool._report_evicted('valid')
+        proxypool._publish_updated()
+        STAGE_SECONDS.observe(time.time() - self.time_start, stage='pipeline')
+        proxypool._publish_metrics()
+
+        stats = {
+            'crawled': self.num_crawled,
+            'filtered': self.num_filtered,
+            'validated': self.num_validated,
+            'seconds': time.time() - self.time_start,
+            'first_usable': self.first_ok,
+        }
+        logging.info('Pipeline round finished: %s' % (stats,))
+
+        return stats
+
+    def _start(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _crawl(self):
+        # 与 ProxyPool._crawl_proxies_sites 相同，抓取和解析分离; 抓取到的页面和解析完的结果
+        # 都放入 events，哪个先到先处理，慢的站点不会推迟其他页面中的代理; 解析完就把其中
+        # 需要检测匿名的代理放入匿名检测队列，队列满时在这里阻塞
+        proxypool = self.proxypool
+        sites     = proxypool.configs['PROXY_SITES']
+        events    = queue.Queue()
+        STAGE_PENDING.set(len(sites), stage='crawl')
+
+        with ThreadPoolExecutor(max_workers=proxypool.tnum_proxy_getter) as fetcher, \
+             ProcessPoolExecutor(max_workers=proxypool.pnum_proxy_parser) as parser:
+            for url, val in sites.items():
+                fetcher.submit(proxypool._fetch_page, url, val['proxies'], events)
+
+            num_fetching = len(sites)
+            num_parsing  = 0
+            while num_fetching or num_parsing:
+                event = events.get()
+                if isinstance(event, concurrent.futures.Future):
+                    num_parsing -= 1
+                    STAGE_PENDING.dec(stage='crawl')
+                    try:
+                        url, proxies = event.result()
+                    except Exception as e:
+                        logging.error('Error when parsing: %r' % (e,))
+                        continue
+                    self._crawled(url, proxies)
+                    continue
+
+                url, text = event
+                num_fetching -= 1
+                if text is None:
+                    STAGE_PENDING.dec(stage='crawl')
+                    continue
+                future = parser.submit(siteparser.parse_page, url, sites[url]['rules'], text)
+                future.add_done_callback(events.put)
+                num_parsing += 1
+
+    def _crawled(self, url, proxies):
+        proxypool = self.proxypool
+        new = [proxy.encode('utf-8')
+               for proxy in proxypool._save_crawled(url, proxies, self.crawled)]
+        with self.lock:
+            self.num_crawled += len(new)
+
+        expired = proxypool._expired_anony(new)
+        with self.lock:
+            self.filtering.update(expired)
+        for proxy in expired:
+            STAGE_PENDING.inc(stage='filter')
+            PIPELINE_QUEUE.inc(queue='filter')
+            self.filter_queue.put(proxy)
+
+    def _feed_anonymous(self):
+        # 已有的匿名代理中本轮不需要重新检测匿名的，直接检测可用性
+        proxypool = self.proxypool
+        for proxy in proxypool.rdb.smembers(proxypool.sproxy_anon):
+            with self.lock:
+                if proxy in self.filtering:
+                    continue
+            self._enqueue_valid(proxy)
+
+    def _enqueue_valid(self, proxy):
+        with self.lock:
+            if proxy in self.validating:
+                return
+            self.validating.add(proxy)
+        STAGE_PENDING.inc(stage='valid')
+        PIPELINE_QUEUE.inc(queue='valid')
+        self.valid_queue.put(proxy)
+
+    def _filter_worker(self):
+        proxypool = self.proxypool
+        limiter   = proxypool.stage_limiters.get('filter')
+        while True:
+            proxy = self.filter_queue.get()
+            if proxy is _DONE:
+                return
+            PIPELINE_QUEUE.dec(queue='filter')
+
+            try:
+                is_anony = proxypool._limited(limiter, lambda is_anony: is_anony is not None,
+                                              proxypool._valid_anony, proxy)
+            except Exception as e:
+                logging.error('Error when checking anonymous %s: %r' % (proxy, e))
+                continue
+            with self.lock:
+                self.num_filtered += 1
+            if is_anony:
+                self._enqueue_valid(proxy)
+
+    def _valid_worker(self):
+        proxypool = self.proxypool
+        limiter   = proxypool.stage_limiters.get('valid')
+        while True:
+            proxy = self.valid_queue.get()
+            if proxy is _DONE:
+                return
+            PIPELINE_QUEUE.dec(queue='valid')
+
+            try:
+                # 每个代理检测前单独读出它的健康状况和历史记录
+                health, records = proxypool._load_states([proxy], time.time())
+                proxypool.health.update(health)
+                proxypool.score_records.update(records)
+                timings = proxypool._limited(
+                    limiter, lambda timings: any(timing.ok for timing in timings.values()),
+                    proxypool._efficiency_proxy, proxy)
+            except Exception as e:
+                logging.error('Error when validating %s: %r' % (proxy, e))
+                continue
+
+            with self.lock:
+                self.num_validated += 1
+                if self.first_ok is None and any(timing.ok for timing in timings.values()):
+                    self.first_ok = time.time() - self.time_start
+                    FIRST_USABLE.set(self.first_ok)
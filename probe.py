@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""通过代理访问目标站点，边读边检查 body，尽早结束.
+
+NOTE:
+  + 只读到 TARGET 的 VALIDATE 标记或 </title> 出现为止，不下载、不解析整个页面:
+    - 先出现 VALIDATE 标记: 检测成功
+    - 先出现 </title>: 代理返回的不是目标站点的页面 (例如被劫持)，检测失败
+    - 读了 MAX_SCAN 字节或 body 结束仍都没有出现: 检测失败
+  + VALIDATE 标记分别按 utf-8 和 gbk 编码查找，目标站点可能使用其中任何一种
+  + 分别记录建立连接、收到响应第一行 (TTFB) 和找到标记的耗时，都从开始连接时算起
+  + 读到一半就结束的连接不能复用，检测后关闭
+"""
+
+import time
+import socket
+import http.client
+import collections
+from urllib.parse import urlsplit
+
+
+# 最多读取的 body 长度
+MAX_SCAN = 256 * 1024
+
+# 一次检测的结果，ok 表示检测成功，各耗时单位是 s，没有到达该阶段时是 None
+Timing = collections.namedtuple('Timing', ['ok', 'connect', 'ttfb', 'total'])
+
+
+def markers(val):
+    """Return the encodings of the VALIDATE string 'val' to look for"""
+    found = []
+    for encoding in ('utf-8', 'gbk'):
+        try:
+            marker = val.encode(encoding)
+        except UnicodeEncodeError:
+            continue
+        if marker not in found:
+            found.append(marker)
+    return found
+
+
+class Scanner(object):
+    """在分块到达的 body 中查找 VALIDATE 标记和 </title>.
+    """
+    ENDS = (b'</title>', b'</TITLE>')
+
+    def __init__(self, val):
+        self.markers = markers(val)
+        self.keep    = max(len(marker) for marker in self.markers + list(self.ENDS)) - 1
+        self.tail    = b''
+        self.size    = 0
+        self.found   = None    # True: 找到了标记，False: title 结束仍没有找到
+
+    def feed(self, chunk):
+        """Scan 'chunk', return True if no more data needs reading"""
+        data       = self.tail + chunk
+        self.size += len(chunk)
+        if any(marker in data for marker in self.markers):
+            self.found = True
+        elif any(end in data for end in self.ENDS):
+            self.found = False
+        else:
+            # 保留末尾，标记可能跨越两个块
+            self.tail = data[-self.keep:] if self.keep else b''
+
+        return self.found is not None or self.size >= MAX_SCAN
+
+
+def probe(proxy, url, val, headers=None, timeout=10):
+    """
+    GET 'url' through 'proxy' ('http://ip:port') and look for 'val',
+    return a Timing. https urls go through a CONNECT tunnel.
+    """
+    proxy_parts = urlsplit(proxy)
+    parts       = urlsplit(url)
+    time_start  = time.time()
+    connect = ttfb = None
+
+    if parts.scheme == 'https':
+        conn = http.client.HTTPSConnection(proxy_parts.hostname, proxy_parts.port or 80,
+                                           timeout=timeout)
+        conn.set_tunnel(parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+    else:
+        conn = http.client.HTTPConnection(proxy_parts.hostname, proxy_parts.port or 80,
+                                          timeout=timeout)
+        path = url
+
+    try:
+        conn.connect()
+        connect = time.time() - time_start
+
+        conn.putrequest('GET', path, skip_host=True, skip_accept_encoding=True)
+        conn.putheader('Host', parts.netloc)
+        # 需要在本地检查内容，不接受压缩的 body
+        conn.putheader('Accept-Encoding', 'identity')
+        for key, value in (headers or {}).items():
+            if key.lower() not in ('host', 'accept-encoding', 'connection'):
+                conn.putheader(key, value)
+        conn.endheaders()
+
+        res  = conn.getresponse()
+        ttfb = time.time() - time_start
+        if res.status != 200:
+            return Timing(False, connect, ttfb, None)
+
+        scanner = Scanner(val)
+        while True:
+            chunk = res.read1(8192) if hasattr(res, 'read1') else res.read(8192)
+            if not chunk or scanner.feed(chunk):
+                break
+
+        return Timing(bool(scanner.found), connect, ttfb, time.time() - time_start)
+    except (OSError, socket.timeout, http.client.HTTPException):
+        return Timing(False, connect, ttfb, None)
+    finally:
+        conn.close()
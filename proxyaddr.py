@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""代理地址的规范化和紧凑表示.
+
+NOTE:
+  + 同一个代理在不同站点上的写法可能不同，例如 ' 010.1.2.3:80'、'http://10.1.2.3'、
+    'HTTP://10.1.2.3:80/'，规范化后都是 'http://10.1.2.3:80'，redis 中只存一份，只检测一次
+  + pack() 把 ipv4 和 port 打包成一个 int: (ip << 16) | port，去重索引中保存 int 而不是
+    bytes，每个代理约 74 字节，bytes 的 set 约 98 字节 (见 benchmarks/bench_crawl.py)
+  + 只支持 ipv4 的 http 代理，其他的 (域名、ipv6、非法端口) 视为无效，直接丢弃
+"""
+
+import threading
+
+
+def pack(proxy):
+    """
+    Return the packed int of 'proxy' ('http://ip:port', 'ip:port',
+    str or bytes), None if it isn't a valid ipv4 http proxy.
+    """
+    if isinstance(proxy, bytes):
+        proxy = proxy.decode('utf-8', 'replace')
+
+    text = proxy.strip().lower()
+    if '://' in text:
+        scheme, _, text = text.partition('://')
+        if scheme != 'http':
+            return None
+    text = text.split('/', 1)[0]
+
+    host, sep, port = text.partition(':')
+    try:
+        port = int(port) if sep else 80
+    except ValueError:
+        return None
+    if not 0 < port < 65536:
+        return None
+
+    parts = host.split('.')
+    if len(parts) != 4:
+        return None
+    try:
+        octets = [int(part) for part in parts]
+    except ValueError:
+        return None
+    ip = 0
+    for octet in octets:
+        if not 0 <= octet <= 255:
+            return None
+        ip = ip << 8 | octet
+
+    return ip << 16 | port
+
+
+def unpack(key):
+    """Return 'http://ip:port' of the packed int 'key'"""
+    ip = key >> 16
+    return 'http://%d.%d.%d.%d:%d' % (ip >> 24, ip >> 16 & 255, ip >> 8 & 255, ip & 255,
+                                      key & 0xffff)
+
+
+def normalize(proxy):
+    """Return the canonical 'http://ip:port' of 'proxy', None if it's invalid"""
+    key = pack(proxy)
+    return None if key is None else unpack(key)
+
+
+class ProxyIndex(object):
+    """一轮抓取中已经见过的代理，按 pack() 的结果去重.
+    """
+    def __init__(self):
+        self.lock           = threading.Lock()
+        self.keys           = set()
+        self.num_duplicates = 0
+        self.num_invalid    = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, proxy):
+        return pack(proxy) in self.keys
+
+    def add(self, proxy):
+        """Return the canonical form of 'proxy' if it's new, otherwise None"""
+        key = pack(proxy)
+        with self.lock:
+            if key is None:
+                self.num_invalid += 1
+                return None
+            if key in self.keys:
+                self.num_duplicates += 1
+                return None
+            self.keys.add(key)
+
+        return unpack(key)
+
+    def add_many(self, proxies):
+        """Return the canonical forms of the new proxies in 'proxies'"""
+        new = []
+        for proxy in proxies:
+            proxy = self.add(proxy)
+            if proxy is not None:
+                new.append(proxy)
+        return new
+
+    def stats(self):
+        return {'unique': len(self.keys), 'duplicates': self.num_duplicates,
+                'invalid': self.num_invalid}
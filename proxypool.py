@@ -20,63 +20,303 @@ Thinking:
   + gevent 不支持 python3.x，不能使用
   + asyncio 虽然可以用 coroutine，但由于没有配合的 http library，也不能发挥作用
   + 暂时通过多线程控制并发
+  + 检测代理时可以通过 CONCURRENT.MODE 选用 asyncio 方式，直接基于 asyncio 的 stream
+    实现 HTTP 请求，见 asyncvalid.py
 
 !!!:
   + redis 是通过 socket 连接，存在一个最大连接数问题，两种解决方法:
     - 通过 ｀ulimit -n 数字｀来解决
     - 随机 sleep 几秒后重连 redis
+    现在所有 redis 连接来自进程内共享的连接池，写操作由 BatchWriter 批量通过 pipeline
+    写入，失败时按指数退避重试，见 batchwriter.py
   + 58 和 赶集 对代理封的比较狠
 """
 
 import os
 import sys
 import time
+import queue
 import random
-import pprint
+import functools
+import itertools
+import contextlib
+import collections
 import logging
 import threading
 import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-import requests
 import yaml
 import redis
-from lxml import etree
+
+import probe
+import lease
+import proxyaddr
+import scoring
+import metrics
+import limiter
+import weighted
+import reflector
+import siteparser
+import sqlitestore
+from batchwriter import BatchWriter
+from httpsession import SessionPool
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(asctime)s][%(levelname)s] %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
 
+# redis 连接池按 db 在进程内共享，避免每个 ProxyPool 实例都新建连接池
+_connection_pools      = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(db, host='localhost', port=6379):
+    """Return the process-wide redis connection pool of 'db'"""
+    key = (host, port, db)
+    with _connection_pools_lock:
+        pool = _connection_pools.get(key)
+        if pool is None:
+            pool = redis.ConnectionPool(host=host, port=port, db=db)
+            _connection_pools[key] = pool
+
+    return pool
+
+
+# 各阶段的指标，见 metrics.py
+STAGE_SECONDS = metrics.REGISTRY.histogram(
+    'proxypool_stage_seconds', 'Duration of a crawl/filter/valid round',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+STAGE_PENDING = metrics.REGISTRY.gauge(
+    'proxypool_stage_pending', 'Sites or proxies not finished in the current round')
+CRAWL_PAGES   = metrics.REGISTRY.counter(
+    'proxypool_crawl_pages_total', 'Pages fetched by result')
+CRAWL_FETCH   = metrics.REGISTRY.histogram(
+    'proxypool_crawl_fetch_seconds', 'Time to fetch a page of proxies')
+CRAWL_PROXIES = metrics.REGISTRY.counter(
+    'proxypool_crawl_proxies_total', 'Proxies parsed from pages')
+CRAWL_DEDUP   = metrics.REGISTRY.counter(
+    'proxypool_crawl_dedup_total', 'Parsed proxies by unique, duplicate or invalid')
+FILTER_PROXIES = metrics.REGISTRY.counter(
+    'proxypool_filter_proxies_total', 'Anonymity checks by verdict')
+VALID_PROXIES = metrics.REGISTRY.counter(
+    'proxypool_valid_proxies_total', 'Proxies validated by result')
+VALID_LATENCY = metrics.REGISTRY.histogram(
+    'proxypool_valid_latency_seconds', 'Time to find the VALIDATE marker by target')
+VALID_CONNECT = metrics.REGISTRY.histogram(
+    'proxypool_valid_connect_seconds', 'Time to connect to the proxy by target')
+VALID_TTFB    = metrics.REGISTRY.histogram(
+    'proxypool_valid_ttfb_seconds', 'Time to the first byte of the response by target')
+EVICTED       = metrics.REGISTRY.counter(
+    'proxypool_evicted_total', 'Proxies evicted by reason')
+
+
+class Config(object):
+    """配置文件.
+
+    文件的 mtime 变化后才重新解析，两次检查之间至少间隔 check_interval 秒.
+    """
+    def __init__(self, configfile='settings.yaml', check_interval=1):
+        # XXX: getting the path of the configuraion file needs improving
+        self.configpath     = os.path.join('.', configfile)
+        self.check_interval = check_interval
+        self.data           = None
+        self.mtime          = None
+        self.time_checked   = 0
+
+        self.reload()
+
+    def reload(self):
+        """Parse the configuration file unconditionally"""
+        mtime = os.stat(self.configpath).st_mtime
+        with open(self.configpath, 'rb') as fp:
+            data = yaml.safe_load(fp)
+
+        self.data         = data
+        self.mtime        = mtime
+        self.time_checked = time.time()
+
+    def refresh(self):
+        """Reload the configuration if the file has changed, return True if reloaded"""
+        now = time.time()
+        if now - self.time_checked < self.check_interval:
+            return False
+
+        self.time_checked = now
+        try:
+            mtime = os.stat(self.configpath).st_mtime
+        except OSError as e:
+            logging.error('Error when checking %s: %r' % (self.configpath, e))
+            return False
+
+        if mtime == self.mtime:
+            return False
+
+        logging.info('Reload configuration file %s' % (self.configpath,))
+        self.reload()
+
+        return True
+
+
 class ProxyPool(object):
     """代理池.
     """
-    def __init__(self, configfile='settings.yaml'):
-        self.configs        = self._get_configs(configfile)
-        
-        self.rdb            = redis.StrictRedis(db=self.configs['STORE']['RDB'])
+    def __init__(self, configfile='settings.yaml', config=None):
+        self.config = config or Config(configfile)
+        self._apply_configs(self.config.data)
+
+        # 检测过程中的状态，由多个线程共享
+        self.lock_evict      = threading.Lock()
+        self.anony_dead      = {}    # 连接失败的代理的连续失败次数
+        self.anony_nonanon   = {}    # 非匿名代理第一次被检测为非匿名的时间
+        self.health          = {}    # 本轮检测的代理的健康状况
+        self.score_records   = {}    # 本轮检测的代理的历史记录，key 是 (target, proxy)
+        self.evicted         = collections.Counter()    # 本轮删除的代理数，key 是原因
+        self.evicted_proxies = set()
+        self.evicted_last    = set()    # 上一轮删除的代理
+
+        # get_many 加权抽样的 alias 表，key 是 (db, minscore, maxscore)，value 是
+        # ((mtime, 版本号), 表); SQLite 后端上随机抽样的候选代理，key 是
+        # (db, minscore, maxscore, 'random')，见 _sample_version
+        self.samplers = {}
+
+        # 一轮可用性检测中访问各 target 共用的线程池，见 _probe_round
+        self.probe_executor = None
+
+        # 各阶段复用连接的 session，每个线程一个
+        self.sessions = {}
+        for stage in ('crawl', 'filter'):
+            pool = self.configs['HTTP'][stage.upper()]
+            self.sessions[stage] = SessionPool(stage,
+                                               pool_connections=pool['POOL_CONNECTIONS'],
+                                               pool_maxsize=pool['POOL_MAXSIZE'])
+
+    def _apply_configs(self, configs):
+        # 根据配置设置各属性，redis 连接来自进程内共享的连接池
+        # 重新加载配置时，有状态的组件 (writer 和它的线程、limiter 学到的并发数、租约的脚本)
+        # 只在它们依赖的配置段变化时重建，旧的 writer 先关闭，写完缓冲的命令
+        old          = getattr(self, 'configs', None)
+        self.configs = configs
+
+        def changed(*sections):
+            return old is None or any(old.get(section) != configs.get(section)
+                                      for section in sections)
+
+        self.store_backend  = self.configs['STORE'].get('BACKEND', 'redis')
         self.try_times_db   = self.configs['STORE']['TRY']
         self.try_time_wait  = self.configs['STORE']['TIME_WAIT']
         self.sproxy_all     = self.configs['STORE']['SPROXY_ALL']
         self.sproxy_anon    = self.configs['STORE']['SPROXY_ANON']
+        if changed('STORE'):
+            if old is not None:
+                self.writer.close()
+            self.rdb    = self._open_store()
+            self.writer = BatchWriter(self.rdb,
+                                      size=self.configs['STORE']['BATCH_SIZE'],
+                                      delay=self.configs['STORE']['BATCH_DELAY'],
+                                      try_times=self.try_times_db,
+                                      time_wait=self.try_time_wait,
+                                      on_write=self._on_written)
+        self.hproxy_anony   = self.configs['ANONY']['HASH']
+        self.ttl_anony      = {
+            'anon': self.configs['ANONY']['TTL_ANON'],
+            'nonanon': self.configs['ANONY']['TTL_NONANON'],
+            'dead': self.configs['ANONY']['TTL_DEAD'],
+        }
         self.init_value     = self.configs['VALIDATE']['INIT_VALUE']
         self.timeout_valid  = self.configs['VALIDATE']['TIMEOUT_VALID']
         self.time_exception = self.configs['VALIDATE']['TIME_EXCEPTION']
         self.targets        = list(self.configs['TARGET'].keys())
+        self.mtime_targets  = dict((val['DB_MTIME'], target)
+                                   for target, val in self.configs['TARGET'].items())
         self.url_reflect    = self.configs['URL']['REFLECT']
+        self.url_local_ip   = self.configs['URL'].get('LOCAL_IP', self.url_reflect)
+        self.anony_elite    = self.configs['ANONY'].get('ELITE', False)
 
         self.tnum_proxy_getter = self.configs['CONCURRENT']['PROXY_GETTER']
         self.tnum_proxy_filter = self.configs['CONCURRENT']['PROXY_FILTER']
         self.tnum_proxy_valid  = self.configs['CONCURRENT']['PROXY_VALID']
+        self.pnum_proxy_parser = self.configs['CONCURRENT']['PROXY_PARSER']
+        self.concurrent_mode   = self.configs['CONCURRENT'].get('MODE', 'thread')
 
-    def _get_configs(self, configfile):
-        """Return the configuration dict"""
-        # XXX: getting the path of the configuraion file needs improving
-        configpath = os.path.join('.', configfile)
-        with open(configpath, 'rb') as fp:
-            configs = yaml.load(fp)
+        self.hproxy_health   = self.configs['EVICT']['HASH']
+        self.evict_stats     = self.configs['EVICT']['STATS']
+        self.evict_max_fails = self.configs['EVICT']['MAX_FAILS']
+        self.evict_max_age   = self.configs['EVICT']['MAX_AGE']
+
+        if changed('ADAPTIVE', 'CONCURRENT', 'TARGET'):
+            self._apply_adaptive(self.configs.get('ADAPTIVE') or {})
 
-        return configs
+        if changed('LEASE', 'STORE'):
+            leases = self.configs.get('LEASE') or {}
+            self.leases = lease.LeaseManager(self, ttl=leases.get('TTL', 60),
+                                             max_ttl=leases.get('MAX_TTL', 600),
+                                             scan=leases.get('SCAN', 200),
+                                             suffix=leases.get('SUFFIX', 'leases'))
+
+        select = self.configs.get('SELECT') or {}
+        self.select_weight      = select.get('WEIGHT', 'inverse')
+        self.select_temperature = select.get('TEMPERATURE', 1.0)
+
+        self.score_model = scoring.ScoreModel(alpha=self.configs['SCORE']['ALPHA'],
+                                              penalty=self.configs['SCORE']['PENALTY'],
+                                              time_exception=self.time_exception)
+
+    def _apply_adaptive(self, adaptive):
+        # 各阶段和各 target 的自适应并发数 (AIMD) 以及各 target 的请求速率上限，见 limiter.py
+        # thread 方式下各阶段的并发数不超过线程数，asyncio 方式下不超过 ASYNC_TOTAL
+        def policy(maximum, **labels):
+            return limiter.AIMD(initial=adaptive.get('INITIAL', 10),
+                                minimum=adaptive.get('MIN', 1),
+                                maximum=maximum,
+                                window=adaptive.get('WINDOW', 50),
+                                tolerance=adaptive.get('TOLERANCE', 0.1),
+                                latency=adaptive.get('LATENCY', 2),
+                                decrease=adaptive.get('DECREASE', 0.5),
+                                increase=adaptive.get('INCREASE', 5),
+                                labels=labels)
+
+        self.stage_limiters  = {}
+        self.target_limiters = {}
+        if adaptive.get('ENABLED'):
+            if self.concurrent_mode == 'asyncio':
+                maximum = {'filter': self.configs['CONCURRENT']['ASYNC_TOTAL'],
+                           'valid': self.configs['CONCURRENT']['ASYNC_TOTAL']}
+            else:
+                maximum = {'filter': self.tnum_proxy_filter, 'valid': self.tnum_proxy_valid}
+            for stage in ('filter', 'valid'):
+                self.stage_limiters[stage] = limiter.Limiter(
+                    policy(maximum[stage], stage=stage))
+            for target in self.targets:
+                self.target_limiters[target] = limiter.Limiter(
+                    policy(adaptive.get('TARGET_MAX', 50), stage='valid', target=target))
+
+        self.target_rates = {}
+        for target in self.targets:
+            rate = self.configs['TARGET'][target].get('RATE', adaptive.get('TARGET_RATE', 0))
+            self.target_rates[target] = limiter.RateLimiter(rate)
+
+    def _open_store(self):
+        # STORE.BACKEND 是 sqlite 时使用嵌入式的 SQLite (sqlitestore.py)，不需要 redis-server;
+        # 它实现了用到的 redis 命令，self.rdb 的用法与 redis 后端相同
+        if self.store_backend == 'sqlite':
+            return sqlitestore.get_store(self.configs['STORE']['PATH'])
+        if self.store_backend != 'redis':
+            raise ValueError('Unknown STORE.BACKEND %r' % (self.store_backend,))
+        return redis.StrictRedis(connection_pool=self._get_connection_pool())
+
+    def _get_connection_pool(self):
+        # redis 的地址可在 STORE 中配置，默认是本机
+        store = self.configs['STORE']
+        return get_connection_pool(store['RDB'],
+                                   host=store.get('HOST', 'localhost'),
+                                   port=store.get('PORT', 6379))
+
+    def refresh(self):
+        """Re-apply the configuration if the configuration file has changed"""
+        if self.config.refresh():
+            self._apply_configs(self.config.data)
 
     def get_mtime(self, target='all'):
         """返回代理上次更新时间"""
@@ -89,14 +329,14 @@ class ProxyPool(object):
 
         return int(mtime)
 
-    def get_many(self, target='all', num=10, minscore=0, maxscore=None):
+    def get_many(self, target='all', num=10, minscore=0, maxscore=None, select='random'):
         """
         Return a list of proxies including at most 'num' proxies
         which socres are between 'minscore' and 'mascore'.
+        Proxies are sampled uniformly if 'select' is 'random', or
+        weighted by their scores (lower is more likely) if it's 'weighted'.
         If there's no proxies matching, return an empty list.
         """
-        # XXX: 当前的策略是先从数据库中取出所有满足要求的代理，然后返回指定数目的代理.
-        #      个人觉得这种策略有待改善，还有优化的空间.
         target = str(target).upper()
         if target not in self.targets:
             target = 'ALL'
@@ -105,18 +345,138 @@ class ProxyPool(object):
         num      = num
         minscore = minscore
         maxscore = maxscore or self.init_value
-        res      = self.rdb.zrangebyscore(db, minscore, maxscore)
+        if select == 'weighted':
+            res = self._sample_weighted(target, db, num, minscore, maxscore)
+        elif select == 'random' and self.store_backend == 'sqlite':
+            res = self._sample_cached(target, db, num, minscore, maxscore)
+        elif select == 'random':
+            res = self._sample(db, num, minscore, maxscore)
+        else:
+            raise ValueError('Unknown select %r' % (select,))
         if res:
-            random.shuffle(res) # for getting random results
             if len(res) < num:
                 logging.warning("The number of proxies you want is less than %d"
                                 % (num,))
-            return [proxy for proxy in res[:num]]
+            return res
         else:
             logging.warning("There're no proxies which scores are between %d and %d"
                             % (minscore, maxscore))
             return []
 
+    def _sample(self, db, num, minscore, maxscore):
+        # 从 db 中随机取出至多 num 个分数在 [minscore, maxscore] 之间的代理
+        # 策略:
+        #     + 通过两次 zcount 得到满足要求的代理在 sorted set 中的排名区间
+        #     + 满足要求的代理不多于 num 个时，直接取出整个区间
+        #     + 否则随机选出 num 个排名，通过 zrange 按排名取出，每次是 O(log(N))
+        # 两步各用一个 pipeline，共两次 redis 往返，与 sorted set 的大小无关;
+        # 两次往返之间 sorted set 可能被更新 (检测过程中一直有批量写入)，排名会移动，
+        # 所以按排名取出时带上分数，分数不在 [minscore, maxscore] 之间的代理丢弃，
+        # 这时结果可能少于 num 个，但不会超出分数区间
+        pipe = self.rdb.pipeline(transaction=False)
+        pipe.zcount(db, '-inf', '(%s' % (minscore,))
+        pipe.zcount(db, minscore, maxscore)
+        rank_start, count = pipe.execute()
+
+        if count <= 0:
+            return []
+
+        if count <= num:
+            res = self.rdb.zrangebyscore(db, minscore, maxscore)
+            random.shuffle(res) # for getting random results
+            return res
+
+        pipe = self.rdb.pipeline(transaction=False)
+        for offset in random.sample(range(count), num):
+            rank = rank_start + offset
+            pipe.zrange(db, rank, rank, withscores=True)
+
+        minscore, maxscore = float(minscore), float(maxscore)
+        res  = []
+        seen = set()
+        for members in pipe.execute():
+            for member, score in members:
+                if minscore <= score <= maxscore and member not in seen:
+                    seen.add(member)
+                    res.append(member)
+
+        return res
+
+    def _sample_version(self, target):
+        # 返回 target 的 (mtime, 版本号)，一次 redis 往返; 缓存的抽样表以此判断是否过期.
+        # mtime 只精确到秒，同一秒内的两次写入 mtime 相同，所以每次更新分数或删除代理时
+        # 还会增加版本号 (见 _save_timings、_evict 和 lease.py); 新的数据库中都没有时是 0
+        mtime, version = self.rdb.mget(self.configs['TARGET'][target]['DB_MTIME'],
+                                       self._version_key(target))
+        return int(mtime or 0), int(version or 0)
+
+    def _version_key(self, target):
+        # target 的 sorted set 的版本号
+        return '%s:version' % (self.configs['TARGET'][target]['DB_PROXY'],)
+
+    def _sample_cached(self, target, db, num, minscore, maxscore):
+        # SQLite 后端上 zcount 和按排名的 zrange 都是 O(N)，不能按排名抽样; 分数区间内的代理
+        # 与加权抽样的 alias 表一样缓存在 samplers 中，target 的 (mtime, 版本号) 变化后才重新
+        # 读取，否则每次只需读一次 mtime 和版本号，没有网络往返
+        key     = (db, minscore, maxscore, 'random')
+        version = self._sample_version(target)
+        entry   = self.samplers.get(key)
+        if entry is None or entry[0] != version:
+            members = self.rdb.zrangebyscore(db, minscore, maxscore)
+            if len(self.samplers) >= 256:
+                self.samplers.clear()
+            self.samplers[key] = entry = (version, members)
+
+        members = entry[1]
+        return random.sample(members, min(num, len(members)))
+
+    def _sample_weighted(self, target, db, num, minscore, maxscore):
+        # 按分数加权不放回地取出至多 num 个代理，见 weighted.py
+        # 分数区间内的代理和 alias 表缓存在 samplers 中，target 的 (mtime, 版本号) 变化后才
+        # 重新读取、建表; 否则每次只需一次 mget 读 mtime 和版本号，抽样是 O(num)
+        key     = (db, minscore, maxscore)
+        version = self._sample_version(target)
+        entry   = self.samplers.get(key)
+        if entry is None or entry[0] != version:
+            members = self.rdb.zrangebyscore(db, minscore, maxscore, withscores=True)
+            sampler = weighted.WeightedSampler(
+                [proxy for proxy, score in members],
+                weighted.weights([score for proxy, score in members],
+                                 kind=self.select_weight, temperature=self.select_temperature))
+            if len(self.samplers) >= 256:
+                self.samplers.clear()
+            self.samplers[key] = entry = (version, sampler)
+
+        return entry[1].sample(num)
+
+    def checkout(self, target='all', num=10, minscore=0, maxscore=None, ttl=None):
+        """
+        Lease at most 'num' proxies which scores are between 'minscore'
+        and 'maxscore' for 'ttl' seconds (LEASE.TTL by default), leased
+        proxies aren't handed out again until released or expired.
+        Return (target, token, expires, [proxy, ...]), see lease.py.
+        """
+        target = str(target).upper()
+        if target not in self.targets:
+            target = 'ALL'
+
+        maxscore = maxscore or self.init_value
+        token, expires, proxies = self.leases.checkout(target, num, minscore, maxscore, ttl)
+
+        return target, token, expires, proxies
+
+    def release(self, token, proxies, target='all', outcome=None, latency=None):
+        """
+        Release 'proxies' leased with 'token', 'outcome' ('ok' or 'failed')
+        and 'latency' reported by the client update their scores.
+        Return the proxies released.
+        """
+        target = str(target).upper()
+        if target not in self.targets:
+            target = 'ALL'
+
+        return self.leases.release(target, token, proxies, outcome=outcome, latency=latency)
+
     def get_one(self, target='all', minscore=0, maxscore=None):
         """
         Return one proxy which score is between 'minscore'
@@ -140,64 +500,100 @@ class ProxyPool(object):
 
     def _crawl_proxies_sites(self):
         """Get proxies from web pages."""
-        with ThreadPoolExecutor(max_workers=self.tnum_proxy_getter) as executor:
-            for url, val in self.configs['PROXY_SITES'].items():
-                executor.submit(self._crawl_proxies_one_site, url, val['rules'], val['proxies'])
-        
-    def _crawl_proxies_one_site(self, url=None, rules=None, proxies=None):
-        # Get proxies (ip:port) from url and then write them into redis.
-        # XXX: 抓取和解析分离
-        url     = url
-        rules   = rules
-        proxies = proxies
+        # 抓取和解析分离: 多个线程抓取页面后放入 pages 队列，页面在进程池中解析
+        sites = self.configs['PROXY_SITES']
+        pages = queue.Queue()
+        index = proxyaddr.ProxyIndex()
+        time_start = time.time()
+        STAGE_PENDING.set(len(sites), stage='crawl')
+
+        with ThreadPoolExecutor(max_workers=self.tnum_proxy_getter) as fetcher, \
+             ProcessPoolExecutor(max_workers=self.pnum_proxy_parser) as parser:
+            for url, val in sites.items():
+                fetcher.submit(self._fetch_page, url, val['proxies'], pages)
+
+            futures = []
+            for _ in range(len(sites)):
+                url, text = pages.get()
+                if text is not None:
+                    futures.append(parser.submit(siteparser.parse_page, url,
+                                                 sites[url]['rules'], text))
+                else:
+                    STAGE_PENDING.dec(stage='crawl')
+
+            for future in concurrent.futures.as_completed(futures):
+                STAGE_PENDING.dec(stage='crawl')
+                try:
+                    url, proxies = future.result()
+                except Exception as e:
+                    logging.error('Error when parsing: %r' % (e,))
+                    continue
+                self._save_crawled(url, proxies, index)
+
+        self.writer.close()
+        self._close_sessions('crawl')
+        self._report_dedup(index)
+        STAGE_SECONDS.observe(time.time() - time_start, stage='crawl')
+        self._publish_metrics()
+
+    def _fetch_page(self, url, proxies, pages):
+        # 抓取 url 的页面，(url, 页面) 放入 pages，失败时页面是 None
         headers = self.configs['CRAWL']['HEADERS']
         logging.info('Begin crawl page %s' % (url,))
-        
-        res       = requests.get(url, headers=headers, proxies=proxies)
-        encoding  = res.encoding
-        html      = etree.HTML(res.text)
-        proxies   = []
-        len_rules = len(rules)
-
-        nodes = html.xpath(rules[0])
-        if nodes:
-            if len_rules == 1:
-                for node in nodes:
-                    text = node.text.strip()
-                    if text:
-                        proxies.append('http://%s' % (text,))
-            elif len_rules == 2:
-                rule_1     = rules[1].split(',')
-                rule_1_len = len(rule_1)
-
-                if rule_1_len == 3:
-                    for node in nodes:
-                        try:
-                            node = node.xpath(rule_1[0])
-                            ip   = node[1].text.strip()
-                            port = node[2].text.strip() or '80'
-                            if ip:
-                                proxies.append('http://%s:%s' % (ip, port))
-                        except Exception as e:
-                            logging.error('Error when parsing %s: %r' % (url, e))
-                elif rule_1_len == 4:
-                    for node in nodes:
-                        try:
-                            ip        = node.xpath(rule_1[0])[0].text.strip()
-                            port      = node.xpath(rule_1[1])[0].text.strip()
-                            is_niming = node.xpath(rule_1[2])[0].text.strip().encode('utf-8')
-                            dec       = rule_1[-1].encode('utf-8')
-
-                            if dec == b'proxy360' and ip and is_niming == '高匿':
-                                proxies.append('http://%s:%s' % (ip, port))
-                            elif dec == b'cn-proxy' and ip and is_niming == '高度匿名':
-                                proxies.append('http://%s:%s' % (ip, port))
-                        except Exception as e:
-                            logging.error('Error when parsing %s: %r' % (url, e))
-
-        for proxy in proxies:
-            logging.info('Got proxy %s from %s' % (proxy, url))
-            self.rdb.sadd(self.sproxy_all, proxy)
+
+        time_start = time.time()
+        try:
+            res  = self.sessions['crawl'].get().get(url, headers=headers, proxies=proxies)
+            text = res.text
+            CRAWL_PAGES.inc(result='ok')
+        except Exception as e:
+            logging.error('Error when crawling %s: %r' % (url, e))
+            text = None
+            CRAWL_PAGES.inc(result='error')
+        CRAWL_FETCH.observe(time.time() - time_start)
+
+        pages.put((url, text))
+
+    def _crawl_proxies_one_site(self, url=None, rules=None, proxies=None, index=None):
+        # Get proxies (ip:port) from url and then write them into redis.
+        # 返回规范化后的新代理，index 见 _save_crawled
+        pages = queue.Queue()
+        self._fetch_page(url, proxies, pages)
+
+        url, text = pages.get()
+        if text is None:
+            return []
+
+        url, proxies = siteparser.parse_page(url, rules, text)
+
+        return self._save_crawled(url, proxies, index)
+
+    def _save_crawled(self, url, proxies, index=None):
+        # 保存从 url 抓取到的代理，返回规范化后的新代理
+        # 代理先规范化成 'http://ip:port'，同一轮中已经从其他站点得到的 (index 中已有的)
+        # 和无效的代理直接丢弃，不写入 redis，也不会被检测，见 proxyaddr.py
+        CRAWL_PROXIES.inc(len(proxies))
+        if index is None:
+            index = proxyaddr.ProxyIndex()
+        duplicates, invalid = index.num_duplicates, index.num_invalid
+        new = index.add_many(proxies)
+        CRAWL_DEDUP.inc(len(new), result='unique')
+        CRAWL_DEDUP.inc(index.num_duplicates - duplicates, result='duplicate')
+        CRAWL_DEDUP.inc(index.num_invalid - invalid, result='invalid')
+
+        for proxy in new:
+            logging.debug('Got proxy %s from %s' % (proxy, url))
+            self.writer.add('sadd', self.sproxy_all, proxy)
+
+        return new
+
+    def _report_dedup(self, index):
+        # 记录本轮去重节省的写入和检测
+        stats = index.stats()
+        logging.info('Crawled %d unique proxies, dropped %d duplicates and %d invalid'
+                     % (stats['unique'], stats['duplicates'], stats['invalid']))
+
+        return stats
 
     def get_ip_local(self):
         # 获取本机出口 ip，最多尝试三次，若尝试后都不能获得，就结束整个程序，因为后续不能保证
@@ -207,11 +603,10 @@ class ProxyPool(object):
         for times_try in range(try_times):
             try:
                 headers = self.configs['CRAWL']['HEADERS']
-                res     = requests.get(self.url_reflect, headers=headers, timeout=timeout)
-                
-                ip_local = res.text.split(':')[-1].split("\n")[0].strip().split('"')[1]
+                session = self.sessions['filter'].get()
+                res     = session.get(self.url_local_ip, headers=headers, timeout=timeout)
 
-                return ip_local
+                return reflector.parse_ip(res.text)
             except Exception:
                 logging.debug('Times of trying to get local ip: %d' % (times_try+1,))
         else:
@@ -231,112 +626,451 @@ class ProxyPool(object):
 
         self.ip_local = self.get_ip_local()
         proxies = self.rdb.smembers(self.sproxy_all)
-        self._filter_anony(proxies)
+        self._filter_anony(self._expired_anony(proxies))
+
+    def _expired_anony(self, proxies, now=None):
+        # 返回 proxies 中需要重新检测匿名的代理: 没有检测过或检测结果已过期的
+        # 检测结果存储在 hash ANONY.HASH 中，value 格式是 b'结果:检测时间'，结果是
+        # anon (匿名)、nonanon (非匿名) 或 dead (连接失败)，各自的有效期见 ANONY
+        # 连接失败时 value 是 b'dead:检测时间:连续失败次数'，非匿名时是
+        # b'nonanon:检测时间:第一次检测为非匿名的时间'
+        now     = now or time.time()
+        proxies = list(proxies)
+
+        expired = []
+        for proxy, verdict in zip(proxies, self._hmget(self.hproxy_anony, proxies)):
+            if verdict:
+                fields = verdict.decode('utf-8').split(':')
+                if now - float(fields[1]) < self.ttl_anony.get(fields[0], 0):
+                    continue
+                if fields[0] == 'dead' and len(fields) > 2:
+                    with self.lock_evict:
+                        self.anony_dead[proxy] = int(fields[2])
+                elif fields[0] == 'nonanon' and len(fields) > 2:
+                    with self.lock_evict:
+                        self.anony_nonanon[proxy] = float(fields[2])
+            expired.append(proxy)
+
+        logging.info('%d of %d proxies need checking anonymous'
+                     % (len(expired), len(proxies)))
+
+        return expired
         
+    def _hmget(self, name, keys):
+        # 分批通过一个 pipeline 取出 hash 中 keys 对应的值
+        pipe = self.rdb.pipeline(transaction=False)
+        for i in range(0, len(keys), 1000):
+            pipe.hmget(name, keys[i:i + 1000])
+
+        with metrics.REDIS_SECONDS.time(op='hmget'):
+            values = pipe.execute()
+
+        return list(itertools.chain(*values))
+
     def _filter_anony(self, proxies):
         # 把 proxies 中的匿名代理找出来，proxies 格式是 ['ip:port', 'ip:port', ...]
-        with ThreadPoolExecutor(max_workers=self.tnum_proxy_filter) as executor:
-            for proxy in proxies:
-                executor.submit(self._valid_anony, proxy)
+        time_start = time.time()
+        STAGE_PENDING.set(len(proxies), stage='filter')
+        if self.concurrent_mode == 'asyncio':
+            validator = self._get_async_validator()
+            validator.filter_anony(proxies, self.url_reflect, self._judge_anony,
+                                   self._save_anony)
+        else:
+            with ThreadPoolExecutor(max_workers=self.tnum_proxy_filter) as executor:
+                for proxy in proxies:
+                    executor.submit(self._limited, self.stage_limiters.get('filter'),
+                                    lambda is_anony: is_anony is not None,
+                                    self._valid_anony, proxy)
+
+        self.writer.close()
+        self._close_sessions('filter')
+        self._report_evicted('filter')
+        STAGE_SECONDS.observe(time.time() - time_start, stage='filter')
+        self._publish_metrics()
 
     def _valid_anony(self, proxy):
-        # 判断该 proxy 是否是 http 匿名代理，参数 proxy 格式是 'http://ip:port'
+        # 判断该 proxy 是否是 http 匿名代理，参数 proxy 格式是 'http://ip:port'，
+        # 返回检测结果，连接失败时是 None
         # 策略:
         #     + 若是匿名代理，则加入到 sproxy_anon
-        #     + 若非匿名代理，则从 sproxy_anon 删除 (不存在时删除没有影响)
+        #     + 若非匿名代理，则从 sproxy_anon 和各 target 中删除 (不存在时删除没有影响)
         proxies = {
             'http': proxy.decode('utf-8'),
         }
         
         try:
             headers = self.configs['CRAWL']['HEADERS']
-            res = requests.get(self.url_reflect, headers=headers, proxies=proxies, timeout=10)
+            session = self.sessions['filter'].get()
+            res = session.get(self.url_reflect, headers=headers, proxies=proxies, timeout=10)
         except Exception as e:
-            logging.error('Error when validating anonymous: %r' % (e,))
+            logging.debug('Error when validating anonymous: %r' % (e,))
+            self._save_anony(proxy, None)
+            return None
+        if res.status_code != 200:
+            # 代理返回的错误页面不是 reflect 的响应，与连接失败一样处理
+            logging.debug('Status %d when validating anonymous' % (res.status_code,))
+            self._save_anony(proxy, None)
+            return None
+
+        is_anony = self._judge_anony(res.text)
+        self._save_anony(proxy, is_anony)
+
+        return is_anony
+
+    def _judge_anony(self, body):
+        # 根据 reflect 服务的响应判断代理是否匿名，见 reflector.py
+        try:
+            return reflector.is_anonymous(body, self.ip_local, elite=self.anony_elite)
+        except (ValueError, KeyError, AttributeError) as e:
+            # 免费代理常常返回其他页面，每个代理一行 ERROR 日志太多
+            logging.debug('Error when parsing reflect response: %r' % (e,))
+            return None
+
+    def _save_anony(self, proxy, is_anony):
+        # 保存 proxy 的匿名检测结果，is_anony 是 None 表示连接失败
+        # 连接失败时只记录结果，不改变 sproxy_anon; 连续失败 EVICT.MAX_FAILS 次后删除该代理
+        # 第一次检测为非匿名超过 EVICT.MAX_AGE 后仍是非匿名的代理也删除，sproxy_all 不会无限增长
+        STAGE_PENDING.dec(stage='filter')
+        now = time.time()
+        with self.lock_evict:
+            nonanon_since = self.anony_nonanon.pop(proxy, now)
+        if is_anony is None:
+            FILTER_PROXIES.inc(result='dead')
+            with self.lock_evict:
+                fails = self.anony_dead.pop(proxy, 0) + 1
+            if fails >= self.evict_max_fails:
+                self._evict(proxy, 'dead')
+                return
+            result = 'dead:%d:%d' % (now, fails)
+            self.writer.add('hset', self.hproxy_anony, proxy, result)
             return
-            
-        if not self.ip_local in res.text:
-            logging.info('Anonymous: %s' % (proxy,))
-            self.rdb.sadd(self.sproxy_anon, proxy)
+        elif is_anony:
+            result = 'anon'
+            logging.debug('Anonymous: %s' % (proxy,))
+            self.writer.add('sadd', self.sproxy_anon, proxy)
+        else:
+            result = 'nonanon'
+            logging.debug('NON-Anonymous: %s' % (proxy,))
+            if now - nonanon_since >= self.evict_max_age:
+                FILTER_PROXIES.inc(result=result)
+                self._evict(proxy, 'nonanon')
+                return
+            # 之前检测为匿名的代理也从各 target 中删除，不再返回给用户
+            commands = [('srem', (self.sproxy_anon, proxy))]
+            for target in self.targets:
+                commands.append(('zrem', (self.configs['TARGET'][target]['DB_PROXY'], proxy)))
+                commands.append(('incr', (self._version_key(target),)))
+            self.writer.add_many(commands)
+
+        FILTER_PROXIES.inc(result=result)
+        if is_anony:
+            self.writer.add('hset', self.hproxy_anony, proxy, '%s:%d' % (result, now))
         else:
-            logging.info('NON-Anonymous: %s' % (proxy,))
-            self.rdb.srem(self.sproxy_anon, proxy)
+            self.writer.add('hset', self.hproxy_anony, proxy,
+                            '%s:%d:%d' % (result, now, nonanon_since))
             
     def valid_active(self):
         # 检验所有的匿名代理的可用性
         proxies = self.rdb.smembers(self.sproxy_anon)
+        self._valid_active(proxies)
 
-        with ThreadPoolExecutor(max_workers=self.tnum_proxy_valid) as executor:
-            for target in self.targets:
+    def _valid_active(self, proxies):
+        # 检验 proxies 中代理的可用性，proxies 格式是 [b'http://ip:port', ...]
+        proxies = list(proxies)
+        now     = time.time()
+        STAGE_PENDING.set(len(proxies), stage='valid')
+        self.health, self.score_records = self._load_states(proxies, now)
+
+        if self.concurrent_mode == 'asyncio':
+            validator = self._get_async_validator()
+            sites     = [(target, self.configs['TARGET'][target]['URL'],
+                          self.configs['TARGET'][target]['VALIDATE'])
+                         for target in self.targets]
+            validator.valid_active([proxy.decode('utf-8') for proxy in proxies], sites,
+                                   self._save_timings)
+        else:
+            with self._probe_round(), \
+                 ThreadPoolExecutor(max_workers=self.tnum_proxy_valid) as executor:
                 for proxy in proxies:
-                    executor.submit(self._efficiency_proxy, proxy, target)
+                    executor.submit(self._limited, self.stage_limiters.get('valid'),
+                                    lambda timings: any(timing.ok for timing in timings.values()),
+                                    self._efficiency_proxy, proxy)
 
-    def _efficiency_proxy(self, proxy, target):
-        # 通过该代理访问指定的几个站点获取访问时间，来检验一个匿名代理是否存活
-        # XXX: 当前是顺序访问指定的站点，考虑是否改为并发访问
-        try:
-            target = target.upper()
-        except AttributeError:
-            target = target
-        test_site = self.configs['TARGET'][target]['URL']
-        db_proxy  = self.configs['TARGET'][target]['DB_PROXY']
-        db_mtime  = self.configs['TARGET'][target]['DB_MTIME']        
-        validate  = self.configs['TARGET'][target]['VALIDATE']
-        
-        time_delay = self._timing_proxy(proxy.decode('utf-8'), test_site, val=validate)
-        proxy      = proxy.decode('utf-8')
-        mtime      = int(time.time())
+        self.writer.close()
+        self._report_evicted('valid')
+        self._publish_updated()
+        STAGE_SECONDS.observe(time.time() - now, stage='valid')
+        self._publish_metrics()
 
-        try_times = 0
-        while True:
-            # 尝试三次连接 redis
-            try:
-                self.rdb.zadd(db_proxy, time_delay, proxy)
-                self.rdb.set(db_mtime, mtime)
-
-                logging.info('Have validated %s' % (proxy,))
-                
-                break
-            except Exception as e:
-                try_times += 1
-                logging.info('Tried %d' % (try_times,))
-                if try_times >= self.try_times_db:
-                    logging.error(e)
-                    break
-                time.sleep(random.randint(0, self.try_time_wait))
-                self.rdb = redis.StrictRedis(db=self.configs['STORE']['RDB'])                
-            
-    def _timing_proxy(self, proxy, site, val):
-        # 获取通过该代理访问指定站点的耗时
-        time_start = time.time()
-        
-        try:
-            res   = requests.get(site, timeout=self.timeout_valid)
-            html  = etree.HTML(res.content)
-            title = html.xpath("/html/head/title")[0].text
-            
-            if res.status_code == 200:
-                time_end = time.time()
+    def _load_states(self, proxies, now):
+        # 读出 proxies 的健康状况和在各 target 上的历史记录，返回 (health, records)
+        health = {}
+        for proxy, value in zip(proxies, self._hmget(self.hproxy_health, proxies)):
+            if value:
+                fails, last_success = value.decode('utf-8').split(':')
+                health[proxy.decode('utf-8')] = (int(fails), float(last_success))
             else:
-                logging.error('Error when validating %s' % (proxy,))
-                time_end = -1
-        except Exception as e:
-            logging.error('Error when validating %s: %r' % (proxy, e))
-            time_end = -1
+                health[proxy.decode('utf-8')] = (0, now)
+
+        records = {}
+        for target in self.targets:
+            values = self._hmget(self._score_hash(target), proxies)
+            for proxy, value in zip(proxies, values):
+                records[(target, proxy.decode('utf-8'))] = scoring.loads(value)
+
+        return health, records
+
+    @contextlib.contextmanager
+    def _probe_round(self):
+        # 一轮可用性检测共用一个线程池访问各 target，线程在代理之间复用，不再每个代理新建;
+        # 检测代理的线程自己访问第一个 target，其余的交给这个线程池，所以最多需要
+        # PROXY_VALID * (target 数 - 1) 个线程
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, self.tnum_proxy_valid * (len(self.targets) - 1)))
+        self.probe_executor = executor
+        try:
+            yield executor
+        finally:
+            self.probe_executor = None
+            executor.shutdown()
+
+    def _efficiency_proxy(self, proxy):
+        # 通过该代理并发访问指定的几个站点获取访问时间，来检验一个匿名代理是否存活
+        # 每个站点一个连接; 读到 VALIDATE 标记就结束，连接不再复用，见 probe.py
+        # 第一个 target 在当前线程中访问，其余的交给 _probe_round 的线程池，
+        # 不在一轮检测中 (没有线程池) 时依次访问; 返回各 target 的 probe.Timing
+        proxy   = proxy.decode('utf-8')
+        calls   = []
+        for target in self.targets:
+            test_site = self.configs['TARGET'][target]['URL']
+            validate  = self.configs['TARGET'][target]['VALIDATE']
+            calls.append((target, functools.partial(
+                self._limited, self.target_limiters.get(target), lambda timing: timing.ok,
+                self._timing_proxy, proxy, test_site, validate, target,
+                rate=self.target_rates.get(target))))
+
+        executor = self.probe_executor
+        futures  = []
+        if executor is not None:
+            futures = [(target, executor.submit(call)) for target, call in calls[1:]]
+            calls   = calls[:1]
+
+        timings = dict((target, call()) for target, call in calls)
+        for target, future in futures:
+            timings[target] = future.result()
+
+        self._save_timings(proxy, timings)
+
+        return timings
 
-        if time_end == -1:
-            time_interval = self.time_exception
+    def _save_timings(self, proxy, timings):
+        # 保存通过 proxy 访问各 target 的耗时，proxy 格式是 'http://ip:port'，
+        # timings 格式是 {target: probe.Timing, ...}，由 writer 批量写入; 分数使用找到
+        # VALIDATE 标记的耗时，失败时是 TIME_EXCEPTION，连接和 TTFB 的耗时只记录在指标中
+        # 同时更新代理的健康状况 (连续失败次数:上次成功时间)，连续失败 EVICT.MAX_FAILS 次
+        # 或超过 EVICT.MAX_AGE 秒没有成功时删除该代理，与写入耗时在同一个事务中
+        now    = time.time()
+        mtime  = int(now)
+        STAGE_PENDING.dec(stage='valid')
+        for target, timing in timings.items():
+            if timing.connect is not None:
+                VALID_CONNECT.observe(timing.connect, target=target)
+            if timing.ttfb is not None:
+                VALID_TTFB.observe(timing.ttfb, target=target)
+        timings = dict((target, timing.total if timing.ok else self.time_exception)
+                       for target, timing in timings.items())
+
+        fails, last_success = self.health.get(proxy, (0, now))
+        if any(time_delay < self.time_exception for time_delay in timings.values()):
+            fails, last_success = 0, now
+            VALID_PROXIES.inc(result='ok')
         else:
-            time_interval = time_end - time_start
+            fails += 1
+            VALID_PROXIES.inc(result='failed')
+
+        if fails >= self.evict_max_fails:
+            self._evict(proxy, 'failures')
+            return
+        if now - last_success >= self.evict_max_age:
+            self._evict(proxy, 'age')
+            return
+
+        # 写入的分数由该代理的历史记录计算，见 scoring.py
+        commands = []
+        for target, time_delay in timings.items():
+            if time_delay < self.time_exception:
+                VALID_LATENCY.observe(time_delay, target=target)
+            record = self.score_model.update(self.score_records.get((target, proxy)), time_delay)
+            commands.append(('zadd', (self.configs['TARGET'][target]['DB_PROXY'],
+                                      self.score_model.score(record), proxy)))
+            commands.append(('hset', (self._score_hash(target), proxy, scoring.dumps(record))))
+            commands.append(('set', (self.configs['TARGET'][target]['DB_MTIME'], mtime)))
+            commands.append(('incr', (self._version_key(target),)))
+        commands.append(('hset', (self.hproxy_health, proxy,
+                                  '%d:%d' % (fails, last_success))))
+        self.writer.add_many(commands)
+
+        logging.debug('Have validated %s' % (proxy,))
+
+    def _on_written(self, commands):
+        # writer 写入后调用: 检测结果更新了 target 的 mtime 时发布新的 mtime，
+        # handler 中等待 mtime 变化的请求由此唤醒，见 watch.py; 每次写入最多发布一次
+        mtimes = {}
+        for command, args in commands:
+            if command == 'set' and args[0] in self.mtime_targets:
+                target = self.mtime_targets[args[0]]
+                mtimes[target] = max(mtimes.get(target, 0), int(args[1]))
+        if mtimes:
+            self._publish_updated(mtimes)
+
+    def _publish_updated(self, mtimes=None):
+        # 在 CACHE.CHANNEL 上发布更新:
+        #   + 本轮检测结束时是 'ALL 58 GANJI'，handler 中的缓存收到后丢弃，见 listcache.py
+        #   + mtimes ({target: mtime}) 不为空时是 'ALL:1394069400 58:1394069400'
+        channel = self.configs['CACHE']['CHANNEL']
+        if not channel:
+            return
+        if mtimes:
+            message = ' '.join('%s:%d' % (target, mtime)
+                               for target, mtime in sorted(mtimes.items()))
+        else:
+            message = ' '.join(self.targets)
+        try:
+            self.rdb.publish(channel, message)
+        except redis.RedisError as e:
+            logging.error('Error when publishing to %s: %r' % (channel, e))
+
+    def _publish_metrics(self):
+        # 把本进程的指标写入 redis，由 handler 的 /metrics 输出，见 metrics.py
+        try:
+            metrics.REGISTRY.publish(self.rdb, self.configs['METRICS']['HASH'], 'pool',
+                                     process='pool')
+        except redis.RedisError as e:
+            logging.error('Error when publishing metrics: %r' % (e,))
+
+    def _score_hash(self, target):
+        # 存储代理在 target 上的历史记录的 hash
+        return '%s:%s' % (self.configs['TARGET'][target]['DB_PROXY'],
+                          self.configs['SCORE']['SUFFIX'])
+
+    def _evict(self, proxy, reason):
+        # 从所有的集合中删除 proxy，这些删除操作是原子执行的
+        commands = [
+            ('srem', (self.sproxy_all, proxy)),
+            ('srem', (self.sproxy_anon, proxy)),
+            ('hdel', (self.hproxy_anony, proxy)),
+            ('hdel', (self.hproxy_health, proxy)),
+        ]
+        for target in self.targets:
+            commands.append(('zrem', (self.configs['TARGET'][target]['DB_PROXY'], proxy)))
+            commands.append(('hdel', (self._score_hash(target), proxy)))
+            commands.append(('incr', (self._version_key(target),)))
+        self.writer.add_many(commands)
+
+        with self.lock_evict:
+            self.evicted[reason] += 1
+            self.evicted_proxies.add(proxy)
+        EVICTED.inc(reason=reason)
+        logging.debug('Evicted %s: %s' % (reason, proxy))
+
+    def _close_sessions(self, stage):
+        # 一轮结束后统计新建和复用的连接数，并关闭该阶段的 session;
+        # 线程池中的线程在一轮结束后退出，它们的 session 不会再被使用
+        stats = self.sessions[stage].round_stats()
+        self.sessions[stage].close_all()
+
+        return stats
+
+    def _report_evicted(self, stage):
+        # 记录并清空本轮删除的代理数，累计的数目记录在 hash EVICT.STATS 中
+        with self.lock_evict:
+            evicted, self.evicted = self.evicted, collections.Counter()
+            self.evicted_last = self.evicted_proxies
+            self.evicted_proxies = set()
+
+        pipe = self.rdb.pipeline(transaction=False)
+        for reason, num in evicted.items():
+            pipe.hincrby(self.evict_stats, reason, num)
+        pipe.hset(self.evict_stats, 'last_%s' % (stage,), sum(evicted.values()))
+        pipe.execute()
+
+        logging.info('Evicted %d proxies in %s round: %s'
+                     % (sum(evicted.values()), stage, dict(evicted)))
+
+        return evicted
+
+    def _get_async_validator(self):
+        # asyncio 模式下使用的检测器
+        from asyncvalid import AsyncValidator
+
+        return AsyncValidator(headers=self.configs['CRAWL']['HEADERS'],
+                              timeout=self.timeout_valid,
+                              total=self.configs['CONCURRENT']['ASYNC_TOTAL'],
+                              per_host=self.configs['CONCURRENT']['ASYNC_PER_HOST'],
+                              stage_policies=dict(
+                                  (stage, lim.policy)
+                                  for stage, lim in self.stage_limiters.items()),
+                              target_policies=dict(
+                                  (target, lim.policy)
+                                  for target, lim in self.target_limiters.items()),
+                              target_rates=self.target_rates)
+
+    def _limited(self, limiter, succeeded, func, *args, rate=None):
+        # 在 limiter 允许时调用 func，succeeded(func 的返回值) 作为检测结果反馈给 limiter;
+        # limiter 是 None (没有开启 ADAPTIVE) 时直接调用
+        # rate (limiter.RateLimiter) 不为 None 时先等待令牌，反馈给 limiter 的耗时从等待结束后
+        # 算起: 限速造成的等待不是拥塞，计入耗时会让 AIMD 错误地减小并发数
+        if limiter is None:
+            if rate is not None:
+                rate.wait()
+            return func(*args)
+
+        time_start = limiter.acquire()
+        ok         = False
+        try:
+            if rate is not None:
+                rate.wait()
+                time_start = time.time()
+            result = func(*args)
+            ok     = succeeded(result)
+            return result
+        finally:
+            limiter.release(ok, time_start)
+
+    def _timing_proxy(self, proxy, site, val, target=None):
+        # 通过该代理访问指定站点，返回 probe.Timing; 对同一个 target 的请求速率受
+        # ADAPTIVE.TARGET_RATE (或 TARGET 中的 RATE) 限制，由 _limited 在调用前等待
+        timing = probe.probe(proxy, site, val, headers=self.configs['CRAWL']['HEADERS'],
+                             timeout=self.timeout_valid)
+        if not timing.ok:
+            logging.debug('Error when validating %s on %s: %r' % (proxy, site, timing))
+
+        return timing
 
-        return time_interval
 
-        
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='代理池服务')
+    parser.add_argument('--daemon', action='store_true',
+                        help='常驻运行，按 SCHEDULE 的配置增量抓取和检测代理')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='抓取、匿名检测、可用性检测以流水线方式运行一轮，见 pipeline.py')
+    args = parser.parse_args()
+
     proxypool = ProxyPool()
-    proxypool.fetch_proxies()   # 抓取代理
-    proxypool.filter_anony()    # 挑选出匿名代理
-    proxypool.valid_active()    # 验证代理的可用性
+    if args.daemon:
+        from scheduler import ProxyDaemon
+        ProxyDaemon(proxypool).run_forever()
+    elif args.pipeline:
+        from pipeline import Pipeline
+        configs = proxypool.configs.get('PIPELINE') or {}
+        Pipeline(proxypool, filter_queue=configs.get('FILTER_QUEUE', 1000),
+                 valid_queue=configs.get('VALID_QUEUE', 500)).run()
+    else:
+        proxypool.fetch_proxies()   # 抓取代理
+        proxypool.filter_anony()    # 挑选出匿名代理
+        proxypool.valid_active()    # 验证代理的可用性
     # pprint.pprint(proxypool.get_many(num=3, maxscore=10, target='58'))
     # pprint.pprint(proxypool.get_many(num=3, maxscore=10, target=58))
     # pprint.pprint(proxypool.get_many(num=3, maxscore=10, target='baixing'))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""返回请求者 ip 和转发相关请求头的 reflect 服务，以及据此判断代理是否匿名.
+
+NOTE:
+  + handler 中的 /reflect 通过 reflect() 生成响应，格式是:
+    {"origin": "对端 ip", "headers": {"X-Forwarded-For": "...", "Via": "...", ...}}
+  + 也兼容 httpbin.org/ip 的响应 {"origin": "ip, ip"}，此时只能根据 origin 判断
+  + 透明代理会在转发头中带上本机的 ip，普通匿名代理只带 Via 等头，高匿代理不带任何转发头;
+    ANONY.ELITE 为 true 时只有高匿代理才算匿名
+"""
+
+import re
+import json
+
+
+# 代理可能添加的转发相关请求头
+FORWARD_HEADERS = (
+    'X-Forwarded-For',
+    'X-Real-Ip',
+    'Forwarded',
+    'Via',
+    'Client-Ip',
+    'Proxy-Connection',
+)
+
+
+# 转发头中分隔 ip 的字符，例如 'ip, ip'、'for="ip:port";proto=http'、'1.1 ip (squid)'
+SEPARATORS = re.compile(r'[\s,;="()\[\]]+')
+
+
+def reflect(remote_ip, headers):
+    """Return the reflect response of a request from 'remote_ip' with 'headers'"""
+    forward = {}
+    for name in FORWARD_HEADERS:
+        value = headers.get(name)
+        if value is not None:
+            forward[name] = value
+
+    return {'origin': remote_ip, 'headers': forward}
+
+
+def parse_ip(body):
+    """Return the first ip in the 'origin' of a reflect response"""
+    data = json.loads(body if isinstance(body, str) else body.decode('utf-8'))
+    return data['origin'].split(',')[0].strip()
+
+
+def _has_ip(value, ip):
+    # value 中是否有完整的 ip (可以带端口)，不是子串匹配: 1.2.3.4 不匹配 11.2.3.45
+    for token in SEPARATORS.split(value):
+        if token == ip or token.rsplit(':', 1)[0] == ip:
+            return True
+    return False
+
+
+def is_anonymous(body, ip_local, elite=False):
+    """
+    Return whether the reflect response 'body' requested through a proxy
+    hides 'ip_local'. If 'elite' is True, any forwarding header makes the
+    proxy non-anonymous.
+    """
+    data    = json.loads(body if isinstance(body, str) else body.decode('utf-8'))
+    origin  = [ip.strip() for ip in str(data.get('origin', '')).split(',')]
+    headers = data.get('headers', {})
+
+    if ip_local in origin:
+        return False
+
+    for name, value in headers.items():
+        if name == 'Proxy-Connection':
+            continue
+        if elite:
+            return False
+        if _has_ip(str(value), ip_local):
+            return False
+
+    return True
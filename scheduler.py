@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""常驻运行的代理池，按优先队列调度抓取和检测任务.
+
+NOTE:
+  + 每个站点按 PROXY_SITES 中的 freq 抓取，没有 freq 或 freq 是 -1 时按 SCHEDULE.CRAWL_FREQ
+  + 只对新抓取到的或匿名检测结果已过期的代理做匿名检测，新的匿名代理立即检测可用性
+  + 每个匿名代理根据上次的检测结果和发现至今的时间安排下次检测:
+    - 检测失败: 间隔随连续失败次数指数增长，VALID_MIN * 2^fails
+    - 检测成功: VALID_MIN * (1 + score / INIT_VALUE) * (1 + age / VALID_MAX)，
+      即延迟越小、越新的代理检测越频繁
+    - 间隔都不超过 VALID_MAX
+    - 按 EVICT 的配置被删除的代理不再检测
+  + 每次检测可用性之前确认代理仍在 sproxy_anon 中: 重新检测为非匿名或已被删除的代理不再调度，
+    不会被检测结果重新写回各 target 的 sorted set
+  + 匿名检测的结果 (ANONY.HASH) 过期时重新检测匿名，不依赖代理再次被抓取到
+  + 每轮循环把所有到期的任务一起执行，检测仍然使用 CONCURRENT.MODE 指定的方式
+"""
+
+import time
+import heapq
+import random
+import logging
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import proxyaddr
+
+
+class Scheduler(object):
+    """按到期时间排序的任务队列，任务是 (kind, key)"""
+    def __init__(self):
+        self.heap    = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, when, kind, key):
+        heapq.heappush(self.heap, (when, next(self.counter), kind, key))
+
+    def next_time(self):
+        """Return the due time of the earliest job, None if there's no job"""
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Pop all jobs due before 'now', return {kind: [key, ...]}"""
+        jobs = {}
+        while self.heap and self.heap[0][0] <= now:
+            when, _, kind, key = heapq.heappop(self.heap)
+            jobs.setdefault(kind, []).append(key)
+        return jobs
+
+
+class ProxyState(object):
+    """调度需要的代理状态"""
+    __slots__ = ('first_seen', 'fails', 'anony_due')
+
+    def __init__(self, first_seen):
+        self.first_seen = first_seen
+        self.fails      = 0
+        self.anony_due  = None    # 重新检测匿名的时间，队列中只有与之相同的任务有效
+
+
+class ProxyDaemon(object):
+    """常驻运行的代理池.
+    """
+    def __init__(self, proxypool):
+        self.proxypool = proxypool
+        self.scheduler = Scheduler()
+        self.states    = {}    # 已安排检测的匿名代理
+
+        schedule = proxypool.configs['SCHEDULE']
+        self.crawl_freq = schedule['CRAWL_FREQ']
+        self.valid_min  = schedule['VALID_MIN']
+        self.valid_max  = schedule['VALID_MAX']
+        self.tick       = schedule['TICK']
+
+    def site_freq(self, url):
+        freq = self.proxypool.configs['PROXY_SITES'][url].get('freq', -1)
+        return freq if freq and freq > 0 else self.crawl_freq
+
+    def valid_interval(self, state, score, now):
+        """Return the seconds to wait before validating the proxy again"""
+        if score is None or score >= self.proxypool.time_exception:
+            interval = self.valid_min * 2 ** min(state.fails, 16)
+        else:
+            age      = now - state.first_seen
+            interval = (self.valid_min * (1 + score / self.proxypool.init_value)
+                        * (1 + min(age, self.valid_max) / self.valid_max))
+
+        return min(interval, self.valid_max)
+
+    def start(self):
+        # 抓取所有站点，已有的代理全部检测一次匿名，匿名代理在 VALID_MIN 内分散检测
+        now = time.time()
+        for url in self.proxypool.configs['PROXY_SITES']:
+            self.scheduler.add(now, 'crawl', url)
+
+        proxypool = self.proxypool
+        proxypool.ip_local = proxypool.get_ip_local()
+        proxies = proxypool.rdb.smembers(proxypool.sproxy_all)
+        proxypool._filter_anony(proxypool._expired_anony(proxies))
+        scheduled = [proxy for proxy in proxypool.rdb.smembers(proxypool.sproxy_anon)
+                     if self._schedule_new(proxy, now + random.uniform(0, self.valid_min))]
+        self._schedule_anony(scheduled)
+
+    def _schedule_new(self, proxy, when):
+        # 返回是否是新安排检测的代理
+        if proxy in self.states:
+            return False
+        self.states[proxy] = ProxyState(time.time())
+        self.scheduler.add(when, 'valid', proxy)
+        return True
+
+    def _schedule_anony(self, proxies):
+        # 在 proxies 的匿名检测结果过期时重新检测匿名; 安排之前都已检测过匿名，
+        # 没有结果的是已被删除的代理 (见 ProxyPool._evict)，不再调度
+        proxypool = self.proxypool
+        proxies   = list(proxies)
+        now       = time.time()
+        for proxy, verdict in zip(proxies, proxypool._hmget(proxypool.hproxy_anony, proxies)):
+            if not verdict:
+                self.states.pop(proxy, None)
+                continue
+            fields = verdict.decode('utf-8').split(':')
+            due    = max(now, float(fields[1]) + proxypool.ttl_anony.get(fields[0], 0))
+            self.states[proxy].anony_due = due
+            self.scheduler.add(due, 'anony', (proxy, due))
+
+    def run_once(self, now=None):
+        """Run all jobs due before 'now', return the number of jobs run"""
+        now  = now or time.time()
+        jobs = self.scheduler.pop_due(now)
+
+        sites = jobs.get('crawl', [])
+        if sites:
+            self._crawl(sites, now)
+
+        # 已不再调度的代理，或已重新安排过的任务，跳过
+        rechecks = [proxy for proxy, due in jobs.get('anony', [])
+                    if proxy in self.states and self.states[proxy].anony_due == due]
+        if rechecks:
+            self._recheck_anony(rechecks)
+
+        proxies = [proxy for proxy in jobs.get('valid', []) if proxy in self.states]
+        if proxies:
+            self._valid(proxies)
+
+        return len(sites) + len(rechecks) + len(proxies)
+
+    def _crawl(self, sites, now):
+        proxypool = self.proxypool
+        crawled   = set()
+        index     = proxyaddr.ProxyIndex()
+        with ThreadPoolExecutor(max_workers=proxypool.tnum_proxy_getter) as executor:
+            futures = []
+            for url in sites:
+                val = proxypool.configs['PROXY_SITES'][url]
+                futures.append(executor.submit(proxypool._crawl_proxies_one_site,
+                                               url, val['rules'], val['proxies'], index))
+                self.scheduler.add(now + self.site_freq(url), 'crawl', url)
+
+            for future in futures:
+                try:
+                    crawled.update(proxy.encode('utf-8') for proxy in future.result())
+                except Exception as e:
+                    logging.error('Error when crawling: %r' % (e,))
+        proxypool.writer.close()
+        proxypool._close_sessions('crawl')
+        proxypool._report_dedup(index)
+
+        # 只检测没有检测过或检测结果已过期的代理
+        new = proxypool._expired_anony(crawled, now=now)
+        logging.info('Crawled %d proxies from %d sites, %d to check'
+                     % (len(crawled), len(sites), len(new)))
+        if not new:
+            return
+
+        proxypool._filter_anony(new)
+        pipe = proxypool.rdb.pipeline(transaction=False)
+        for proxy in new:
+            pipe.sismember(proxypool.sproxy_anon, proxy)
+        self._schedule_anony([proxy for proxy, is_anony in zip(new, pipe.execute())
+                              if is_anony and self._schedule_new(proxy, now)])
+
+    def _recheck_anony(self, proxies):
+        # 重新检测匿名检测结果已过期的代理，新的结果过期时再检测; 不再是匿名的代理
+        # 在下次检测可用性时停止调度
+        proxypool = self.proxypool
+        expired   = proxypool._expired_anony(proxies)
+        if expired:
+            proxypool._filter_anony(expired)
+        self._schedule_anony(proxies)
+
+    def _valid(self, proxies):
+        proxypool = self.proxypool
+
+        # 只检测仍是匿名的代理，否则检测结果会把非匿名或已删除的代理重新写入各 target
+        pipe = proxypool.rdb.pipeline(transaction=False)
+        for proxy in proxies:
+            pipe.sismember(proxypool.sproxy_anon, proxy)
+        members = pipe.execute()
+        for proxy, is_member in zip(proxies, members):
+            if not is_member:
+                del self.states[proxy]
+        proxies = [proxy for proxy, is_member in zip(proxies, members) if is_member]
+        if not proxies:
+            logging.info('No anonymous proxies to validate, %d scheduled'
+                         % (len(self.scheduler),))
+            return
+
+        proxypool._valid_active(proxies)
+
+        # 取回各 target 中的分数，用最小的分数安排下次检测
+        pipe = proxypool.rdb.pipeline(transaction=False)
+        for proxy in proxies:
+            for target in proxypool.targets:
+                pipe.zscore(proxypool.configs['TARGET'][target]['DB_PROXY'], proxy)
+        scores = pipe.execute()
+
+        now = time.time()
+        num = len(proxypool.targets)
+        for i, proxy in enumerate(proxies):
+            if proxy.decode('utf-8') in proxypool.evicted_last:
+                # 已从代理池中删除，不再检测
+                del self.states[proxy]
+                continue
+
+            state = self.states[proxy]
+            found = [score for score in scores[i * num:(i + 1) * num] if score is not None]
+            score = min(found) if found else None
+            if score is None or score >= proxypool.time_exception:
+                state.fails += 1
+            else:
+                state.fails = 0
+            self.scheduler.add(now + self.valid_interval(state, score, now), 'valid', proxy)
+
+        logging.info('Validated %d proxies, %d scheduled' % (len(proxies), len(self.scheduler)))
+
+    def run_forever(self):
+        self.start()
+        while True:
+            self.proxypool.refresh()
+            self.run_once()
+
+            next_time = self.scheduler.next_time()
+            wait      = self.tick if next_time is None else next_time - time.time()
+            time.sleep(min(max(wait, 0), self.tick))
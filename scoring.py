@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""根据历史检测结果计算代理的分数.
+
+NOTE:
+  + 每个代理对每个 target 保存一条记录 (平均延迟, 成功率, 检测次数)，
+    平均延迟和成功率都是 EWMA，平滑系数是 SCORE.ALPHA
+  + 分数 = 平均延迟 / 成功率^SCORE.PENALTY，不超过 TIME_EXCEPTION;
+    从没成功过的代理分数是 TIME_EXCEPTION
+  + 一次慢的或失败的检测不会让好的代理变得不可用，一次幸运的检测也不会让差的代理变得可用
+  + 模型只依赖传入的耗时，可以直接用构造的耗时序列测试，例如:
+    >>> model = ScoreModel(alpha=0.3, penalty=2, time_exception=100000)
+    >>> record = None
+    >>> for time_delay in (1.0, 1.2, 100000, 0.8):
+    ...     record = model.update(record, time_delay)
+    >>> round(model.score(record), 2)
+    1.57
+"""
+
+
+class ScoreModel(object):
+    """EWMA 延迟和成功率模型.
+    """
+    def __init__(self, alpha=0.3, penalty=2, time_exception=100000):
+        self.alpha          = alpha
+        self.penalty        = penalty
+        self.time_exception = time_exception
+
+    def update(self, record, time_delay):
+        """
+        Return the new record (latency, ratio, samples) after a validation
+        took 'time_delay' seconds, 'record' is None for a new proxy.
+        """
+        success = time_delay < self.time_exception
+        if record is None:
+            if success:
+                return (time_delay, 1.0, 1)
+            return (None, 0.0, 1)
+
+        latency, ratio, samples = record
+        alpha = self.alpha
+        if success:
+            latency = time_delay if latency is None else alpha * time_delay + (1 - alpha) * latency
+            ratio   = alpha + (1 - alpha) * ratio
+        else:
+            ratio   = (1 - alpha) * ratio
+
+        return (latency, ratio, samples + 1)
+
+    def score(self, record):
+        """Return the score of 'record', lower is better"""
+        if record is None:
+            return self.time_exception
+
+        latency, ratio, samples = record
+        if latency is None or ratio <= 0:
+            return self.time_exception
+
+        return min(latency / ratio ** self.penalty, self.time_exception)
+
+
+def dumps(record):
+    """Serialize 'record' as 'latency:ratio:samples'"""
+    latency, ratio, samples = record
+    latency = '' if latency is None else '%.4f' % (latency,)
+    return '%s:%.4f:%d' % (latency, ratio, samples)
+
+
+def loads(value):
+    """Parse the value of dumps(), return None for None"""
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+
+    latency, ratio, samples = value.split(':')
+    latency = float(latency) if latency else None
+    return (latency, float(ratio), int(samples))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""多进程的 http 服务，取代 nginx + 多个 handler 的部署方式.
+
+NOTE:
+  + 主进程监听 SERVER.PORT 后 fork 出 SERVER.WORKERS 个 worker 进程，各 worker 共享监听的
+    socket，由内核分配连接; WORKERS 是 0 时使用 cpu 的个数
+  + 主进程不处理请求，只负责监控 worker:
+    - worker 意外退出时重新 fork，存活不到 1s 就退出的 worker 等待 1s 后再 fork
+    - 收到 SIGHUP 时平滑重启: 先按新的配置 fork 出新的 worker，再让旧的 worker 退出
+    - 收到 SIGTERM/SIGINT 时让所有 worker 退出后退出
+  + worker 收到 SIGTERM 后不再接受新的连接，等待 SERVER.GRACE 秒处理完已有的连接后退出
+  + 每个 worker 在 /health 上报告自己的状态，见 handlers/handler_template.py;
+    每个 worker 定期把自己的指标写入 redis，/metrics 输出所有 worker 和各阶段的指标
+  + redis 连接、ProxyPool 都在 fork 之后由 worker 各自创建
+"""
+
+import os
+import time
+import errno
+import signal
+import logging
+
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
+
+from proxypool import Config
+
+
+def run_worker(worker, sockets, configfile, grace):
+    """Serve on 'sockets' until SIGTERM, in the worker process"""
+    from proxypool import ProxyPool
+    from handlers.handler_template import make_app, publish_metrics
+
+    proxypool = ProxyPool(configfile)
+    app       = make_app(proxypool, worker=worker)
+    server    = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    ioloop    = tornado.ioloop.IOLoop.instance()
+    publish_metrics(proxypool, worker)
+
+    def shutdown():
+        logging.info('Worker %d (pid %d) is shutting down' % (worker['id'], os.getpid()))
+        server.stop()
+        ioloop.add_timeout(time.time() + grace, ioloop.stop)
+
+    def on_signal(signum, frame):
+        ioloop.add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    logging.info('Worker %d (pid %d) started' % (worker['id'], os.getpid()))
+    ioloop.start()
+
+
+class Master(object):
+    """fork 并监控 worker 进程.
+    """
+    def __init__(self, configfile='settings.yaml'):
+        self.configfile = configfile
+        self.config     = Config(configfile)
+        self.workers    = {}     # pid -> worker 的编号
+        self.started    = {}     # pid -> fork 的时间
+        self.retiring   = set()  # 平滑重启中等待退出的旧 worker
+        self.stopping   = False
+        self.restarting = False
+
+        self._apply_configs(self.config.data)
+        self.sockets = tornado.netutil.bind_sockets(self.port, address=self.address)
+
+    def _apply_configs(self, configs):
+        self.port        = configs['SERVER']['PORT']
+        self.address     = configs['SERVER'].get('ADDRESS') or None
+        self.num_workers = configs['SERVER']['WORKERS'] or tornado.process.cpu_count()
+        self.grace       = configs['SERVER']['GRACE']
+
+    def spawn(self, index):
+        """Fork worker 'index', return its pid"""
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker({'id': index, 'started': time.time()},
+                           self.sockets, self.configfile, self.grace)
+            except Exception:
+                logging.exception('Worker %d crashed' % (index,))
+                code = 1
+            finally:
+                os._exit(code)
+
+        self.workers[pid] = index
+        self.started[pid] = time.time()
+        return pid
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.restarting = True
+        else:
+            self.stopping = True
+
+    def run(self):
+        """Fork the workers and supervise them until SIGTERM/SIGINT"""
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+
+        for index in range(self.num_workers):
+            self.spawn(index)
+        logging.info('Serving on port %d with %d workers' % (self.port, self.num_workers))
+
+        while not self.stopping:
+            if self.restarting:
+                self.restarting = False
+                self.restart()
+            self._reap()
+            time.sleep(0.2)
+
+        self.stop()
+
+    def restart(self):
+        """Fork a new generation of workers, then retire the old ones"""
+        self.config.refresh()
+        self._apply_configs(self.config.data)
+
+        old = [pid for pid in self.workers if pid not in self.retiring]
+        for index in range(self.num_workers):
+            self.spawn(index)
+        for pid in old:
+            self.retiring.add(pid)
+            self._kill(pid, signal.SIGTERM)
+        logging.info('Restarted %d workers' % (self.num_workers,))
+
+    def stop(self):
+        """Shut down all workers gracefully, kill them after the grace period"""
+        self.retiring.update(self.workers)
+        for pid in list(self.workers):
+            self._kill(pid, signal.SIGTERM)
+
+        deadline = time.time() + self.grace + 5
+        while self.workers and time.time() < deadline:
+            self._reap(respawn=False)
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self._kill(pid, signal.SIGKILL)
+        logging.info('Server stopped')
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self, respawn=True):
+        # 回收已退出的 worker，意外退出的重新 fork
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid not in self.workers:
+                continue
+
+            index   = self.workers.pop(pid)
+            started = self.started.pop(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+
+            logging.error('Worker %d (pid %d) exited with status %d'
+                          % (index, pid, status))
+            if respawn and not self.stopping:
+                if time.time() - started < 1:
+                    time.sleep(1)
+                self.spawn(index)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='代理池的 http 服务')
+    parser.add_argument('-c', '--config', default='settings.yaml', help='配置文件')
+    args = parser.parse_args()
+
+    Master(args.config).run()
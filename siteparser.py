@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""解析代理网站的页面.
+
+NOTE:
+  + PROXY_SITES 中每个站点的 rules 只编译一次成 etree.XPath，之后每次解析直接使用
+  + etree.XPath 不能 pickle，在进程池中使用时每个进程各自编译并缓存，见 parse_page()
+  + rules 的格式:
+    - [节点]: 节点的文本就是 ip:port
+    - [节点, '子节点,n,m']: 子节点中第 2 个是 ip，第 3 个是 port (n、m 目前没有使用)
+    - [节点, 'ip,port,是否匿名,站点标识']: 站点标识用来决定判断匿名的文本
+"""
+
+import logging
+
+from lxml import etree
+
+
+# 各站点表示高匿的文本
+ANONYMOUS_TEXT = {
+    'proxy360': '高匿',
+    'cn-proxy': '高度匿名',
+}
+
+
+def _text(nodes, index=0):
+    return (nodes[index].text or '').strip()
+
+
+class SiteRule(object):
+    """一个站点编译后的解析规则.
+    """
+    def __init__(self, rules):
+        self.xpath_nodes = etree.XPath(rules[0])
+        self.kind        = 'text'
+
+        if len(rules) == 2:
+            rule_1    = rules[1].split(',')
+            self.kind = None
+            if len(rule_1) == 3:
+                self.kind       = 'cells'
+                self.xpath_cell = etree.XPath(rule_1[0])
+            elif len(rule_1) == 4:
+                self.kind         = 'fields'
+                self.xpath_ip     = etree.XPath(rule_1[0])
+                self.xpath_port   = etree.XPath(rule_1[1])
+                self.xpath_niming = etree.XPath(rule_1[2])
+                self.anonymous    = ANONYMOUS_TEXT.get(rule_1[3])
+
+    def parse(self, text, url=''):
+        """Return the list of proxies ('http://ip:port') found in the page 'text'"""
+        if self.kind is None:
+            return []
+
+        try:
+            html = etree.HTML(text)
+        except Exception as e:
+            logging.error('Error when parsing %s: %r' % (url, e))
+            return []
+        if html is None:
+            return []
+
+        proxies = []
+        for node in self.xpath_nodes(html):
+            try:
+                proxy = getattr(self, '_parse_' + self.kind)(node)
+            except Exception as e:
+                logging.error('Error when parsing %s: %r' % (url, e))
+                continue
+            if proxy:
+                proxies.append(proxy)
+
+        return proxies
+
+    def _parse_text(self, node):
+        text = (node.text or '').strip()
+        if text:
+            return 'http://%s' % (text,)
+
+    def _parse_cells(self, node):
+        cells = self.xpath_cell(node)
+        ip    = _text(cells, 1)
+        port  = _text(cells, 2) or '80'
+        if ip:
+            return 'http://%s:%s' % (ip, port)
+
+    def _parse_fields(self, node):
+        ip     = _text(self.xpath_ip(node))
+        port   = _text(self.xpath_port(node))
+        niming = _text(self.xpath_niming(node))
+        if ip and niming == self.anonymous:
+            return 'http://%s:%s' % (ip, port)
+
+
+# 进程内缓存的编译后的规则，key 是 (url, tuple(rules))
+_rules_compiled = {}
+
+
+def get_rule(url, rules):
+    """Return the compiled SiteRule of 'rules', compiling it at most once per process"""
+    key  = (url, tuple(rules))
+    rule = _rules_compiled.get(key)
+    if rule is None:
+        rule = SiteRule(rules)
+        _rules_compiled[key] = rule
+
+    return rule
+
+
+def parse_page(url, rules, text):
+    """
+    Parse the page 'text' crawled from 'url' with 'rules', return
+    (url, proxies). Can be submitted to a ProcessPoolExecutor.
+    """
+    return url, get_rule(url, rules).parse(text, url=url)
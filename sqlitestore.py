@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""嵌入式的存储后端: 单机部署时用 SQLite 代替 redis.
+
+NOTE:
+  + STORE.BACKEND 是 sqlite 时，ProxyPool.rdb 是 SQLiteStore，它实现了 ProxyPool、
+    BatchWriter、scheduler、handler 用到的 redis 命令，参数和返回值与 redis-py 的
+    StrictRedis 相同 (值是 bytes，分数是 float，zadd 是 score, member 的顺序)，
+    其他模块不需要区分后端
+  + 数据库文件是 STORE.PATH，使用 WAL 模式: 多个 handler 进程同时读同一个文件，写不阻塞读;
+    每个线程一个连接，没有网络往返，也不需要 redis-server
+  + sorted set 存储在 zsets 表中，(key, score, member) 上有索引，zrangebyscore 和 zscore
+    是索引查找; 但 B 树中没有计数，zcount 和按排名的 zrange 是 O(N)，get_many 在这个后端上
+    不按排名抽样，改为缓存分数区间内的代理，见 ProxyPool._sample_cached
+  + pipeline() 缓冲命令，execute() 时在一个事务中执行，与 MULTI/EXEC 一样是原子的;
+    有写命令时以 BEGIN IMMEDIATE 开始，进程之间的写由 SQLite 的锁串行化，最多等待 timeout 秒
+  + 不支持 pubsub 和 Lua 脚本: publish 什么也不做，handler 的缓存按 CACHE.CHECK_INTERVAL
+    检查 mtime; 租约 (lease.py) 需要 redis 后端
+"""
+
+import sqlite3
+import threading
+import contextlib
+
+import redis
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+  key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sets (
+  key BLOB, member BLOB, PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes (
+  key BLOB, field BLOB, value BLOB NOT NULL, PRIMARY KEY (key, field)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zsets (
+  key BLOB, member BLOB, score REAL NOT NULL, PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS zsets_score ON zsets (key, score, member);
+"""
+
+# 不修改数据的命令，只有这些命令的 pipeline 不需要写锁
+READONLY = frozenset(['ping', 'get', 'mget', 'smembers', 'sismember', 'scard', 'hget', 'hmget',
+                      'hgetall', 'hlen', 'zcard', 'zscore', 'zcount', 'zrange',
+                      'zrangebyscore'])
+
+
+class StoreError(redis.RedisError):
+    """SQLite 的错误，与 redis 的错误一样处理"""
+
+
+def _encode(value):
+    # 与 redis-py 的 Connection.encode 相同
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode('utf-8')
+    if isinstance(value, int):
+        return str(value).encode('utf-8')
+    return str(value).encode('utf-8')
+
+
+def _bound(value):
+    # 解析 zcount、zrangebyscore 的分数边界，返回 (分数, 是否不包含边界)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith('('):
+            return float(value[1:]), True
+        return float(value), False
+    return float(value), False
+
+
+def _score_range(minscore, maxscore):
+    low, low_open   = _bound(minscore)
+    high, high_open = _bound(maxscore)
+    return ('score %s ? AND score %s ?' % ('>' if low_open else '>=', '<' if high_open else '<='),
+            [low, high])
+
+
+class Pipeline(object):
+    """缓冲命令，execute() 时在一个事务中执行.
+    """
+    def __init__(self, store):
+        self.store    = store
+        self.commands = []
+
+    def __getattr__(self, name):
+        func = getattr(self.store, name)
+
+        def command(*args, **kwargs):
+            self.commands.append((name, func, args, kwargs))
+            return self
+        return command
+
+    def __len__(self):
+        return len(self.commands)
+
+    def execute(self, raise_on_error=True):
+        """
+        Run the buffered commands in one transaction, return their results.
+        Unlike redis, an error rolls back the whole transaction and is always
+        raised, 'raise_on_error' is only accepted for compatibility.
+        """
+        commands, self.commands = self.commands, []
+        immediate = any(name not in READONLY for name, _, _, _ in commands)
+        with self.store._transaction(immediate=immediate):
+            return [func(*args, **kwargs) for _, func, args, kwargs in commands]
+
+
+class SQLiteStore(object):
+    """用 SQLite 实现的 redis 命令的子集.
+    """
+    def __init__(self, path, timeout=30):
+        self.path    = path
+        self.timeout = timeout
+        self.local   = threading.local()
+
+        try:
+            self._conn().executescript(SCHEMA)
+        except sqlite3.Error as e:
+            raise StoreError(repr(e))
+
+    def _conn(self):
+        # 每个线程一个连接，事务的嵌套深度也按线程记录
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            try:
+                conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                       check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            except sqlite3.Error as e:
+                raise StoreError('Error when opening %s: %r' % (self.path, e))
+            self.local.conn  = conn
+            self.local.depth = 0
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self, immediate=False):
+        # 嵌套时只有最外层开始和提交事务
+        conn = self._conn()
+        if self.local.depth:
+            self.local.depth += 1
+            try:
+                yield conn
+            finally:
+                self.local.depth -= 1
+            return
+
+        try:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        except sqlite3.Error as e:
+            raise StoreError(repr(e))
+        self.local.depth = 1
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            if isinstance(e, sqlite3.Error):
+                raise StoreError(repr(e))
+            raise
+        finally:
+            self.local.depth = 0
+
+    def _query(self, sql, params=()):
+        try:
+            return self._conn().execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            raise StoreError(repr(e))
+
+    def _write(self, sql, params=(), many=False):
+        # 返回修改的行数
+        with self._transaction(immediate=True) as conn:
+            if many:
+                return conn.executemany(sql, params).rowcount
+            return conn.execute(sql, params).rowcount
+
+    def pipeline(self, transaction=True):
+        """Return a pipeline, commands are always run in one transaction"""
+        return Pipeline(self)
+
+    def ping(self):
+        self._query('SELECT 1')
+        return True
+
+    def publish(self, channel, message):
+        """No subscribers in the embedded backend, return 0"""
+        return 0
+
+    def delete(self, *names):
+        num = 0
+        with self._transaction(immediate=True):
+            for name in names:
+                name = _encode(name)
+                num += any([self._write('DELETE FROM %s WHERE key = ?' % (table,), (name,))
+                            for table in ('kv', 'sets', 'hashes', 'zsets')])
+        return num
+
+    # string
+    def get(self, name):
+        rows = self._query('SELECT value FROM kv WHERE key = ?', (_encode(name),))
+        return rows[0][0] if rows else None
+
+    def set(self, name, value):
+        self._write('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+                    (_encode(name), _encode(value)))
+        return True
+
+    def mget(self, keys, *args):
+        if isinstance(keys, (bytes, str)):
+            keys = [keys]
+        with self._transaction():
+            return [self.get(key) for key in list(keys) + list(args)]
+
+    def incr(self, name, amount=1):
+        with self._transaction(immediate=True):
+            value = int(self.get(name) or 0) + amount
+            self.set(name, value)
+        return value
+
+    # set
+    def sadd(self, name, *values):
+        name = _encode(name)
+        return self._write('INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)',
+                           [(name, _encode(value)) for value in values], many=True)
+
+    def srem(self, name, *values):
+        name = _encode(name)
+        return self._write('DELETE FROM sets WHERE key = ? AND member = ?',
+                           [(name, _encode(value)) for value in values], many=True)
+
+    def smembers(self, name):
+        return set(row[0] for row in
+                   self._query('SELECT member FROM sets WHERE key = ?', (_encode(name),)))
+
+    def sismember(self, name, value):
+        return bool(self._query('SELECT 1 FROM sets WHERE key = ? AND member = ?',
+                                (_encode(name), _encode(value))))
+
+    def scard(self, name):
+        return self._query('SELECT COUNT(*) FROM sets WHERE key = ?', (_encode(name),))[0][0]
+
+    # hash
+    def hset(self, name, key, value):
+        name, key = _encode(name), _encode(key)
+        with self._transaction(immediate=True):
+            new = not self._query('SELECT 1 FROM hashes WHERE key = ? AND field = ?', (name, key))
+            self._write('INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)',
+                        (name, key, _encode(value)))
+        return int(new)
+
+    def hget(self, name, key):
+        rows = self._query('SELECT value FROM hashes WHERE key = ? AND field = ?',
+                           (_encode(name), _encode(key)))
+        return rows[0][0] if rows else None
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, (bytes, str)):
+            keys = [keys]
+        keys = [_encode(key) for key in list(keys) + list(args)]
+        with self._transaction():
+            return [self.hget(name, key) for key in keys]
+
+    def hincrby(self, name, key, amount=1):
+        with self._transaction(immediate=True):
+            value = int(self.hget(name, key) or 0) + amount
+            self._write('INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)',
+                        (_encode(name), _encode(key), _encode(value)))
+        return value
+
+    def hdel(self, name, *keys):
+        name = _encode(name)
+        return self._write('DELETE FROM hashes WHERE key = ? AND field = ?',
+                           [(name, _encode(key)) for key in keys], many=True)
+
+    def hgetall(self, name):
+        return dict(self._query('SELECT field, value FROM hashes WHERE key = ?',
+                                (_encode(name),)))
+
+    def hlen(self, name):
+        return self._query('SELECT COUNT(*) FROM hashes WHERE key = ?', (_encode(name),))[0][0]
+
+    # sorted set
+    def zadd(self, name, *args, **kwargs):
+        """zadd(name, score1, member1, score2, member2, ..., member3=score3)"""
+        if len(args) % 2:
+            raise StoreError('ZADD requires an equal number of values and scores')
+        pairs = list(zip(args[1::2], args[::2])) + list(kwargs.items())
+        name  = _encode(name)
+        with self._transaction(immediate=True):
+            num = 0
+            for member, score in pairs:
+                member = _encode(member)
+                num   += not self._query('SELECT 1 FROM zsets WHERE key = ? AND member = ?',
+                                         (name, member))
+                self._write('INSERT OR REPLACE INTO zsets (key, member, score) VALUES (?, ?, ?)',
+                            (name, member, float(score)))
+        return num
+
+    def zrem(self, name, *values):
+        name = _encode(name)
+        return self._write('DELETE FROM zsets WHERE key = ? AND member = ?',
+                           [(name, _encode(value)) for value in values], many=True)
+
+    def zcard(self, name):
+        return self._query('SELECT COUNT(*) FROM zsets WHERE key = ?', (_encode(name),))[0][0]
+
+    def zscore(self, name, value):
+        rows = self._query('SELECT score FROM zsets WHERE key = ? AND member = ?',
+                           (_encode(name), _encode(value)))
+        return rows[0][0] if rows else None
+
+    def zcount(self, name, min, max):
+        where, params = _score_range(min, max)
+        return self._query('SELECT COUNT(*) FROM zsets WHERE key = ? AND ' + where,
+                           [_encode(name)] + params)[0][0]
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        with self._transaction():
+            if start < 0 or end < 0:
+                size  = self.zcard(name)
+                start = max(0, start + size if start < 0 else start)
+                end   = end + size if end < 0 else end
+            if end < start:
+                return []
+            order = 'DESC' if desc else 'ASC'
+            rows  = self._query('SELECT member, score FROM zsets WHERE key = ? '
+                                'ORDER BY score %s, member %s LIMIT ? OFFSET ?' % (order, order),
+                                (_encode(name), end - start + 1, start))
+        return self._members(rows, withscores, score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False,
+                      score_cast_func=float):
+        if (start is None) != (num is None):
+            raise StoreError('``start`` and ``num`` must both be specified')
+        where, params = _score_range(min, max)
+        sql = ('SELECT member, score FROM zsets WHERE key = ? AND %s ORDER BY score, member'
+               % (where,))
+        params = [_encode(name)] + params
+        if start is not None:
+            sql    += ' LIMIT ? OFFSET ?'
+            params += [num, start]
+        return self._members(self._query(sql, params), withscores, score_cast_func)
+
+    @staticmethod
+    def _members(rows, withscores, score_cast_func):
+        if withscores:
+            return [(member, score_cast_func(score)) for member, score in rows]
+        return [member for member, _ in rows]
+
+
+# 同一个文件的 SQLiteStore 在进程内共享
+_stores      = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path, timeout=30):
+    """Return the process-wide SQLiteStore of 'path'"""
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = SQLiteStore(path, timeout=timeout)
+            _stores[path] = store
+
+    return store
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""lease.py 的 Lua 脚本 (借出、归还、更新分数) 在真实的 redis-server 上的测试.
+
+stubredis 不支持 Lua 脚本，redis-server 是 $REDIS_SERVER 或 PATH 中的 redis-server，
+没有时跳过. 在项目根目录下运行:
+
+    $ REDIS_SERVER=/usr/bin/redis-server python3 -m unittest tests.test_lease
+"""
+
+import os
+import time
+import unittest
+
+from proxypool import ProxyPool
+from benchmarks.common import make_configfile, RedisServer
+
+
+NUM_PROXIES = 20
+
+
+def setUpModule():
+    global SERVER
+    SERVER = RedisServer().start()
+
+
+def tearDownModule():
+    if SERVER is not None:
+        SERVER.stop()
+
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        if SERVER is None:
+            self.skipTest('No redis-server, set REDIS_SERVER')
+        configfile = make_configfile(SERVER.port, LEASE={'SCAN': 200})
+        try:
+            self.proxypool = ProxyPool(configfile)
+        finally:
+            os.remove(configfile)
+
+        self.rdb      = self.proxypool.rdb
+        self.leases   = self.proxypool.leases
+        self.db       = self.proxypool.configs['TARGET']['ALL']['DB_PROXY']
+        self.maxscore = self.proxypool.init_value
+        self.rdb.flushdb()
+
+        # 分数越低越快，proxies 按分数从低到高
+        self.proxies = ['http://10.0.0.%d:80' % (i,) for i in range(NUM_PROXIES)]
+        pipe = self.rdb.pipeline(transaction=False)
+        for i, proxy in enumerate(self.proxies):
+            pipe.zadd(self.db, 1 + i * 0.1, proxy)
+        pipe.execute()
+
+    def checkout(self, num, ttl=None):
+        return self.leases.checkout('ALL', num, 0, self.maxscore, ttl)
+
+    def leased(self):
+        return sorted(p.decode('utf-8') for p in self.rdb.zrange(self.db + ':leases', 0, -1))
+
+    def test_checkout_fastest_first(self):
+        token, expires, proxies = self.checkout(3)
+        self.assertEqual([p.decode('utf-8') for p in proxies], self.proxies[:3])
+        self.assertTrue(expires > time.time())
+        self.assertEqual(self.leased(), sorted(self.proxies[:3]))
+
+    def test_checkout_skips_leased(self):
+        _, _, first  = self.checkout(5)
+        _, _, second = self.checkout(5)
+        self.assertEqual([p.decode('utf-8') for p in second], self.proxies[5:10])
+        self.assertFalse(set(first) & set(second))
+
+        # 全部借出后没有可借的代理
+        self.checkout(NUM_PROXIES)
+        self.assertEqual(self.checkout(1)[2], [])
+
+    def test_checkout_score_range(self):
+        token, expires, proxies = self.leases.checkout('ALL', NUM_PROXIES, 1.5, 2.05)
+        self.assertEqual([p.decode('utf-8') for p in proxies], self.proxies[5:11])
+
+    def test_lease_expires(self):
+        _, _, first = self.checkout(2, ttl=0.2)
+        self.assertEqual([p.decode('utf-8') for p in self.checkout(2)[2]], self.proxies[2:4])
+
+        time.sleep(0.3)
+        _, _, again = self.checkout(2)
+        self.assertEqual(again, first)
+
+    def test_release_wrong_token(self):
+        token, _, proxies = self.checkout(2)
+        self.assertEqual(self.leases.release('ALL', 'not-the-token', proxies), [])
+        self.assertEqual(self.leased(), sorted(self.proxies[:2]))
+        self.assertFalse(set(self.checkout(2)[2]) & set(proxies))
+
+        released = self.leases.release('ALL', token, proxies)
+        self.assertEqual(released, proxies)
+        self.assertEqual(self.leased(), sorted(self.proxies[2:4]))
+
+    def test_release_expired_lease_taken_by_another(self):
+        token, _, proxies = self.checkout(1, ttl=0.2)
+        time.sleep(0.3)
+        other, _, again = self.checkout(1)
+        self.assertEqual(again, proxies)
+        self.assertEqual(self.leases.release('ALL', token, proxies), [])
+        self.assertEqual(self.leases.release('ALL', other, again), again)
+
+    def test_release_outcome_updates_score(self):
+        version_key = self.proxypool._version_key('ALL')
+        token, _, proxies = self.checkout(1)
+        score = self.rdb.zscore(self.db, proxies[0])
+
+        self.leases.release('ALL', token, proxies, outcome='failed')
+        self.assertTrue(self.rdb.zscore(self.db, proxies[0]) > score)
+        self.assertEqual(int(self.rdb.get(version_key)), 1)
+
+        # 已经不在 sorted set 中的代理不会被重新加入
+        token, _, proxies = self.checkout(1)
+        self.rdb.zrem(self.db, proxies[0])
+        self.leases.release('ALL', token, proxies, outcome='ok', latency=0.5)
+        self.assertIsNone(self.rdb.zscore(self.db, proxies[0]))
+        self.assertEqual(int(self.rdb.get(version_key)), 1)
+
+    def test_scan_limit(self):
+        self.leases.scan = 5
+        self.checkout(5)
+        self.assertEqual(self.checkout(1)[2], [])
+
+    def test_scan_capped(self):
+        configfile = make_configfile(SERVER.port, LEASE={'SCAN': 100000})
+        try:
+            self.assertEqual(ProxyPool(configfile).leases.scan, self.leases.MAX_SCAN)
+        finally:
+            os.remove(configfile)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""handler 中等待 target 的 mtime 变化: /proxylist/watch (长轮询) 和 /proxylist/events (SSE).
+
+NOTE:
+  + 检测过程中 BatchWriter 每次写入新的 mtime 后，ProxyPool 在 CACHE.CHANNEL 上发布
+    'ALL:1394069400 58:1394069400'; 每个 worker 只有 ProxyListCache 的一个订阅线程，
+    收到后交给 MtimeWatcher，由 IOLoop 唤醒等待该 target 的请求，见 listcache.py
+  + 等待的请求不访问 redis: 每个 worker 中每个 target 只在第一次被等待时读一次 mtime，
+    之后由频道的通知更新; 重新订阅后 (可能错过了通知) 重新读一次已知的各 target
+  + 没有订阅时 (CACHE.CHANNEL 为空或 SQLite 后端) 每个 worker 每隔 CACHE.CHECK_INTERVAL 秒
+    读一次正在等待的 target 的 mtime，与客户端的数目无关
+  + 请求最多等待 WATCH.TIMEOUT 秒，超时返回当前的 mtime，客户端应立即重新请求
+"""
+
+import functools
+import threading
+
+import tornado.ioloop
+import tornado.concurrent
+
+import metrics
+
+
+WATCH_WAITERS = metrics.REGISTRY.gauge(
+    'proxypool_watch_waiters', 'Requests waiting for the mtime of a target to change')
+WATCH_WAKEUPS = metrics.REGISTRY.counter(
+    'proxypool_watch_wakeups_total', 'Waiting requests woken up by a new mtime')
+
+
+class MtimeWatcher(object):
+    """按 target 等待 mtime 变化.
+    """
+    def __init__(self, proxypool, subscribed=False, poll_interval=5):
+        self.proxypool     = proxypool
+        self.subscribed    = subscribed    # 是否由频道的通知调用 update
+        self.poll_interval = poll_interval
+
+        self.lock    = threading.Lock()
+        self.mtimes  = {}    # target -> 最新的 mtime，由订阅线程和 IOLoop 更新
+        self.waiters = {}    # target -> {future: since}，只在 IOLoop 中访问
+        self.ioloop  = None
+        self.poller  = None
+
+    def normalize(self, target):
+        target = str(target).upper()
+        if target not in self.proxypool.targets:
+            target = 'ALL'
+        return target
+
+    def update(self, mtimes):
+        """
+        Record {target: mtime} published on the channel, None if messages
+        may have been missed. Can be called in any thread.
+        """
+        if mtimes is None:
+            with self.lock:
+                targets = list(self.mtimes)
+            mtimes = self._read(targets)
+
+        changed = {}
+        with self.lock:
+            for target, mtime in mtimes.items():
+                if mtime > self.mtimes.get(target, 0):
+                    self.mtimes[target] = changed[target] = mtime
+            ioloop = self.ioloop
+        if changed and ioloop is not None:
+            ioloop.add_callback(self._wake, changed)
+
+    def _read(self, targets):
+        # 从 redis 读出 targets 的 mtime，没有 mtime 的 target 忽略
+        mtimes = {}
+        for target in targets:
+            try:
+                mtimes[target] = self.proxypool.get_mtime(target=target)
+            except (TypeError, ValueError):
+                continue
+        return mtimes
+
+    def _wake(self, changed):
+        for target, mtime in changed.items():
+            waiters = self.waiters.get(target, {})
+            for future, since in list(waiters.items()):
+                if mtime > since:
+                    del waiters[future]
+                    WATCH_WAKEUPS.inc()
+                    future.set_result(mtime)
+            if not waiters:
+                self.waiters.pop(target, None)
+        self._count()
+
+    def _count(self):
+        WATCH_WAITERS.set(sum(len(waiters) for waiters in self.waiters.values()))
+
+    def current(self, target):
+        """Return the latest mtime of 'target', read from redis the first time"""
+        with self.lock:
+            mtime = self.mtimes.get(target)
+        if mtime is None:
+            mtime = self.proxypool.get_mtime(target=target)
+            self.update({target: mtime})
+        return mtime
+
+    def wait(self, target, since, timeout):
+        """
+        Return a Future of the mtime of 'target' once it's later than
+        'since', or of None after 'timeout' seconds. Must be called in
+        the IOLoop.
+        """
+        ioloop = tornado.ioloop.IOLoop.current()
+        with self.lock:
+            self.ioloop = ioloop
+        self._start_poller()
+
+        future = tornado.concurrent.Future()
+        mtime  = self.current(target)
+        if mtime > since:
+            future.set_result(mtime)
+            return future
+
+        self.waiters.setdefault(target, {})[future] = since
+        self._count()
+        # IOLoop.call_later 需要 tornado 4.0，requirements.txt 中是 3.2
+        handle = ioloop.add_timeout(ioloop.time() + timeout,
+                                    functools.partial(self.cancel, target, future))
+        future.add_done_callback(lambda future: ioloop.remove_timeout(handle))
+        return future
+
+    def cancel(self, target, future):
+        """Resolve 'future' of 'target' with None, e.g. when the client has gone"""
+        waiters = self.waiters.get(target, {})
+        waiters.pop(future, None)
+        if not waiters:
+            self.waiters.pop(target, None)
+        if not future.done():
+            future.set_result(None)
+        self._count()
+
+    def _start_poller(self):
+        # 没有订阅频道时由每个 worker 定期读 mtime
+        if self.poller is not None or self.subscribed:
+            return
+        self.poller = tornado.ioloop.PeriodicCallback(self._poll, self.poll_interval * 1000)
+        self.poller.start()
+
+    def _poll(self):
+        if self.waiters:
+            self.update(self._read(list(self.waiters)))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""按分数加权、不放回地随机抽取代理.
+
+NOTE:
+  + 分数越低 (延迟越小) 权重越大，两种权重:
+    - inverse: 1 / 分数
+    - softmax: exp(-分数 / SELECT.TEMPERATURE)，温度越低越偏向最快的代理
+  + 预先建立 alias 表 (Vose)，每次抽取是 O(1); 表只在 target 的 mtime 变化后重建，
+    每个请求的耗时是 O(num)，与候选代理的数目无关
+  + 不放回抽样通过拒绝重复实现，num 接近候选数目或权重集中在少数代理上时拒绝会很多，
+    超过 num 的 MAX_REJECTS 倍后改为对剩余代理用 Efraimidis-Spirakis 方法一次抽完，是 O(N log N)
+"""
+
+import math
+import random
+
+
+# 分数的下限，避免 inverse 权重除以 0
+MIN_SCORE = 0.01
+
+# 拒绝重复的次数超过 num 的多少倍后改用 Efraimidis-Spirakis 方法
+MAX_REJECTS = 4
+
+
+def weights(scores, kind='inverse', temperature=1.0):
+    """Return the weights of 'scores' (lower is better)"""
+    if kind == 'softmax':
+        # 减去最小值，避免 exp 下溢为 0
+        low = min(scores) if scores else 0
+        return [math.exp(-(score - low) / temperature) for score in scores]
+    if kind == 'inverse':
+        return [1.0 / max(score, MIN_SCORE) for score in scores]
+    raise ValueError('Unknown weight kind %r' % (kind,))
+
+
+class WeightedSampler(object):
+    """items 按 weights 加权的 alias 表.
+    """
+    def __init__(self, items, weights):
+        self.items   = list(items)
+        self.weights = list(weights)
+        self.prob, self.alias = self._build(self.weights)
+
+    @staticmethod
+    def _build(weights):
+        # Vose 的 alias 方法，O(N)
+        num   = len(weights)
+        total = float(sum(weights))
+        if not num or total <= 0:
+            return [1.0] * num, list(range(num))
+
+        prob  = [weight * num / total for weight in weights]
+        alias = list(range(num))
+        small = [i for i, p in enumerate(prob) if p < 1.0]
+        large = [i for i, p in enumerate(prob) if p >= 1.0]
+        while small and large:
+            less, more  = small.pop(), large.pop()
+            alias[less] = more
+            prob[more]  = prob[more] + prob[less] - 1.0
+            if prob[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # 剩下的由于浮点误差没有配对，概率都是 1
+        for i in small + large:
+            prob[i] = 1.0
+
+        return prob, alias
+
+    def __len__(self):
+        return len(self.items)
+
+    def draw(self, rng=random):
+        """Return the index of one item, with replacement"""
+        i = int(rng.random() * len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+    def sample(self, num, rng=random):
+        """Return at most 'num' distinct items, in the order drawn"""
+        size = len(self.items)
+        if num >= size:
+            return self._sample_rest(set(), size, rng)
+
+        chosen  = []
+        seen    = set()
+        rejects = 0
+        while len(chosen) < num:
+            i = self.draw(rng)
+            if i in seen:
+                rejects += 1
+                if rejects > num * MAX_REJECTS:
+                    return chosen + self._sample_rest(seen, num - len(chosen), rng)
+                continue
+            seen.add(i)
+            chosen.append(self.items[i])
+
+        return chosen
+
+    def _sample_rest(self, seen, num, rng):
+        # Efraimidis-Spirakis: 每个代理的键是 u ** (1 / weight)，取键最大的 num 个;
+        # 比较的是键的对数 log(u) / weight，权重很小时不会下溢
+        keys = []
+        for i, weight in enumerate(self.weights):
+            if i in seen:
+                continue
+            if weight > 0:
+                keys.append((math.log(1.0 - rng.random()) / weight, i))
+            else:
+                keys.append((float('-inf'), i))
+        keys.sort(reverse=True)
+
+        return [self.items[i] for _, i in keys[:num]]